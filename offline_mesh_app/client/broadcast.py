@@ -1,18 +1,19 @@
-import json
 import time
 import uuid
 import socket
 import threading
 import ipaddress
-from client.sender import send_to_peer
+from client.sender import send_packet
 from config import (
     MY_ID, MY_IP, KNOWN_PEERS,
-    MAX_TTL, BROADCAST_INTERVAL, DISCOVERY_INTERVAL,
+    HSLS_SLOT, HSLS_TRIGGER_HOLDDOWN, ROUTING_SNAPSHOT_SLOTS, DISCOVERY_INTERVAL,
     PORT, save_config
 )
 from routing.router import router
+from routing.hsls import LOCAL_SCOPE, scope_for_slot
 from utils.logger import log_routing, routing_logger
-from utils.encryption import encrypt_data, decrypt_data
+from utils.codec import LOCAL_CODECS
+from utils.compression import LOCAL_COMPRESSIONS
 
 def get_all_network_interfaces():
     """Get all network interfaces IP addresses"""
@@ -196,7 +197,7 @@ def discover_peers():
         save_config()
         
         # Send an immediate routing update to announce to new peers
-        broadcast_routing_update()
+        broadcast_routing_update(snapshot=True)
     else:
         routing_logger.info(f"No new peers discovered. Current peers: {', '.join(KNOWN_PEERS) if KNOWN_PEERS else 'None'}")
     
@@ -213,10 +214,10 @@ def periodic_discovery():
         # Sleep between discovery runs
         time.sleep(DISCOVERY_INTERVAL)
 
-def broadcast_routing_update():
-    """Send a single routing update to known peers"""
+def broadcast_routing_update(scope=LOCAL_SCOPE, snapshot=False):
+    """Send our link state to known peers, to be flooded up to `scope` hops out"""
     # Get current link state from router
-    link_state = router.get_link_state()
+    link_state = router.get_link_state(scope, snapshot)
     
     # Create routing packet
     message_id = str(uuid.uuid4())
@@ -226,37 +227,59 @@ def broadcast_routing_update():
         "src": MY_ID,
         "link_state": link_state,
         "seq": link_state[MY_ID]["seq"],
-        "ttl": MAX_TTL,
-        "timestamp": time.time()
+        "ttl": scope,
+        "scope": scope,  # Lets receivers tell how far the update travelled
+        "hops": [],
+        "multi_hop": True,
+        "timestamp": time.time(),
+        "codecs": LOCAL_CODECS,  # Lets neighbors switch to our most compact packet encoding
+        "compressions": LOCAL_COMPRESSIONS  # And compress the bodies they send us
     }
     
-    # Convert to JSON
-    json_data = json.dumps(packet)
-    
-    # Encrypt if needed
-    encrypted_data = encrypt_data(json_data)
+    # Encodings shared by every peer we send to
+    encoded = {}
     
     # Send to all known peers
     for peer in KNOWN_PEERS:
         try:
-            send_to_peer(peer, encrypted_data)
+            send_packet(peer, packet, encoded=encoded)
             log_routing(peer, "ROUTING_SENT")
         except Exception as e:
             routing_logger.error(f"Failed to send routing update to {peer}: {e}")
 
 def broadcast_routing():
-    """Periodically broadcast routing updates"""
+    """Send routing updates on the HSLS schedule, plus a local one soon after our links change"""
+    slot = 0
+    next_slot = time.time()
     while True:
         try:
-            broadcast_routing_update()
-            
-            # Cleanup stale routes
+            # Cleanup stale routes as they fall due
             stale_count = router.cleanup_stale_routes()
             if stale_count > 0:
                 routing_logger.info(f"Removed {stale_count} stale routes")
                 
+            if time.time() >= next_slot:
+                slot += 1
+                next_slot = time.time() + HSLS_SLOT
+                
+                # Every slot's update reaches 2 hops, every 2nd one 4 hops and
+                # so on; it carries any link changes, so no separate one is due.
+                # Now and then one carries all our links for whoever missed a change
+                router.links_changed.clear()
+                broadcast_routing_update(scope_for_slot(slot), slot % ROUTING_SNAPSHOT_SLOTS == 0)
+            elif router.links_changed.is_set():
+                # Tell the nodes nearby now; the rest hear at their next scope
+                router.links_changed.clear()
+                broadcast_routing_update(LOCAL_SCOPE)
+        
         except Exception as e:
             routing_logger.error(f"Error in routing broadcast: {e}")
             
-        # Sleep between broadcasts
-        time.sleep(BROADCAST_INTERVAL)
+        # Sleep until the next slot or the next expiry, waking early when our
+        # links change; the hold-down gathers a burst of changes into one update
+        wake = next_slot
+        next_expiry = router.next_expiry()
+        if next_expiry is not None:
+            wake = min(wake, next_expiry)
+        if router.links_changed.wait(max(0.0, wake - time.time())):
+            time.sleep(HSLS_TRIGGER_HOLDDOWN)
@@ -0,0 +1,188 @@
+import math
+import time
+import threading
+from config import (
+    CHUNK_SIZE, TRANSFER_INITIAL_WINDOW, TRANSFER_MAX_WINDOW, CC_TARGET_QUEUE_DELAY,
+    MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, CHUNK_OVERHEAD_BYTES, CHUNKS_PER_RTT, CHUNK_SIZING_MIN_SAMPLES
+)
+
+# Retransmission timeout bounds, in seconds
+MIN_RTO = 0.5
+MAX_RTO = 10.0
+INITIAL_RTO = 2.0
+
+# Window reduction on loss, and the gentler one when queueing delay builds up
+LOSS_BACKOFF = 0.5
+DELAY_BACKOFF = 0.85
+
+# Weight of the newest transfer in each next hop's link history
+LINK_HISTORY_WEIGHT = 0.5
+
+# What recent transfers measured on each next hop, for sizing the next one's chunks
+link_history = {}  # {next hop ip: {"chunk_size": bytes, "srtt": s, "window_bytes": bytes, "byte_loss": per-byte loss, "updated": time}}
+link_history_lock = threading.Lock()
+
+
+def ideal_chunk_size(chunk_size, window_bytes, byte_loss):
+    """Chunk size to move to from `chunk_size`, given the bytes a link carries per round trip and its per-byte loss"""
+    # A lost chunk costs its whole size again; the best size on a lossy link
+    # is where that cost equals the overhead saved by sending fewer chunks
+    size = MAX_CHUNK_SIZE
+    if byte_loss > 0:
+        size = min(size, math.sqrt(CHUNK_OVERHEAD_BYTES / byte_loss))
+    
+    # Only grow while the window still holds several chunks per round trip,
+    # so it can pace and spot losses early. The window is counted in chunks,
+    # so a small one is no reason to shrink: smaller chunks would shrink it too
+    if size > chunk_size and window_bytes:
+        size = min(size, max(chunk_size, window_bytes / CHUNKS_PER_RTT))
+    
+    # Powers of two, so sizes change in whole steps
+    size = max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, int(size)))
+    return 1 << (size.bit_length() - 1)
+
+def path_chunk_size(cc, chunks_sent, chunks_lost):
+    """Ideal chunk size from one path's live measurements, or None until it has enough of them"""
+    if chunks_sent < CHUNK_SIZING_MIN_SAMPLES or cc.srtt is None:
+        return None
+    return ideal_chunk_size(cc.chunk_size, cc.window_bytes(), chunks_lost / chunks_sent / cc.chunk_size)
+
+def record_link(ip, cc, chunks_sent, chunks_lost):
+    """Fold what a transfer measured on a next hop into its link history"""
+    if chunks_sent < CHUNK_SIZING_MIN_SAMPLES or cc.srtt is None:
+        return
+    sample = {"chunk_size": cc.chunk_size, "srtt": cc.srtt, "window_bytes": cc.window_bytes(), "byte_loss": chunks_lost / chunks_sent / cc.chunk_size}
+    with link_history_lock:
+        history = link_history.get(ip)
+        if history is not None:
+            for key in ("srtt", "window_bytes", "byte_loss"):
+                sample[key] = LINK_HISTORY_WEIGHT * sample[key] + (1 - LINK_HISTORY_WEIGHT) * history[key]
+        sample["updated"] = time.time()
+        link_history[ip] = sample
+
+def choose_chunk_size(next_hops):
+    """Chunk size for a transfer over these next hops: what the worst measured one supports, or CHUNK_SIZE"""
+    sizes = []
+    with link_history_lock:
+        for ip in next_hops:
+            history = link_history.get(ip)
+            if history is not None:
+                sizes.append(ideal_chunk_size(history["chunk_size"], history["window_bytes"], history["byte_loss"]))
+    return min(sizes) if sizes else CHUNK_SIZE
+
+
+class CongestionController:
+    """AIMD congestion window for one bulk flow, with a queueing-delay signal and pacing"""
+    def __init__(self, chunk_size=CHUNK_SIZE, initial_window=TRANSFER_INITIAL_WINDOW, max_window=TRANSFER_MAX_WINDOW):
+        self.chunk_size = chunk_size
+        self.max_window = max_window
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        
+        # RTT estimation
+        self.srtt = None
+        self.rttvar = 0.0
+        self.min_rtt = None
+        self.rto = INITIAL_RTO
+        
+        # At most one window reduction per round trip
+        self.last_reduction = 0.0
+        
+        # Counters
+        self.losses = 0
+        self.timeouts = 0
+        self.delay_backoffs = 0
+        self.acked_bytes = 0
+        self.started = time.time()
+    
+    def on_rtt_sample(self, sample):
+        """Fold an RTT sample into the estimates and check for queue build-up"""
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+        
+        # Delay above the path's floor is time spent queued at relays; back off
+        # before they drop anything so chat traffic sharing them stays responsive
+        if self.srtt - self.min_rtt > CC_TARGET_QUEUE_DELAY and self._may_reduce():
+            self.cwnd = max(1.0, self.cwnd * DELAY_BACKOFF)
+            self.ssthresh = self.cwnd
+            self.delay_backoffs += 1
+    
+    def on_ack(self, acked_chunks):
+        """Grow the window for newly acknowledged chunks"""
+        self.acked_bytes += acked_chunks * self.chunk_size
+        
+        # The path delivers again, so drop the timeout backoff; after a collapse
+        # only resent chunks are in flight, and they give no RTT sample to do it
+        if self.srtt is not None:
+            self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+        for _ in range(acked_chunks):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1  # Slow start: doubles every round trip
+            else:
+                self.cwnd += 1 / self.cwnd  # Additive increase: one chunk per round trip
+        self.cwnd = min(self.cwnd, float(self.max_window))
+    
+    def on_loss(self):
+        """Multiplicative decrease when a chunk was lost"""
+        self.losses += 1
+        if self._may_reduce():
+            self.ssthresh = max(2.0, self.cwnd * LOSS_BACKOFF)
+            self.cwnd = self.ssthresh
+    
+    def on_timeout(self):
+        """Collapse the window when acknowledgements stopped altogether"""
+        self.timeouts += 1
+        self.ssthresh = max(2.0, self.cwnd * LOSS_BACKOFF)
+        self.cwnd = 1.0
+        self.rto = min(MAX_RTO, self.rto * 2)
+        self.last_reduction = time.time()
+    
+    def _may_reduce(self):
+        """Check if a round trip has passed since the last reduction, and record one if so"""
+        now = time.time()
+        if now - self.last_reduction < (self.srtt or self.rto):
+            return False
+        self.last_reduction = now
+        return True
+    
+    def window(self):
+        """Chunks that may be in flight"""
+        return max(1, int(self.cwnd))
+    
+    def window_bytes(self):
+        """Bytes the path has shown it can keep in flight, ignoring the collapse right after a timeout"""
+        return max(self.cwnd, min(self.ssthresh, float(self.max_window))) * self.chunk_size
+    
+    def pacing_interval(self):
+        """Seconds between chunk sends, spreading the window over a round trip"""
+        if self.srtt is None:
+            return 0.0
+        return self.srtt / max(1.0, self.cwnd)
+    
+    def rate(self):
+        """Current sending rate in bytes per second"""
+        if self.srtt is None or self.srtt <= 0:
+            return 0.0
+        return self.cwnd * self.chunk_size / self.srtt
+    
+    def get_stats(self):
+        """Get window, RTT and loss figures"""
+        elapsed = max(time.time() - self.started, 1e-6)
+        return {
+            "cwnd": self.cwnd,
+            "ssthresh": self.ssthresh,
+            "srtt_ms": (self.srtt or 0.0) * 1000,
+            "min_rtt_ms": (self.min_rtt or 0.0) * 1000,
+            "rto_ms": self.rto * 1000,
+            "rate_bps": self.rate(),
+            "goodput_bps": self.acked_bytes / elapsed,
+            "losses": self.losses,
+            "timeouts": self.timeouts,
+            "delay_backoffs": self.delay_backoffs
+        }
@@ -0,0 +1,318 @@
+import socket
+import select
+import threading
+import time
+from collections import deque
+from config import PORT, POOL_IDLE_TIMEOUT, EGRESS_PRIORITY_BURST, EGRESS_NOTSENT_LOWAT, EGRESS_QUEUE_MAX_BYTES
+from utils.framing import TRAFFIC_CONTROL, TRAFFIC_INTERACTIVE, TRAFFIC_BULK, TRAFFIC_CLASS_NAMES
+from utils.logger import network_logger
+from client.rate_limit import rate_limiter
+
+# Order in which the egress scheduler serves traffic classes
+EGRESS_PRIORITY = (TRAFFIC_CONTROL, TRAFFIC_INTERACTIVE, TRAFFIC_BULK)
+
+
+class PeerConnection:
+    """A long-lived TCP connection to one peer, shared by every sender through a priority egress queue"""
+    def __init__(self, ip, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.ip = ip
+        self.sock = None
+        self.lock = threading.Lock()  # Serializes whole frames onto the stream
+        self.last_used = time.time()
+        self.idle_timeout = idle_timeout
+        
+        # Frames waiting for the writer thread, one queue per traffic class
+        self.queues = {traffic_class: deque() for traffic_class in EGRESS_PRIORITY}  # {class: deque of frame dicts}
+        self.queued_bytes = {traffic_class: 0 for traffic_class in EGRESS_PRIORITY}  # Bytes queued by senders that didn't wait
+        self.queue_lock = threading.Lock()
+        self.not_empty = threading.Condition(self.queue_lock)
+        self.writer_thread = None
+        
+        # Counters, per class name
+        self.sent = {name: 0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.max_depth = {name: 0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.total_wait = {name: 0.0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.max_wait = {name: 0.0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.dropped = {name: 0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.passed_over = {traffic_class: 0 for traffic_class in EGRESS_PRIORITY}  # Frames sent ahead of a waiting class since it last sent
+        self.promoted = 0  # Frames sent ahead of higher-priority traffic to keep their class moving
+    
+    def _connect(self):
+        """Open the underlying socket"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(5)
+        # Keep unsent bytes in our priority queues rather than the kernel's
+        # send buffer, where a chat frame would wait behind queued bulk data;
+        # only some platforms have the option
+        if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+            try:
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, EGRESS_NOTSENT_LOWAT)
+            except OSError:
+                pass
+        try:
+            s.connect((self.ip, PORT))
+        except Exception:
+            s.close()
+            raise
+        self.sock = s
+        network_logger.debug(f"Opened pooled connection to {self.ip}")
+    
+    def _close(self):
+        """Close the underlying socket, if any"""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+    
+    def _is_stale(self):
+        """Check if the peer has closed or reset an idle connection"""
+        try:
+            # Peers never write back on this connection, so readable means EOF or reset
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable)
+        except (OSError, ValueError):
+            return True
+    
+    def send(self, data, traffic_class=TRAFFIC_INTERACTIVE, wait=True, on_error=None, limits=()):
+        """Queue one complete frame behind higher-priority traffic and wait until it is written; with wait=False return at once, False if the queue is full"""
+        if traffic_class not in self.queues:
+            traffic_class = TRAFFIC_INTERACTIVE
+        frame = {
+            "data": data, "enqueued": time.time(), "done": threading.Event() if wait else None, "error": None,
+            "on_error": on_error, "limits": (rate_limiter.peer(self.ip),) + tuple(limits)  # Buckets the frame is charged to
+        }
+        
+        with self.queue_lock:
+            queue = self.queues[traffic_class]
+            class_name = TRAFFIC_CLASS_NAMES[traffic_class]
+            if not wait:
+                # Nobody waits on these frames to slow their senders down, so a
+                # neighbor that can't keep up turns them into drops, not memory
+                if self.queued_bytes[traffic_class] + len(data) > EGRESS_QUEUE_MAX_BYTES:
+                    self.dropped[class_name] += 1
+                    return False
+                self.queued_bytes[traffic_class] += len(data)
+            queue.append(frame)
+            self.max_depth[class_name] = max(self.max_depth[class_name], len(queue))
+            
+            # The writer exits once the connection goes quiet; start another
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self._write_frames, name=f"egress-{self.ip}", daemon=True)
+                self.writer_thread.start()
+            self.not_empty.notify()
+        
+        if wait:
+            frame["done"].wait()
+            if frame["error"] is not None:
+                raise frame["error"]
+        return True
+    
+    def _next_frame(self):
+        """Take the oldest frame of the highest-priority class that has one, letting a lower class through now and then; also return how long held-back bulk frames wait"""
+        waiting = [traffic_class for traffic_class in EGRESS_PRIORITY if self.queues[traffic_class]]
+        
+        # Bulk frames sit out while a bucket the next one is charged to is in
+        # debt, so the classes above them keep flowing instead of waiting behind the limit
+        held = 0.0
+        if TRAFFIC_BULK in waiting:
+            held = max(bucket.debt_delay() for bucket in self.queues[TRAFFIC_BULK][0]["limits"])
+            if held > 0:
+                waiting.remove(TRAFFIC_BULK)
+        if not waiting:
+            return None, None, held
+        
+        # A lower class passed over for a whole burst gets one frame out, so a
+        # busy higher class can slow it down but never starve it outright
+        chosen = waiting[0]
+        for traffic_class in reversed(waiting[1:]):
+            if self.passed_over[traffic_class] >= EGRESS_PRIORITY_BURST:
+                chosen = traffic_class
+                self.promoted += 1
+                break
+        
+        for traffic_class in waiting:
+            if traffic_class == chosen:
+                self.passed_over[traffic_class] = 0
+            elif EGRESS_PRIORITY.index(traffic_class) > EGRESS_PRIORITY.index(chosen):
+                self.passed_over[traffic_class] += 1
+        return chosen, self.queues[chosen].popleft(), held
+    
+    def _write_frames(self):
+        """Write queued frames to the socket in priority order"""
+        while True:
+            with self.queue_lock:
+                traffic_class, frame, held = self._next_frame()
+                while frame is None:
+                    # Wake for a new frame, or once held-back bulk frames may
+                    # go; with nothing queued the writer exits when idle
+                    self.not_empty.wait(held or self.idle_timeout)
+                    traffic_class, frame, held = self._next_frame()
+                    if frame is None and not held:
+                        self.writer_thread = None
+                        return
+                
+                if frame["done"] is None:
+                    self.queued_bytes[traffic_class] -= len(frame["data"])
+                class_name = TRAFFIC_CLASS_NAMES[traffic_class]
+                wait = time.time() - frame["enqueued"]
+                self.sent[class_name] += 1
+                self.total_wait[class_name] += wait
+                self.max_wait[class_name] = max(self.max_wait[class_name], wait)
+            
+            try:
+                # Every frame uses up its buckets, but none sleeps here; the
+                # debt a bulk frame leaves holds back the next one
+                for bucket in frame["limits"]:
+                    bucket.reserve(len(frame["data"]), wait=traffic_class == TRAFFIC_BULK)
+                self._write(frame["data"])
+            except Exception as e:
+                frame["error"] = e
+            
+            if frame["done"] is not None:
+                frame["done"].set()
+            elif frame["error"] is not None and frame["on_error"] is not None:
+                frame["on_error"](frame["error"])
+    
+    def _write(self, data):
+        """Write one complete frame, reconnecting lazily if needed"""
+        with self.lock:
+            if self.sock is not None and self._is_stale():
+                network_logger.debug(f"Pooled connection to {self.ip} was closed by peer, reconnecting")
+                self._close()
+            
+            if self.sock is None:
+                self._connect()
+            
+            try:
+                self.sock.sendall(data)
+            except Exception:
+                # Drop the broken socket so the next attempt reconnects
+                self._close()
+                raise
+            
+            self.last_used = time.time()
+    
+    def close_if_idle(self, now, idle_timeout):
+        """Close the connection if it hasn't been used recently"""
+        # Don't wait behind an in-progress send; it isn't idle
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self.sock is not None and now - self.last_used > idle_timeout:
+                self._close()
+                return True
+            return False
+        finally:
+            self.lock.release()
+    
+    def close(self):
+        """Close the connection"""
+        with self.lock:
+            self._close()
+    
+    def get_stats(self):
+        """Get queue depth and queueing latency per traffic class"""
+        with self.queue_lock:
+            stats = {}
+            for traffic_class in EGRESS_PRIORITY:
+                class_name = TRAFFIC_CLASS_NAMES[traffic_class]
+                sent = self.sent[class_name]
+                stats[class_name] = {
+                    "depth": len(self.queues[traffic_class]),
+                    "max_depth": self.max_depth[class_name],
+                    "sent": sent,
+                    "total_wait": self.total_wait[class_name],
+                    "avg_wait_ms": (self.total_wait[class_name] / sent * 1000) if sent else 0.0,
+                    "max_wait_ms": self.max_wait[class_name] * 1000,
+                    "dropped": self.dropped[class_name]
+                }
+            stats["promoted"] = self.promoted
+            return stats
+
+
+class ConnectionPool:
+    """Persistent outgoing connections keyed by peer IP"""
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.connections = {}  # {ip: PeerConnection}
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.reaper_thread = None
+    
+    def get(self, ip):
+        """Get the connection for a peer, creating it on first use"""
+        with self.lock:
+            connection = self.connections.get(ip)
+            if connection is None:
+                connection = PeerConnection(ip, self.idle_timeout)
+                self.connections[ip] = connection
+            
+            # Start the idle reaper the first time the pool is used
+            if self.reaper_thread is None:
+                self.reaper_thread = threading.Thread(target=self._reap_idle_connections, daemon=True)
+                self.reaper_thread.start()
+            
+            return connection
+    
+    def send(self, ip, data, traffic_class=TRAFFIC_INTERACTIVE, wait=True, on_error=None, limits=()):
+        """Send one complete frame to a peer, ahead of queued lower-priority frames"""
+        return self.get(ip).send(data, traffic_class, wait, on_error, limits)
+    
+    def close_idle(self):
+        """Close connections that have been idle longer than the timeout"""
+        now = time.time()
+        with self.lock:
+            connections = list(self.connections.items())
+        
+        closed = 0
+        for ip, connection in connections:
+            if connection.close_if_idle(now, self.idle_timeout):
+                network_logger.debug(f"Closed idle pooled connection to {ip}")
+                closed += 1
+        return closed
+    
+    def close_all(self):
+        """Close every pooled connection"""
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        
+        for connection in connections:
+            connection.close()
+    
+    def get_stats(self):
+        """Get egress queue depth and latency per traffic class, for each peer and in total"""
+        with self.lock:
+            connections = list(self.connections.items())
+        
+        peers = {ip: connection.get_stats() for ip, connection in connections}
+        totals = {}
+        for traffic_class in EGRESS_PRIORITY:
+            class_name = TRAFFIC_CLASS_NAMES[traffic_class]
+            per_peer = [stats[class_name] for stats in peers.values()]
+            sent = sum(s["sent"] for s in per_peer)
+            total_wait = sum(s["total_wait"] for s in per_peer)
+            totals[class_name] = {
+                "depth": sum(s["depth"] for s in per_peer),
+                "max_depth": max((s["max_depth"] for s in per_peer), default=0),
+                "sent": sent,
+                "avg_wait_ms": (total_wait / sent * 1000) if sent else 0.0,
+                "max_wait_ms": max((s["max_wait_ms"] for s in per_peer), default=0.0),
+                "dropped": sum(s["dropped"] for s in per_peer)
+            }
+        totals["promoted"] = sum(stats["promoted"] for stats in peers.values())
+        return {"total": totals, "peers": peers}
+    
+    def _reap_idle_connections(self):
+        """Periodically close idle connections"""
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            try:
+                self.close_idle()
+            except Exception as e:
+                network_logger.error(f"Error closing idle connections: {e}")
+
+
+# Create a global connection pool
+connection_pool = ConnectionPool()
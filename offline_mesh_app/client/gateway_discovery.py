@@ -1,12 +1,10 @@
 import threading
 import time
-import json
 import socket
 from config import PORT, MY_ID, MY_IP, IS_HOTSPOT_HOST, GATEWAY_BROADCAST_INTERVAL
 from routing.router import router
 from utils.logger import network_logger
-from utils.encryption import encrypt_data
-from client.sender import send_to_peer
+from client.sender import send_packet
 
 def share_peers_with_gateways():
     """Share our known peers with other gateway nodes"""
@@ -22,7 +20,7 @@ def share_peers_with_gateways():
             gateways = []
             with router.lock:
                 for node_id, route in router.routing_table.items():
-                    if route.get("is_gateway", False) and time.time() - route["timestamp"] <= 60:
+                    if route.get("is_gateway", False):
                         gateways.append(route["next_hop"])
             
             if gateways:
@@ -38,13 +36,12 @@ def share_peers_with_gateways():
                     "timestamp": time.time()
                 }
                 
-                # Convert to JSON and encrypt
-                json_data = json.dumps(gateway_packet)
-                encrypted_data = encrypt_data(json_data)
+                # Encodings shared by every gateway we send to
+                encoded = {}
                 
                 # Share with other gateways
                 for gateway_ip in gateways:
-                    send_to_peer(gateway_ip, encrypted_data, retry=2)
+                    send_packet(gateway_ip, gateway_packet, retry=2, encoded=encoded)
             
             # Run this function periodically
             time.sleep(GATEWAY_BROADCAST_INTERVAL)
@@ -60,19 +57,9 @@ def handle_gateway_update(packet, source_ip):
         is_gateway = packet.get("is_gateway", False)
         peers = packet.get("peers", [])
         
-        # Update routing table with gateway information
-        router.update_link_state(
-            source_id, 
-            source_ip, 
-            {"is_gateway": is_gateway},
-            0,  # No sequence number for gateway updates
-            2   # TTL of 2 for gateway updates
-        )
-        
-        # Mark this node as a gateway in the routing table
-        with router.lock:
-            if source_id in router.routing_table:
-                router.routing_table[source_id]["is_gateway"] = True
+        # Gateway updates come straight from the gateway, so it's a neighbor
+        if is_gateway:
+            router.mark_gateway(source_id, source_ip)
         
         network_logger.info(f"Received gateway update from {source_id} with {len(peers)} peers")
         
@@ -0,0 +1,61 @@
+import time
+import uuid
+from config import MY_ID, LINK_PROBE_INTERVAL
+from routing.router import router
+from utils.logger import network_logger
+from client.sender import send_packet
+
+def send_probe(node_id):
+    """Queue one probe to a neighbor; its reply is matched to it by sequence number"""
+    probe = router.start_probe(node_id)
+    if probe is None:
+        return
+    
+    ip, seq = probe
+    packet = {
+        "type": "probe",
+        "id": str(uuid.uuid4()),
+        "src": MY_ID,
+        "dst": node_id,
+        "seq": seq,
+        "ttl": 1,
+        "timestamp": time.time()
+    }
+    # A probe the egress queue can't take stays pending and times out as lost
+    send_packet(ip, packet, retry=0, wait=False)
+
+def probe_links():
+    """Probe every neighbor periodically, measuring the round trip and loss of each link"""
+    while True:
+        # Probes only go into each neighbor's egress queue, so one that can't
+        # be reached doesn't hold up the others' measurements
+        for node_id in router.get_neighbor_ids():
+            try:
+                send_probe(node_id)
+            except Exception as e:
+                network_logger.error(f"Error probing {node_id}: {e}")
+        
+        time.sleep(LINK_PROBE_INTERVAL)
+
+def handle_probe(packet, source_ip, received):
+    """Answer a neighbor's probe, telling it how long the probe waited here"""
+    try:
+        reply = {
+            "type": "probe_reply",
+            "id": packet.get("id"),
+            "src": MY_ID,
+            "dst": packet.get("src"),
+            "seq": packet.get("seq"),
+            "held": time.time() - received,
+            "ttl": 1
+        }
+        send_packet(source_ip, reply, retry=0, wait=False)
+    except Exception as e:
+        network_logger.error(f"Error answering probe from {source_ip}: {e}")
+
+def handle_probe_reply(packet, source_ip, received):
+    """Record the answer to one of our probes"""
+    try:
+        router.record_probe_reply(packet.get("src"), packet.get("seq"), received, packet.get("held", 0.0))
+    except Exception as e:
+        network_logger.error(f"Error handling probe reply from {source_ip}: {e}")
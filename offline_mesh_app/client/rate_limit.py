@@ -0,0 +1,161 @@
+import time
+import threading
+from config import TRANSFER_RATE_LIMIT, PEER_RATE_LIMIT, FORWARD_RATE_LIMIT, RATE_LIMIT_BURST
+
+
+class TokenBucket:
+    """Byte-rate limit that lets bursts of up to `burst` bytes through and holds senders back beyond that"""
+    def __init__(self, rate=0, burst=RATE_LIMIT_BURST):
+        self.rate = rate  # Bytes per second; 0 means unlimited
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        
+        # Counters
+        self.passed_bytes = 0
+        self.throttled_bytes = 0  # Bytes that had to wait for tokens
+        self.throttled_time = 0.0  # Seconds senders spent waiting
+    
+    def _refill(self, now):
+        """Add the tokens earned since the last call; call with the lock held"""
+        if self.rate > 0:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def set_rate(self, rate):
+        """Change the rate; the bucket keeps what it holds"""
+        with self.lock:
+            self._refill(time.time())
+            self.rate = rate
+            if rate <= 0:
+                self.tokens = float(self.burst)
+    
+    def reserve(self, count, wait=True):
+        """Take `count` bytes of tokens and return the seconds to wait before sending them; with `wait` False the bytes only use up the bucket"""
+        with self.lock:
+            self.passed_bytes += count
+            if self.rate <= 0:
+                return 0.0
+            
+            # Tokens may go negative, so a send larger than the burst still
+            # goes through once, and whoever takes the next ones waits it off
+            self._refill(time.time())
+            self.tokens -= count
+            if self.tokens >= 0 or not wait:
+                return 0.0
+            delay = -self.tokens / self.rate
+            self.throttled_bytes += count
+            self.throttled_time += delay
+            return delay
+    
+    def debt_delay(self):
+        """Get the seconds until the bucket is out of debt, without taking any tokens"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill(time.time())
+            return max(0.0, -self.tokens / self.rate)
+    
+    def consume(self, count, wait=True):
+        """Take `count` bytes of tokens, sleeping until they are earned unless `wait` is False"""
+        # Traffic that mustn't wait still uses up the bucket, so bulk traffic
+        # behind it slows down to keep the total under the limit
+        delay = self.reserve(count, wait)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+    
+    def get_stats(self):
+        """Get the rate and how much traffic the limit held back"""
+        with self.lock:
+            return {
+                "rate_bps": self.rate,
+                "passed_bytes": self.passed_bytes,
+                "throttled_bytes": self.throttled_bytes,
+                "throttled_time": self.throttled_time
+            }
+
+
+class RateLimiter:
+    """Bandwidth caps for each outgoing transfer, each neighbor and traffic forwarded for other nodes"""
+    def __init__(self, transfer_rate=TRANSFER_RATE_LIMIT, peer_rate=PEER_RATE_LIMIT, forward_rate=FORWARD_RATE_LIMIT):
+        self.transfer_rate = transfer_rate
+        self.peer_rate = peer_rate
+        self.transfers = {}  # {file_id: TokenBucket}
+        self.peers = {}  # {ip: TokenBucket}
+        self.forward = TokenBucket(forward_rate)
+        self.lock = threading.Lock()
+        
+        # Counters of transfers that have finished
+        self.finished_transfers = {"passed_bytes": 0, "throttled_bytes": 0, "throttled_time": 0.0}
+    
+    def set_limits(self, transfer_rate=None, peer_rate=None, forward_rate=None):
+        """Change any of the limits, in bytes per second (0 for unlimited); running transfers and peers follow"""
+        with self.lock:
+            if transfer_rate is not None:
+                self.transfer_rate = transfer_rate
+                for bucket in self.transfers.values():
+                    bucket.set_rate(transfer_rate)
+            if peer_rate is not None:
+                self.peer_rate = peer_rate
+                for bucket in self.peers.values():
+                    bucket.set_rate(peer_rate)
+        if forward_rate is not None:
+            self.forward.set_rate(forward_rate)
+    
+    def get_limits(self):
+        """Get the current limits, in bytes per second"""
+        with self.lock:
+            return {"transfer_rate": self.transfer_rate, "peer_rate": self.peer_rate, "forward_rate": self.forward.rate}
+    
+    def open_transfer(self, file_id):
+        """Get a bucket for an outgoing transfer, at the current per-transfer limit"""
+        with self.lock:
+            bucket = self.transfers.get(file_id)
+            if bucket is None:
+                bucket = TokenBucket(self.transfer_rate)
+                self.transfers[file_id] = bucket
+            return bucket
+    
+    def close_transfer(self, file_id):
+        """Forget a finished transfer's bucket, keeping its counters in the totals"""
+        with self.lock:
+            bucket = self.transfers.pop(file_id, None)
+            if bucket is None:
+                return
+            for key, value in bucket.get_stats().items():
+                if key in self.finished_transfers:
+                    self.finished_transfers[key] += value
+    
+    def peer(self, ip):
+        """Get the bucket for traffic to a neighbor"""
+        with self.lock:
+            bucket = self.peers.get(ip)
+            if bucket is None:
+                bucket = TokenBucket(self.peer_rate)
+                self.peers[ip] = bucket
+            return bucket
+    
+    def get_stats(self):
+        """Get each limit's rate and how much traffic it throttled"""
+        with self.lock:
+            transfers = {file_id: bucket.get_stats() for file_id, bucket in self.transfers.items()}
+            peers = {ip: bucket.get_stats() for ip, bucket in self.peers.items()}
+            transfer_totals = dict(self.finished_transfers)
+        
+        for stats in transfers.values():
+            for key in transfer_totals:
+                transfer_totals[key] += stats[key]
+        transfer_totals["rate_bps"] = self.transfer_rate
+        
+        return {
+            "transfer": transfer_totals,
+            "transfers": transfers,
+            "peers": peers,
+            "forward": self.forward.get_stats()
+        }
+
+
+# Create a global rate limiter
+rate_limiter = RateLimiter()
@@ -1,52 +1,111 @@
 import socket
 from config import PORT
 import os
-import json
 import time
 import uuid
-import base64
 import threading
 from tqdm import tqdm
-from config import CHUNK_SIZE, MY_ID, MY_IP, MAX_TTL
+from config import (
+    CHUNK_SIZE, MY_ID, MY_IP, MAX_TTL, USE_ENCRYPTION, ENCRYPT_DIRECT_TRANSFERS,
+    HAVE_MAP_TIMEOUT, TRANSFER_MAX_ROUNDS, MULTIPATH_MAX_PATHS, FILE_HASHES_PER_PACKET,
+    CUT_THROUGH_TRANSFERS, FLOW_STATUS_TIMEOUT, CHUNK_RESIZE_FACTOR
+)
 from routing.router import router
 from routing.cache import message_cache, file_cache
 from utils.logger import log_message, log_file_transfer, network_logger
-from utils.encryption import encrypt_data
+from utils.codec import codec_for_peer
+from utils.compression import compression_for_peer
+from utils.envelope import seal_packet
+from utils.merkle import file_chunk_hashes, merkle_root, pack_hashes
+from utils.framing import (
+    encode_frame, encode_frame_header, FRAME_FILE_STREAM, FRAME_FLOW_STREAM, FLAG_SEALED_STREAM,
+    TRAFFIC_INTERACTIVE, TRAFFIC_BULK, TRAFFIC_CLASS_NAMES, frame_flags_for, frame_traffic_class, recv_exact
+)
+from utils.file_stream import (
+    TransferProgress, file_stream_length, send_file_stream, flow_stream_id,
+    FLOW_HEADER_LENGTH, FLOW_COMPLETE, FLOW_INCOMPLETE, FLOW_UNVERIFIED, STREAM_ID_SIZE
+)
+from client.connection_pool import connection_pool
+from client.transfer import expect_have_map, wait_have_map, missing_chunks, FileTransfer
+from client.congestion import choose_chunk_size
+from client.rate_limit import rate_limiter
 
 
-def chunk_file(file_path, chunk_size=1024):
+def chunk_file(file_path, chunk_size=CHUNK_SIZE):
     with open(file_path, "rb") as f:
         while chunk := f.read(chunk_size):
             yield chunk
 
-def send_file_to_peer(ip, file_path):
+def stream_file(ip, file_path):
+    """Send a file over its own connection as a single file-stream frame"""
+    filesize = os.path.getsize(file_path)
+    sealed = ENCRYPT_DIRECT_TRANSFERS and USE_ENCRYPTION
+    
+    s = socket.create_connection((ip, PORT), timeout=10)  # Longer timeout for file transfer
+    try:
+        # Announce the stream length so the receiver reads exactly one frame
+        flags = TRAFFIC_BULK | (FLAG_SEALED_STREAM if sealed else 0)
+        stream_id = os.urandom(STREAM_ID_SIZE) if sealed else b''
+        s.sendall(encode_frame_header(len(stream_id) + file_stream_length(filesize, sealed), FRAME_FILE_STREAM, flags) + stream_id)
+        
+        # Progress is reported from its own thread so the send loop stays tight
+        with TransferProgress(filesize, f"Sending {os.path.basename(file_path)}") as progress:
+            send_file_stream(s, file_path, filesize, sealed, progress, limits=(rate_limiter.peer(ip),), stream_id=stream_id)
+    finally:
+        s.close()
+
+def encode_flow_header(ip, packet, stream_length, flags):
+    """Build the frame header and routing header that open a flow stream of `stream_length` file bytes"""
+    envelope = seal_packet(packet, codec_for_peer(ip), compression_for_peer(ip))
+    length = FLOW_HEADER_LENGTH.size + len(envelope) + stream_length
+    return encode_frame_header(length, FRAME_FLOW_STREAM, flags) + FLOW_HEADER_LENGTH.pack(len(envelope)) + envelope
+
+def open_flow(ip, packet, stream_length, flags):
+    """Connect to a next hop and send the header of a flow stream"""
+    header = encode_flow_header(ip, packet, stream_length, flags)
+    s = socket.create_connection((ip, PORT), timeout=10)  # Longer timeout for file transfer
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((ip, PORT))
+        s.sendall(header)
+    except Exception:
+        s.close()
+        raise
+    return s
 
-        for chunk in chunk_file(file_path):
-            s.sendall(chunk)
+def stream_flow(ip, info_packet, file_path, sealed, rate_limit=None):
+    """Stream a file to the node named in its file info, returning the destination's status byte"""
+    filesize = os.path.getsize(file_path)
+    flags = TRAFFIC_BULK | (FLAG_SEALED_STREAM if sealed else 0)
+    s = open_flow(ip, info_packet, file_stream_length(filesize, sealed), flags)
+    try:
+        with TransferProgress(filesize, f"Streaming {os.path.basename(file_path)}") as progress:
+            limits = (rate_limiter.peer(ip),) if rate_limit is None else (rate_limit, rate_limiter.peer(ip))
+            send_file_stream(s, file_path, filesize, sealed, progress, limits=limits, stream_id=flow_stream_id(info_packet))
         
+        # The destination confirms once everything is on its disk
+        s.settimeout(FLOW_STATUS_TIMEOUT)
+        return recv_exact(s, 1) or FLOW_INCOMPLETE
+    finally:
         s.close()
+
+def send_file_to_peer(ip, file_path):
+    try:
+        stream_file(ip, file_path)
         print(f"[INFO] File sent to {ip}")
     except Exception as e:
         print(f"[ERROR] Could not send file to {ip}: {e}")
 
 
-def send_to_peer(ip, data, retry=3):
-    """Send data to a specific peer with enhanced retry logic"""
+def send_to_peer(ip, data, retry=3, flags=TRAFFIC_INTERACTIVE, wait=True, limits=()):
+    """Send data to a specific peer over its pooled connection, with retries"""
+    # Wrap the packet in a length-prefixed frame tagged with its traffic class
+    frame = encode_frame(data, flags=flags)
+    traffic_class = frame_traffic_class(flags)
+    if not wait:
+        return queue_to_peer(ip, frame, traffic_class, retry, limits)
+    
     for attempt in range(retry + 1):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5)
-            s.connect((ip, PORT))
-            
-            # Convert data to bytes if it's not already
-            if isinstance(data, str):
-                data = data.encode()
-                
-            s.sendall(data)
-            s.close()
+            connection_pool.send(ip, frame, traffic_class, limits=limits)
             return True
         except Exception as e:
             if attempt < retry:
@@ -56,8 +115,41 @@ def send_to_peer(ip, data, retry=3):
                 time.sleep(backoff_time)  # Increasing backoff
             else:
                 network_logger.error(f"Failed to send to {ip} after {retry} retries: {e}")
+                router.record_link_failure(ip)
                 return False
 
+def queue_to_peer(ip, frame, traffic_class, retry, limits=(), attempt=0):
+    """Hand a frame to a peer's egress queue without waiting for it to be written, retrying a failed write from a timer"""
+    def on_error(e):
+        if attempt < retry:
+            backoff_time = (attempt + 1) * 1.5
+            network_logger.warning(f"Failed to send to {ip}, retrying in {backoff_time}s (attempt {attempt+1}/{retry}): {e}")
+            timer = threading.Timer(backoff_time, queue_to_peer, (ip, frame, traffic_class, retry, limits, attempt + 1))
+            timer.daemon = True
+            timer.start()
+        else:
+            network_logger.error(f"Failed to send to {ip} after {retry} retries: {e}")
+            router.record_link_failure(ip)
+    
+    if not connection_pool.send(ip, frame, traffic_class, wait=False, on_error=on_error, limits=limits):
+        network_logger.warning(f"Egress queue to {ip} is full, dropping a {TRAFFIC_CLASS_NAMES[traffic_class]} packet")
+        return False
+    return True
+
+def send_packet(ip, packet, retry=3, encoded=None, wait=True, limits=()):
+    """Seal a packet with the codec and compression the peer supports and send it, or only queue it if wait is False"""
+    codec = codec_for_peer(ip)
+    compression = compression_for_peer(ip)
+    
+    # Reuse the sealed packet when the same packet fans out to several peers;
+    # relayed packets keep their original sealed body and only get a new header
+    if encoded is None:
+        encoded = {}
+    if (codec, compression) not in encoded:
+        encoded[(codec, compression)] = seal_packet(packet, codec, compression)
+    
+    return send_to_peer(ip, encoded[(codec, compression)], retry, frame_flags_for(packet.get("type")), wait, limits)
+
 def send_message(destination_id, content, message_type="text"):
     """Send a message to a specific node"""
     # Generate a unique message ID
@@ -78,67 +170,21 @@ def send_message(destination_id, content, message_type="text"):
         "multi_hop": True  # Flag to indicate this is for a multi-hop network
     }
     
-    # Convert to JSON
-    json_data = json.dumps(packet)
-    
-    # Encrypt for transmission
-    encrypted_data = encrypt_data(json_data)
+    # Encodings shared by every peer we send to
+    encoded = {}
     
     # Log the outgoing message
     log_message(MY_ID, destination_id, content, message_type)
     
-    # Get next hop(s) from router
+    # Get the next hop from the router; unicast messages are never flooded
     next_hop = router.get_next_hop(destination_id)
-    
-    # If no specific route, send to all neighbors
-    if isinstance(next_hop, list):
-        if not next_hop:
-            network_logger.warning(f"No neighbors available to send message to {destination_id}")
-            return False
-            
-        network_logger.info(f"No direct route to {destination_id}, flooding to {len(next_hop)} neighbors")
-        success = False
-        
-        # Try bridge nodes first if available
-        bridge_attempts = []
-        regular_attempts = []
-        
-        # Separate bridge nodes from regular nodes
-        for ip in next_hop:
-            for node_id, route in router.get_all_routes().items():
-                if route["next_hop"] == ip and route.get("via_bridge", False):
-                    bridge_attempts.append(ip)
-                    break
-            else:
-                regular_attempts.append(ip)
-        
-        # Log the strategy
-        if bridge_attempts:
-            network_logger.info(f"Trying {len(bridge_attempts)} bridge nodes first: {bridge_attempts}")
-        
-        # First try bridge nodes
-        for ip in bridge_attempts:
-            if send_to_peer(ip, encrypted_data, retry=2):
-                network_logger.info(f"Successfully sent via bridge node {ip}")
-                success = True
-        
-        # If bridge nodes failed or don't exist, try all regular nodes
-        if not success:
-            for ip in regular_attempts:
-                if send_to_peer(ip, encrypted_data):
-                    success = True
-        
-        return success
-    
-    # If we have a specific next hop, send there
-    elif next_hop:
+    if next_hop:
         network_logger.info(f"Sending message to {destination_id} via {next_hop}")
-        return send_to_peer(next_hop, encrypted_data, retry=2)
+        return send_packet(next_hop, packet, retry=2, encoded=encoded)
     
     # If destination is ourselves or no route available
-    else:
-        network_logger.warning(f"No route to {destination_id}")
-        return False
+    network_logger.warning(f"No route to {destination_id}")
+    return False
 
 def broadcast_message(content, message_type="text"):
     """Broadcast a message to all known peers"""
@@ -159,11 +205,8 @@ def broadcast_message(content, message_type="text"):
         "multi_hop": True  # Flag to indicate this is for a multi-hop network
     }
     
-    # Convert to JSON
-    json_data = json.dumps(packet)
-    
-    # Encrypt for transmission
-    encrypted_data = encrypt_data(json_data)
+    # Encodings shared by every peer we send to
+    encoded = {}
     
     # Log the outgoing broadcast
     log_message(MY_ID, "ALL", content, message_type)
@@ -175,194 +218,262 @@ def broadcast_message(content, message_type="text"):
     network_logger.info(f"Broadcasting message to {len(neighbors)} neighbors")
     
     for ip in neighbors:
-        if send_to_peer(ip, encrypted_data, retry=1):
+        if send_packet(ip, packet, retry=1, encoded=encoded):
             success_count += 1
     
     return success_count > 0
 
+def choose_file_next_hops(destination_id):
+    """Pick the next hops a file transfer to a destination should stripe across, preferred first"""
+    return router.get_next_hops(destination_id)[:MULTIPATH_MAX_PATHS]
+
+def choose_file_next_hop(destination_id):
+    """Pick the single next hop a file transfer to a destination should use"""
+    next_hops = choose_file_next_hops(destination_id)
+    return next_hops[0] if next_hops else None
+
+def transfer_file_id(destination_id, file_path):
+    """Stable ID for sending a file to a destination, so a retried transfer resumes"""
+    stat = os.stat(file_path)
+    key = f"{MY_ID}:{destination_id}:{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+def query_have_map(next_hop, destination_id, file_id):
+    """Ask the receiver which chunks of a file it holds, returning its reply or None"""
+    query = {
+        "type": "file_have_query",
+        "file_id": file_id,
+        "src": MY_ID,
+        "dst": destination_id,
+        "ttl": MAX_TTL,
+        "timestamp": time.time(),
+        "multi_hop": True
+    }
+    
+    waiter = expect_have_map(file_id)
+    if not send_packet(next_hop, query, retry=1):
+        wait_have_map(file_id, waiter, 0)
+        return None
+    return wait_have_map(file_id, waiter, HAVE_MAP_TIMEOUT)
+
+def file_info_packet(file_id, destination_id, file_path, chunk_size, chunk_hashes=None):
+    """Build the file_info announcing a file split into chunks of `chunk_size` bytes, with the Merkle root of their hashes if given"""
+    filesize = os.path.getsize(file_path)
+    packet = {
+        "type": "file_info",
+        "id": file_id,
+        "src": MY_ID,
+        "dst": destination_id,
+        "filename": os.path.basename(file_path),
+        "filesize": filesize,
+        "total_chunks": (filesize + chunk_size - 1) // chunk_size,
+        "chunk_size": chunk_size,
+        "ttl": MAX_TTL,
+        "timestamp": time.time(),
+        "multi_hop": True  # Flag to indicate this is for a multi-hop network
+    }
+    if chunk_hashes is not None:
+        packet["merkle_root"] = merkle_root(chunk_hashes).hex()
+    return packet
+
+def send_file_hashes(next_hop, info_packet, chunk_hashes):
+    """Send a file's chunk hashes after its file info, split so no packet outgrows a frame"""
+    for start in range(0, len(chunk_hashes), FILE_HASHES_PER_PACKET):
+        packet = {
+            "type": "file_hashes",
+            "file_id": info_packet["id"],
+            "src": MY_ID,
+            "dst": info_packet["dst"],
+            "start": start,
+            "total_chunks": info_packet["total_chunks"],
+            "chunk_size": info_packet["chunk_size"],
+            "data": pack_hashes(chunk_hashes[start:start + FILE_HASHES_PER_PACKET]),  # Raw bytes like a chunk's data
+            "ttl": MAX_TTL,
+            "timestamp": time.time(),
+            "multi_hop": True
+        }
+        if not send_packet(next_hop, packet, retry=3):
+            return False
+    return True
+
+def resize_chunks(chunk_size, ideal):
+    """Chunk size to use next: the ideal one if it has drifted far enough from the current one"""
+    if max(ideal, chunk_size) >= CHUNK_RESIZE_FACTOR * min(ideal, chunk_size):
+        return ideal
+    return chunk_size
+
 def send_file(destination_id, file_path):
     """Send a file to a destination node by chunking it"""
     if not os.path.exists(file_path):
         network_logger.error(f"File not found: {file_path}")
         return False
     
+    # Derive the file ID from the file, so sending it again resumes where it stopped
+    file_id = transfer_file_id(destination_id, file_path)
+    rate_limit = rate_limiter.open_transfer(file_id)
     try:
-        # Generate a unique file ID
-        file_id = str(uuid.uuid4())
         filename = os.path.basename(file_path)
         filesize = os.path.getsize(file_path)
         
-        # Calculate number of chunks
-        num_chunks = (filesize + CHUNK_SIZE - 1) // CHUNK_SIZE
-        
-        log_file_transfer(filename, MY_ID, destination_id, "STARTED", 
-                         f"Size: {filesize} bytes, Chunks: {num_chunks}")
-        
-        # Get next hop for destination
-        next_hop = router.get_next_hop(destination_id)
+        # Get next hops for destination
+        next_hops = choose_file_next_hops(destination_id)
         
         # If no route, abort
-        if not next_hop or (isinstance(next_hop, list) and not next_hop):
+        if not next_hops:
             network_logger.error(f"No route to {destination_id} for file transfer")
             return False
         
-        # If multiple routes, choose first one for file transfer
-        # Prioritize bridge nodes for multi-hop networks
-        if isinstance(next_hop, list):
-            # Look for bridge nodes
-            bridge_ip = None
-            for ip in next_hop:
-                for node_id, route in router.get_all_routes().items():
-                    if route["next_hop"] == ip and route.get("via_bridge", False):
-                        bridge_ip = ip
-                        break
-                if bridge_ip:
-                    break
-            
-            if bridge_ip:
-                network_logger.info(f"Using bridge node {bridge_ip} for file transfer")
-                next_hop = bridge_ip
-            else:
-                next_hop = next_hop[0] if next_hop else None
+        # Size chunks for what earlier transfers measured on these next hops;
+        # the file info carries the size, so the receiver lays out the file to match
+        chunk_size = choose_chunk_size(next_hops)
+        info_packet = file_info_packet(file_id, destination_id, file_path, chunk_size)
+        num_chunks = info_packet["total_chunks"]
         
-        # First option: Try sending the file directly over a socket (this is faster for one-hop transfers)
-        try:
-            # Check if this is a direct connection (one hop)
-            is_direct_connection = False
-            # Check if destination is a direct neighbor
-            if destination_id in router.routing_table:
-                route = router.routing_table[destination_id]
-                if route["ttl"] == 1:  # TTL of 1 means direct neighbor
-                    is_direct_connection = True
-            
-            if is_direct_connection:
-                network_logger.info(f"Attempting direct file transfer to {destination_id} at {next_hop}")
+        log_file_transfer(filename, MY_ID, destination_id, "STARTED", 
+                         f"Size: {filesize} bytes, Chunks: {num_chunks} of {chunk_size} bytes")
+        
+        # First option: stream the whole file over its own connection. The
+        # stream opens with the file info, so the receiver knows which transfer
+        # the bytes belong to before the first one arrives; to a neighbor this
+        # is the fast one-hop path, further away each relay pipes the stream on.
+        # The stream carries no chunk hashes, so its first byte doesn't wait for
+        # the whole file to be read; a sealed stream is authenticated segment by
+        # segment instead, while a plain one is only saved once the chunked rounds
+        # below have sent its hashes. Whatever doesn't arrive is resent by those rounds
+        route = router.routing_table.get(destination_id)
+        is_direct_connection = route is not None and route["hops"] == 1
+        if is_direct_connection or CUT_THROUGH_TRANSFERS:
+            next_hop = router.get_next_hop(destination_id)
+            if next_hop:
+                try:
+                    network_logger.info(f"Streaming {filename} to {destination_id} through {next_hop}")
+                    if is_direct_connection:
+                        sealed = ENCRYPT_DIRECT_TRANSFERS and USE_ENCRYPTION
+                    else:
+                        sealed = USE_ENCRYPTION  # Relayed bytes stay encrypted end to end, like relayed chunks
+                    
+                    status = stream_flow(next_hop, info_packet, file_path, sealed, rate_limit)
+                    if status == FLOW_COMPLETE:
+                        log_file_transfer(filename, MY_ID, destination_id, "COMPLETED", f"Size: {filesize} bytes")
+                        return True
+                    if status == FLOW_UNVERIFIED:
+                        network_logger.info(f"Stream of {filename} to {destination_id} arrived, sending its chunk hashes")
+                    else:
+                        network_logger.warning(f"Stream of {filename} to {destination_id} arrived incomplete, resuming with chunks")
+                except Exception as e:
+                    network_logger.warning(f"Stream of {filename} to {destination_id} failed, resuming with chunks: {e}")
+        
+        # Hash every chunk before sending chunks; the receiver checks each one
+        # as it lands, along with any the stream left behind, and relays can
+        # drop corrupt ones, so only bad chunks are sent again
+        chunk_hashes = file_chunk_hashes(file_path, chunk_size)
+        info_packet = file_info_packet(file_id, destination_id, file_path, chunk_size, chunk_hashes)
+        
+        # Send the file as chunks in rounds; each round asks the receiver what
+        # it holds and resends only the missing chunks, so a failed chunk, a
+        # route change or a restart on either side doesn't start over
+        with tqdm(total=num_chunks, desc=f"Sending {filename}", unit="chunk") as pbar:
+            all_sent = False
+            requested_chunk_size = None  # Set when a round ended early to switch chunk size
+            hashes_held = False  # Whether the receiver reported it holds our chunk hashes
+            for round_index in range(TRANSFER_MAX_ROUNDS):
+                # Routes may have changed since the last round
+                next_hops = choose_file_next_hops(destination_id)
+                if not next_hops:
+                    network_logger.warning(f"No route to {destination_id}, retrying file transfer")
+                    time.sleep(2)
+                    continue
+                next_hop = next_hops[0]
                 
-                # Send file info first with normal method (to prepare receiver)
-                info_packet = {
-                    "type": "file_info",
-                    "id": file_id,
-                    "src": MY_ID,
-                    "dst": destination_id,
-                    "filename": filename,
-                    "filesize": filesize,
-                    "total_chunks": num_chunks,
-                    "ttl": MAX_TTL,
-                    "timestamp": time.time(),
-                    "multi_hop": True
-                }
+                # Switch chunk size between rounds when the last round's
+                # measurements call for a very different one; the receiver
+                # keeps what it holds, as chunk indexes map to byte offsets
+                if round_index > 0:
+                    new_chunk_size = resize_chunks(chunk_size, requested_chunk_size or choose_chunk_size(next_hops))
+                    if new_chunk_size != chunk_size:
+                        network_logger.info(f"Resending {filename} in {new_chunk_size}-byte chunks instead of {chunk_size}")
+                        chunk_size = new_chunk_size
+                        chunk_hashes = file_chunk_hashes(file_path, chunk_size)
+                        info_packet = file_info_packet(file_id, destination_id, file_path, chunk_size, chunk_hashes)
+                        num_chunks = info_packet["total_chunks"]
+                        pbar.total = num_chunks
+                        hashes_held = False
                 
-                # Convert to JSON and encrypt
-                json_data = json.dumps(info_packet)
-                encrypted_data = encrypt_data(json_data)
+                # Send file info, and the chunk hashes unless the receiver already holds them
+                if not send_packet(next_hop, info_packet, retry=3):
+                    network_logger.warning(f"Failed to send file info to {destination_id}")
+                    continue
+                if not hashes_held and not send_file_hashes(next_hop, info_packet, chunk_hashes):
+                    network_logger.warning(f"Failed to send chunk hashes to {destination_id}")
+                    continue
                 
-                # Send file info to prepare receiver
-                if not send_to_peer(next_hop, encrypted_data, retry=2):
-                    network_logger.error(f"Failed to send file info to {destination_id}")
-                    # Fall back to chunked method later
+                # Find out what the receiver already has
+                have_map = query_have_map(next_hop, destination_id, file_id)
+                if have_map is not None and have_map.get("complete"):
+                    all_sent = True
+                    break
+                if have_map is not None and have_map.get("chunk_size", chunk_size) == chunk_size:
+                    missing = missing_chunks(have_map, num_chunks)
+                    hashes_held = have_map.get("hashes", False)
                 else:
-                    # Wait a brief moment for the receiver to process the file info
-                    time.sleep(0.5)
-                    
-                    # Now send the actual file directly with binary transfer
-                    # This is much faster for large files
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.settimeout(10)  # Longer timeout for file transfer
-                    s.connect((next_hop, PORT))
-                    
-                    # Show progress bar
-                    with open(file_path, "rb") as f, tqdm(total=filesize, desc=f"Sending {filename}", unit="B", unit_scale=True) as pbar:
-                        while True:
-                            chunk = f.read(CHUNK_SIZE)
-                            if not chunk:
-                                break
-                            s.sendall(chunk)
-                            pbar.update(len(chunk))
-                    
-                    s.close()
-                    network_logger.info(f"Direct file transfer completed to {destination_id}")
-                    log_file_transfer(filename, MY_ID, destination_id, "COMPLETED", f"Size: {filesize} bytes")
-                    return True
-        except Exception as e:
-            network_logger.warning(f"Direct file transfer failed, falling back to chunked method: {e}")
-            # Fall back to the chunked method below
-        
-        # Show progress bar
-        with tqdm(total=num_chunks, desc=f"Sending {filename}", unit="chunk") as pbar:
-            # Send file info first
-            info_packet = {
-                "type": "file_info",
-                "id": file_id,
-                "src": MY_ID,
-                "dst": destination_id,
-                "filename": filename,
-                "filesize": filesize,
-                "total_chunks": num_chunks,
-                "ttl": MAX_TTL,
-                "timestamp": time.time(),
-                "multi_hop": True  # Flag to indicate this is for a multi-hop network
-            }
-            
-            # Convert to JSON and encrypt
-            json_data = json.dumps(info_packet)
-            encrypted_data = encrypt_data(json_data)
-            
-            # Send file info
-            if not send_to_peer(next_hop, encrypted_data, retry=3):
-                network_logger.error(f"Failed to send file info to {destination_id}")
-                return False
-            
-            # Send chunks
-            success = True
-            with open(file_path, "rb") as f:
-                for chunk_index in range(num_chunks):
-                    chunk_data = f.read(CHUNK_SIZE)
-                    
-                    # Base64 encode binary data for JSON
-                    encoded_chunk = base64.b64encode(chunk_data).decode('utf-8')
-                    
-                    # Create chunk packet
-                    chunk_packet = {
-                        "type": "file_chunk",
-                        "file_id": file_id,
-                        "src": MY_ID,
-                        "dst": destination_id,
-                        "chunk_index": chunk_index,
-                        "total_chunks": num_chunks,
-                        "data": encoded_chunk,
-                        "ttl": MAX_TTL,
-                        "timestamp": time.time(),
-                        "multi_hop": True  # Flag to indicate this is for a multi-hop network
-                    }
-                    
-                    # Convert to JSON and encrypt
-                    json_data = json.dumps(chunk_packet)
-                    encrypted_data = encrypt_data(json_data)
-                    
-                    # Send chunk with retry
-                    if not send_to_peer(next_hop, encrypted_data, retry=3):
-                        network_logger.error(f"Failed to send chunk {chunk_index} to {destination_id}")
-                        success = False
-                        break
-                    
-                    # Update progress
-                    pbar.update(1)
-                    
-                    # Small delay to avoid overwhelming the network
-                    time.sleep(0.01)
+                    missing = list(range(num_chunks))
+                
+                # Every chunk is there but still waits on the hashes; send them again
+                if not missing:
+                    continue
+                
+                pbar.n = num_chunks - len(missing)
+                pbar.refresh()
+                if round_index > 0:
+                    network_logger.info(f"Resending {len(missing)} missing chunks of {filename} to {destination_id}")
+                
+                # Stream the missing chunks with a sliding window per path, striped
+                # across every usable next hop; acknowledgements pace each path,
+                # so no fixed delay between chunks is needed. The first round may
+                # end early if the paths turn out to want a very different chunk size
+                if len(next_hops) > 1:
+                    network_logger.info(f"Striping {filename} to {destination_id} across {len(next_hops)} paths: {next_hops}")
+                transfer = FileTransfer(
+                    file_id, destination_id, file_path, num_chunks, send_packet,
+                    chunk_size, allow_resize=round_index == 0, rate_limit=rate_limit
+                )
+                all_sent = transfer.run(next_hops, missing, pbar)
+                pbar.update(transfer.acked_count - pbar.n)
+                requested_chunk_size = transfer.resize_to
+                if not all_sent:
+                    continue
+                
+                # Every chunk is acknowledged, but the file only completes once
+                # its hashes are in too; batches handled before the file info
+                # that announced their layout were dropped, so check before stopping
+                have_map = query_have_map(next_hop, destination_id, file_id)
+                if have_map is not None and have_map.get("complete"):
+                    break
+                all_sent = False
+                hashes_held = have_map is not None and have_map.get("hashes", False)
             
-            if success:
+            if all_sent:
                 log_file_transfer(filename, MY_ID, destination_id, "COMPLETED", f"Size: {filesize} bytes")
             else:
-                log_file_transfer(filename, MY_ID, destination_id, "FAILED", "Chunk transfer failed")
+                log_file_transfer(filename, MY_ID, destination_id, "FAILED",
+                                  "Chunk transfer incomplete; sending again will resume")
             
-            return success
+            return all_sent
     except Exception as e:
         network_logger.error(f"Error sending file: {e}")
         return False
+    finally:
+        rate_limiter.close_transfer(file_id)
+
+def forward_next_hop(destination_id, received_from):
+    """Next hop to pass a packet on to: the best route that doesn't lead back where it came from, or None"""
+    for next_hop in router.get_next_hops(destination_id):
+        if next_hop != received_from:
+            return next_hop
+    return None
 
 def forward_packet(packet, received_from):
-    """Forward a packet based on routing information"""
+    """Forward a packet based on routing information, passing its sealed body through"""
     try:
         # Extract packet data
         packet_type = packet.get("type", "")
@@ -394,45 +505,13 @@ def forward_packet(packet, received_from):
             if not router.should_forward_message(message_id, ttl):
                 return False
             
-            # Get next hop
-            next_hop = router.get_next_hop(dest_id)
-            
-            # Don't send back to where it came from
-            if isinstance(next_hop, list):
-                if received_from in next_hop:
-                    next_hop.remove(received_from)
-            elif next_hop == received_from:
-                # Check for alternative routes via bridge nodes
-                bridge_routes = []
-                for bridge_id in router.bridge_nodes:
-                    if bridge_id in router.routing_table:
-                        bridge_route = router.routing_table[bridge_id]
-                        if bridge_route["next_hop"] != received_from:
-                            bridge_routes.append(bridge_route["next_hop"])
-                
-                if bridge_routes:
-                    network_logger.info(f"Using alternative bridge route for {dest_id}: {bridge_routes}")
-                    next_hop = bridge_routes
-                else:
-                    # No alternative route
-                    return False
-            
             # Forward packet
+            next_hop = forward_next_hop(dest_id, received_from)
             if next_hop:
-                json_data = json.dumps(packet)
-                encrypted_data = encrypt_data(json_data)
-                
-                if isinstance(next_hop, list):
-                    success = False
-                    for ip in next_hop:
-                        if send_to_peer(ip, encrypted_data, retry=2):
-                            success = True
-                    return success
-                else:
-                    return send_to_peer(next_hop, encrypted_data, retry=2)
+                return send_packet(next_hop, packet, retry=2, wait=False, limits=(rate_limiter.forward,))
         
-        elif packet_type == "broadcast":
-            # Check if we've seen this broadcast before
+        elif packet_type in ["broadcast", "routing"]:
+            # Check if we've seen this broadcast or routing update before
             message_id = packet.get("id", "")
             if not router.should_forward_message(message_id, ttl):
                 return False
@@ -443,63 +522,25 @@ def forward_packet(packet, received_from):
                 neighbors.remove(received_from)
             
             if neighbors:
-                json_data = json.dumps(packet)
-                encrypted_data = encrypt_data(json_data)
+                encoded = {}
                 
                 success = False
                 for ip in neighbors:
-                    if send_to_peer(ip, encrypted_data):
+                    if send_packet(ip, packet, encoded=encoded, wait=False, limits=(rate_limiter.forward,)):
                         success = True
                 return success
         
-        elif packet_type in ["file_info", "file_chunk"]:
+        elif packet_type in ["file_info", "file_hashes", "file_chunk", "file_have_query", "file_have_map", "file_ack"]:
             dest_id = packet.get("dst", "")
             
             # If we're the destination, don't forward
             if dest_id == MY_ID:
                 return False
             
-            # Get next hop
-            next_hop = router.get_next_hop(dest_id)
-            
-            # Don't send back to where it came from
-            if isinstance(next_hop, list):
-                if received_from in next_hop:
-                    next_hop.remove(received_from)
-                
-                # For file transfers, pick the best node (prioritize bridge nodes)
-                bridge_ip = None
-                for ip in next_hop:
-                    for node_id, route in router.get_all_routes().items():
-                        if route["next_hop"] == ip and route.get("via_bridge", False):
-                            bridge_ip = ip
-                            break
-                    if bridge_ip:
-                        break
-                
-                if bridge_ip:
-                    next_hop = bridge_ip
-                elif next_hop:
-                    next_hop = next_hop[0]  # Pick first for file transfers
-                else:
-                    return False
-            elif next_hop == received_from:
-                # Check for alternative routes via bridge nodes
-                for bridge_id in router.bridge_nodes:
-                    if bridge_id in router.routing_table:
-                        bridge_route = router.routing_table[bridge_id]
-                        if bridge_route["next_hop"] != received_from:
-                            next_hop = bridge_route["next_hop"]
-                            break
-                else:
-                    # No alternative route
-                    return False
-            
             # Forward packet
+            next_hop = forward_next_hop(dest_id, received_from)
             if next_hop:
-                json_data = json.dumps(packet)
-                encrypted_data = encrypt_data(json_data)
-                return send_to_peer(next_hop, encrypted_data, retry=3)
+                return send_packet(next_hop, packet, retry=3, wait=False, limits=(rate_limiter.forward,))
         
         return False
         
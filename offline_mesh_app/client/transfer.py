@@ -0,0 +1,463 @@
+import time
+import base64
+import threading
+from collections import OrderedDict, deque
+from config import (
+    MY_ID, MAX_TTL, CHUNK_SIZE, TRANSFER_REORDER_THRESHOLD, TRANSFER_STALL_TIMEOUT, MULTIPATH_PATH_FAIL_TIMEOUTS,
+    CHUNK_RESIZE_FACTOR, CHUNK_SIZING_MIN_SAMPLES
+)
+from client.congestion import CongestionController, path_chunk_size, record_link
+from utils.logger import network_logger
+
+# Windowed transfers in progress, keyed by file ID, so acknowledgements can find them
+active_transfers = {}  # {file_id: FileTransfer}
+active_transfers_lock = threading.Lock()
+
+# Senders waiting for a receiver's have-map, keyed by file ID
+have_map_waiters = {}  # {file_id: {"event": Event, "reply": packet}}
+have_map_lock = threading.Lock()
+
+
+def get_transfer_stats():
+    """Get stats for each active transfer, keyed by file ID"""
+    with active_transfers_lock:
+        transfers = list(active_transfers.items())
+    return {file_id: transfer.get_stats() for file_id, transfer in transfers}
+
+
+def expect_have_map(file_id):
+    """Register interest in the next have-map for a file; call before sending the query"""
+    with have_map_lock:
+        waiter = {"event": threading.Event(), "reply": None}
+        have_map_waiters[file_id] = waiter
+        return waiter
+
+def wait_have_map(file_id, waiter, timeout):
+    """Wait for a have-map reply, returning the packet or None on timeout"""
+    try:
+        waiter["event"].wait(timeout)
+        return waiter["reply"]
+    finally:
+        with have_map_lock:
+            if have_map_waiters.get(file_id) is waiter:
+                del have_map_waiters[file_id]
+
+def deliver_have_map(packet):
+    """Hand a received have-map to the sender waiting for it"""
+    file_id = packet.get("file_id")
+    with have_map_lock:
+        waiter = have_map_waiters.get(file_id)
+    
+    if waiter is None:
+        network_logger.debug(f"Ignoring unexpected have-map for {file_id}")
+        return
+    
+    waiter["reply"] = packet
+    waiter["event"].set()
+
+def missing_chunks(have_map, total_chunks):
+    """List the chunk indexes a have-map reports as missing"""
+    bitmap = have_map.get("data", b"")
+    if isinstance(bitmap, str):
+        bitmap = base64.b64decode(bitmap)
+    
+    missing = []
+    for chunk_index in range(total_chunks):
+        byte_index, bit = divmod(chunk_index, 8)
+        if byte_index >= len(bitmap) or not bitmap[byte_index] & (1 << bit):
+            missing.append(chunk_index)
+    return missing
+
+
+def deliver_file_ack(packet):
+    """Hand a received acknowledgement to its transfer"""
+    file_id = packet.get("file_id")
+    with active_transfers_lock:
+        transfer = active_transfers.get(file_id)
+    
+    if transfer is None:
+        network_logger.debug(f"Ignoring acknowledgement for inactive transfer {file_id}")
+        return
+    
+    transfer.on_ack(packet)
+
+
+class TransferPath:
+    """One next hop a transfer stripes chunks over, with its own congestion window"""
+    def __init__(self, ip, chunk_size):
+        self.ip = ip
+        self.cc = CongestionController(chunk_size)
+        self.in_flight = OrderedDict()  # {chunk_index: (send time, path sequence)}, oldest first
+        self.next_seq = 0  # Order chunks were sent on this path, for loss detection
+        self.highest_acked_seq = -1
+        self.next_send_at = 0.0
+        self.consecutive_timeouts = 0
+        self.alive = True
+        
+        # Counters
+        self.chunks_sent = 0
+        self.chunks_acked = 0
+        self.chunks_lost = 0  # Chunks resent after a gap or timeout
+    
+    def get_stats(self):
+        """Get this path's share of the transfer and its controller's figures"""
+        stats = self.cc.get_stats()
+        stats.update({
+            "alive": self.alive,
+            "in_flight": len(self.in_flight),
+            "chunks_sent": self.chunks_sent,
+            "chunks_acked": self.chunks_acked,
+            "chunks_lost": self.chunks_lost
+        })
+        return stats
+
+
+class FileTransfer:
+    """Sliding-window sender for the chunks of one file, striped over one or more next hops"""
+    def __init__(self, file_id, destination_id, file_path, total_chunks, send_packet, chunk_size=CHUNK_SIZE, allow_resize=False, rate_limit=None):
+        self.file_id = file_id
+        self.destination_id = destination_id
+        self.file_path = file_path
+        self.total_chunks = total_chunks
+        self.chunk_size = chunk_size
+        self.send_packet = send_packet
+        self.rate_limit = rate_limit  # Token bucket shared by every path, if the transfer is capped
+        self.cond = threading.Condition()
+        
+        # Chunk size the paths' measurements call for, if the round ended early to switch to it
+        self.allow_resize = allow_resize
+        self.resize_to = None
+        
+        # Chunk state
+        self.acked = bytearray((total_chunks + 7) // 8)
+        self.acked_count = 0
+        self.pending = deque()  # Chunk indexes waiting to be sent or resent
+        self.in_flight = {}  # {chunk_index: TransferPath it was last sent on}
+        self.sent_before = set()  # Chunks sent at least once
+        self.resent = set()  # Chunks sent more than once; their acks give no RTT sample
+        self.fast_resent = set()  # Chunks already resent early; further losses wait for the timeout
+        self.complete = False
+        self.succeeded = False
+        self.ended = False
+        
+        # Paths, each with its own window, RTT and pacing. Every path has a sender
+        # thread pulling from the shared queue, so it is handed chunks as fast as
+        # it gets them acknowledged, in proportion to its measured throughput
+        self.paths = {}  # {next hop ip: TransferPath}
+        self.last_progress = time.time()
+        self.progress = None
+        
+        # Counters
+        self.chunks_sent = 0
+        self.retransmits = 0
+        self.failed_paths = 0
+    
+    def _is_acked(self, chunk_index):
+        return self.acked[chunk_index // 8] & (1 << (chunk_index % 8))
+    
+    def _mark_acked(self, chunk_index, now):
+        """Record a chunk as acknowledged, returning the path it was in flight on and its RTT sample if it has a clean one"""
+        if self._is_acked(chunk_index):
+            return None, None
+        self.acked[chunk_index // 8] |= 1 << (chunk_index % 8)
+        self.acked_count += 1
+        
+        path = self.in_flight.pop(chunk_index, None)
+        if path is None:
+            return None, None
+        sent_at, seq = path.in_flight.pop(chunk_index)
+        path.chunks_acked += 1
+        path.highest_acked_seq = max(path.highest_acked_seq, seq)
+        if chunk_index in self.resent:
+            return path, None  # Karn's rule: ambiguous after a resend
+        return path, now - sent_at
+    
+    def on_ack(self, packet):
+        """Apply a cumulative/selective acknowledgement from the receiver"""
+        with self.cond:
+            if packet.get("complete"):
+                self.complete = True
+                self.cond.notify_all()
+                return
+            
+            # Left over from before the receiver switched to this round's chunk size
+            if packet.get("chunk_size", self.chunk_size) != self.chunk_size:
+                return
+            
+            now = time.time()
+            newly_acked = {}  # {TransferPath: chunks}
+            rtt_samples = {}  # {TransferPath: latest sample}
+            
+            # Everything below the cumulative point, then each selective range
+            ranges = [(0, packet.get("ack", 0))] + [tuple(r) for r in packet.get("sack", []) if len(r) == 2]
+            for start, end in ranges:
+                for chunk_index in range(max(0, start), min(end, self.total_chunks)):
+                    if self._is_acked(chunk_index):
+                        continue
+                    path, sample = self._mark_acked(chunk_index, now)
+                    self.last_progress = now
+                    if path is None:
+                        continue
+                    newly_acked[path] = newly_acked.get(path, 0) + 1
+                    if sample is not None:
+                        rtt_samples[path] = sample
+            
+            for path, sample in rtt_samples.items():
+                path.cc.on_rtt_sample(sample)
+            
+            for path, count in newly_acked.items():
+                path.consecutive_timeouts = 0
+                path.cc.on_ack(count)
+                
+                # Chunks sent on this path well before ones that were just acknowledged
+                # were probably lost; resend them now rather than waiting for the timeout.
+                # Comparing send order per path keeps a slower path from looking lossy.
+                # A small window never has enough chunks behind a gap, so it needs fewer
+                threshold = min(TRANSFER_REORDER_THRESHOLD, max(1, path.cc.window() - 1))
+                lost = False
+                for chunk_index, (_, seq) in list(path.in_flight.items()):
+                    if seq + threshold > path.highest_acked_seq:
+                        break
+                    if chunk_index in self.fast_resent:
+                        continue
+                    del path.in_flight[chunk_index]
+                    del self.in_flight[chunk_index]
+                    self.fast_resent.add(chunk_index)
+                    self.pending.appendleft(chunk_index)
+                    path.chunks_lost += 1
+                    lost = True
+                if lost:
+                    path.cc.on_loss()
+                
+                self._check_chunk_size(path)
+            
+            self._update_progress()
+            self.cond.notify_all()
+    
+    def _requeue(self, path):
+        """Move a path's outstanding chunks back to the front of the queue for any path to send"""
+        for chunk_index in reversed(path.in_flight):
+            del self.in_flight[chunk_index]
+            self.pending.appendleft(chunk_index)
+        path.in_flight.clear()
+    
+    def _fail_path(self, path, reason):
+        """Stop using a path and hand its outstanding chunks to the surviving ones"""
+        if not path.alive:
+            return
+        path.alive = False
+        self.failed_paths += 1
+        self._requeue(path)
+        survivors = sum(1 for other in self.paths.values() if other.alive)
+        network_logger.warning(f"Dropping path {path.ip} from transfer {self.file_id} ({reason}); {survivors} paths left")
+        self.cond.notify_all()
+    
+    def _check_timeouts(self, path, now):
+        """Queue chunks whose acknowledgement is overdue on a path for resending"""
+        timed_out = False
+        while path.in_flight:
+            chunk_index, (sent_at, _) = next(iter(path.in_flight.items()))
+            if now - sent_at < path.cc.rto:
+                break
+            del path.in_flight[chunk_index]
+            del self.in_flight[chunk_index]
+            self.pending.appendleft(chunk_index)
+            path.chunks_lost += 1
+            timed_out = True
+        
+        if timed_out:
+            # Back off; the path is slower or lossier than we assumed
+            path.cc.on_timeout()
+            path.consecutive_timeouts += 1
+            
+            # A path that keeps timing out while others deliver is a dead end
+            others_alive = any(other.alive for other in self.paths.values() if other is not path)
+            if others_alive and path.consecutive_timeouts >= MULTIPATH_PATH_FAIL_TIMEOUTS:
+                self._fail_path(path, f"{path.consecutive_timeouts} timeouts in a row")
+    
+    def _check_chunk_size(self, path):
+        """End the round early if a path's measurements call for a very different chunk size; call with the lock held"""
+        if not self.allow_resize or self.resize_to is not None:
+            return
+        ideal = path_chunk_size(path.cc, path.chunks_sent, path.chunks_lost)
+        if ideal is None or max(ideal, self.chunk_size) < CHUNK_RESIZE_FACTOR * min(ideal, self.chunk_size):
+            return
+        
+        # Switching costs a round trip and a recheck at the receiver; not worth it near the end
+        remaining = (self.total_chunks - self.acked_count) * self.chunk_size
+        if remaining < CHUNK_SIZING_MIN_SAMPLES * max(ideal, self.chunk_size):
+            return
+        
+        network_logger.info(f"Transfer {self.file_id} switching from {self.chunk_size}-byte to {ideal}-byte chunks after measuring {path.ip}")
+        self.resize_to = ideal
+        self.ended = True
+        self.cond.notify_all()
+    
+    def _next_chunk(self, path):
+        """Wait until a path may send a chunk and return its index and whether to ask for an immediate acknowledgement, or None once the transfer or path has ended"""
+        with self.cond:
+            while True:
+                if self.complete or self.acked_count == self.total_chunks:
+                    self.succeeded = True
+                    self.cond.notify_all()
+                    return None
+                if self.ended or not path.alive:
+                    return None
+                
+                now = time.time()
+                self._check_timeouts(path, now)
+                if not path.alive:
+                    return None
+                if now - self.last_progress > TRANSFER_STALL_TIMEOUT:
+                    network_logger.warning(f"Transfer {self.file_id} stalled with {self.acked_count}/{self.total_chunks} chunks acknowledged")
+                    self.ended = True
+                    self.cond.notify_all()
+                    return None
+                
+                # Send while the window has room, spaced out so a whole window
+                # doesn't land in a relay's queue at once
+                window_open = self.pending and len(path.in_flight) < path.cc.window()
+                if window_open and now >= path.next_send_at:
+                    while self.pending:
+                        chunk_index = self.pending.popleft()
+                        if self._is_acked(chunk_index) or chunk_index in self.in_flight:
+                            continue
+                        if chunk_index in self.sent_before:
+                            self.retransmits += 1
+                            self.resent.add(chunk_index)
+                        path.in_flight[chunk_index] = (now, path.next_seq)
+                        path.next_seq += 1
+                        self.in_flight[chunk_index] = path
+                        path.next_send_at = now + path.cc.pacing_interval()
+                        
+                        # The receiver acknowledges in-order chunks in batches; when
+                        # this chunk fills the window or empties the queue, nothing
+                        # may follow to complete the batch, so ask for it now
+                        ack_now = len(path.in_flight) >= path.cc.window() or not self.pending
+                        return chunk_index, ack_now
+                    continue
+                
+                # Wait for the pacing gap, an acknowledgement or the oldest chunk's timeout
+                timeout = path.cc.rto
+                if path.in_flight:
+                    oldest_sent, _ = next(iter(path.in_flight.values()))
+                    timeout = max(0.01, oldest_sent + path.cc.rto - now)
+                if window_open:
+                    timeout = min(timeout, path.next_send_at - now)
+                self.cond.wait(timeout)
+    
+    def _update_progress(self):
+        """Move the progress bar to the acknowledged count; call with the lock held"""
+        if self.progress is not None:
+            self.progress.update(self.acked_count - self.progress.n)
+    
+    def get_stats(self):
+        """Get progress plus each path's window, rate and RTT"""
+        with self.cond:
+            paths = {ip: path.get_stats() for ip, path in self.paths.items()}
+            return {
+                "destination": self.destination_id,
+                "chunk_size": self.chunk_size,
+                "acked_chunks": self.acked_count,
+                "total_chunks": self.total_chunks,
+                "in_flight": len(self.in_flight),
+                "chunks_sent": self.chunks_sent,
+                "retransmits": self.retransmits,
+                "failed_paths": self.failed_paths,
+                "rate_bps": sum(stats["rate_bps"] for stats in paths.values() if stats["alive"]),
+                "throttled_bytes": self.rate_limit.get_stats()["throttled_bytes"] if self.rate_limit is not None else 0,
+                "paths": paths
+            }
+    
+    def _chunk_packet(self, chunk_index, chunk_data, ack_now=False):
+        """Build the packet for one chunk"""
+        packet = {
+            "type": "file_chunk",
+            "file_id": self.file_id,
+            "src": MY_ID,
+            "dst": self.destination_id,
+            "chunk_index": chunk_index,
+            "total_chunks": self.total_chunks,
+            "chunk_size": self.chunk_size,  # Chunks of an earlier round's size are dropped after a switch
+            "data": chunk_data,  # Raw bytes; base64-encoded only for JSON peers
+            "ttl": MAX_TTL,
+            "timestamp": time.time(),
+            "multi_hop": True  # Flag to indicate this is for a multi-hop network
+        }
+        if ack_now:
+            packet["ack_now"] = True
+        return packet
+    
+    def _send_over(self, path):
+        """Sender loop for one path; runs until the transfer ends or the path fails"""
+        try:
+            with open(self.file_path, "rb") as f:
+                while True:
+                    # Wait for the transfer's bandwidth cap before taking a chunk,
+                    # so the time spent waiting doesn't count towards its RTT
+                    if self.rate_limit is not None:
+                        self.rate_limit.consume(self.chunk_size)
+                    next_chunk = self._next_chunk(path)
+                    if next_chunk is None:
+                        return
+                    chunk_index, ack_now = next_chunk
+                    
+                    f.seek(chunk_index * self.chunk_size)
+                    chunk_data = f.read(self.chunk_size)
+                    
+                    if not self.send_packet(path.ip, self._chunk_packet(chunk_index, chunk_data, ack_now), retry=3):
+                        network_logger.warning(f"Failed to send chunk {chunk_index} to {self.destination_id} via {path.ip}")
+                        with self.cond:
+                            self._fail_path(path, "send failed")
+                        return
+                    
+                    with self.cond:
+                        self.sent_before.add(chunk_index)
+                        self.chunks_sent += 1
+                        path.chunks_sent += 1
+        except Exception as e:
+            network_logger.error(f"Error sending chunks via {path.ip}: {e}")
+            with self.cond:
+                self._fail_path(path, str(e))
+    
+    def run(self, next_hops, chunks, progress=None):
+        """Send the given chunks through one or more next hops until all are acknowledged; False if the round failed"""
+        if isinstance(next_hops, str):
+            next_hops = [next_hops]
+        
+        with self.cond:
+            # Chunks the receiver already holds count as acknowledged
+            wanted = set(chunks)
+            for chunk_index in range(self.total_chunks):
+                if chunk_index not in wanted:
+                    self._mark_acked(chunk_index, 0)
+            self.pending.extend(chunks)
+            self.last_progress = time.time()
+            self.progress = progress
+            for ip in next_hops:
+                self.paths[ip] = TransferPath(ip, self.chunk_size)
+        
+        with active_transfers_lock:
+            active_transfers[self.file_id] = self
+        
+        try:
+            senders = [
+                threading.Thread(target=self._send_over, args=(path,), daemon=True)
+                for path in self.paths.values()
+            ]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+            
+            with self.cond:
+                self._update_progress()
+                
+                # Size the next transfer's chunks over these next hops from what this one saw
+                for path in self.paths.values():
+                    record_link(path.ip, path.cc, path.chunks_sent, path.chunks_lost)
+                return self.succeeded
+        finally:
+            with active_transfers_lock:
+                if active_transfers.get(self.file_id) is self:
+                    del active_transfers[self.file_id]
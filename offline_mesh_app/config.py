@@ -6,9 +6,39 @@ import json
 # Network settings
 PORT = 5000
 BUFFER_SIZE = 4096
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Largest packet frame accepted from a peer
+WIRE_CODEC = "binary"  # Preferred packet encoding ("binary" or "json"); peers without it get JSON
+COMPRESSION = "zlib"  # Body compression for peers that support it ("zlib", "lzma" or None)
+COMPRESSION_MIN_SIZE = 256  # Bodies smaller than this are never compressed
+COMPRESSION_SAMPLE_SIZE = 1024  # Bytes test-compressed to decide whether a flow is compressible
+COMPRESSION_MIN_SAVING = 0.1  # Fraction a body must shrink by to be sent compressed
+COMPRESSION_RECHECK_INTERVAL = 64  # Packets between compressibility samples on a flow
+COMPRESSION_STATS_FLOWS = 32  # Flows whose compression stats are kept
 BROADCAST_INTERVAL = 10  # seconds
 DISCOVERY_INTERVAL = 30  # seconds
 
+# Server settings
+SERVER_MODE = "threaded"  # "threaded" (thread per connection) or "asyncio" (single event loop)
+SERVER_IDLE_TIMEOUT = 60  # Seconds an incoming connection may sit idle between frames
+STREAM_WORKERS = 4  # Threads the asyncio server decrypts and writes incoming file streams on
+
+# Ingress settings (packets waiting to be decrypted and handled)
+INGRESS_WORKERS = 4  # Worker threads handling received packets
+INGRESS_QUEUE_SIZE = 256  # Packets allowed to wait for a worker
+INGRESS_OVERLOAD_POLICY = "drop_oldest_routing"  # "drop_oldest_routing" or "block"; user traffic is never dropped
+
+# Connection pool settings
+POOL_IDLE_TIMEOUT = 30  # Seconds before an unused outgoing connection is closed
+EGRESS_NOTSENT_LOWAT = 64 * 1024  # Unsent bytes the kernel may buffer per connection; the rest waits in priority order
+EGRESS_PRIORITY_BURST = 16  # Higher-priority frames sent to a peer in a row before a waiting lower-priority one gets a turn
+EGRESS_QUEUE_MAX_BYTES = 16 * 1024 * 1024  # Bytes of forwarded packets and replies one class may queue for a peer; more are dropped
+
+# Bandwidth limits, in bytes per second (0 for unlimited); adjustable at runtime from the Settings tab
+TRANSFER_RATE_LIMIT = 0  # Each outgoing file transfer
+PEER_RATE_LIMIT = 0  # Everything sent to one neighbor
+FORWARD_RATE_LIMIT = 0  # Everything this node relays for others
+RATE_LIMIT_BURST = 256 * 1024  # Bytes a limit lets through at once after a quiet spell
+
 # Gateway node settings
 IS_HOTSPOT_HOST = False  # Set to True if this device is hosting a hotspot
 GATEWAY_BROADCAST_INTERVAL = 20  # seconds
@@ -40,7 +70,11 @@ MY_IP = get_best_ip()
 KNOWN_PEERS = []  # Will be populated through discovery
 
 # File transfer settings
-CHUNK_SIZE = 8192
+CHUNK_SIZE = 8192  # Chunk size for links no transfer has measured yet
+MIN_CHUNK_SIZE = 1024  # Smallest chunk adaptive sizing picks, for lossy links
+MAX_CHUNK_SIZE = 256 * 1024  # Largest chunk adaptive sizing picks, for fast clean links
+DIRECT_SEGMENT_SIZE = 1024 * 1024  # Bytes per sendfile call or sealed segment on direct transfers
+ENCRYPT_DIRECT_TRANSFERS = False  # Seal direct one-hop file streams; raw streams can use zero-copy sendfile
 DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "MeshDownloads")
 if not os.path.exists(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR)
@@ -48,15 +82,50 @@ if not os.path.exists(DOWNLOAD_DIR):
 # Routing settings
 MAX_TTL = 3  # Maximum number of hops for a message
 ROUTING_TIMEOUT = 60  # Seconds before route is considered stale
+HSLS_SLOT = BROADCAST_INTERVAL  # Seconds between routing updates; each reaches 2 hops, every 2nd 4 hops, every 4th 8 hops and so on
+HSLS_LEVELS = max(1, (MAX_TTL - 1).bit_length())  # Update scopes (2, 4, ... 2^levels hops); the widest covers every node within MAX_TTL
+HSLS_EXPIRY_FACTOR = 3  # Refresh intervals a link state outlives before it is dropped
+HSLS_TRIGGER_HOLDDOWN = 1.0  # Seconds a link change waits to gather others into one triggered update
+ROUTING_SNAPSHOT_SLOTS = 1 << HSLS_LEVELS  # Slots between updates carrying all our links rather than the changes, repairing missed deltas
+LINK_PROBE_INTERVAL = 2  # Seconds between probes to each neighbor
+LINK_PROBE_TIMEOUT = 3  # Seconds a probe waits for its reply before it counts as lost
+LINK_PROBE_WINDOW = 20  # Latest probes a link's loss and ETX are measured over
+LINK_PROBE_MIN_SAMPLES = 5  # Probes a link needs before its measurements set its cost
+LINK_RTT_UNIT = 0.05  # Seconds of round trip a link takes before its cost rises above its ETX
+LINK_MAX_COST = 20.0  # Cost of a link that answered none of the probes in its window
+LINK_COST_HYSTERESIS = 0.25  # Fraction a link's measured cost must move by before it is advertised
+ROUTE_SWITCH_HYSTERESIS = 0.2  # Fraction cheaper another next hop must be before a route moves to it
 
 # Encryption settings
 USE_ENCRYPTION = True
 AES_KEY = b'ThisIsA16ByteKey'  # 16-byte key for AES
-AES_MODE = 'CBC'
+AES_MODE = 'GCM'  # Authenticated; tampered or foreign packets are rejected
 
 # Cache settings
 MESSAGE_CACHE_SIZE = 100
-FILE_CACHE_SIZE = 5  # Number of files to cache
+FILE_CACHE_SIZE = 64  # Most incomplete incoming files held open at once
+FILE_CACHE_MAX_BYTES = 8 * 1024 ** 3  # Disk reserved by incomplete incoming files before the oldest is evicted
+FILE_CACHE_PERSIST_INTERVAL = 1.0  # Seconds between saves of a partial file's chunk bitmap
+HAVE_MAP_TIMEOUT = 3  # Seconds to wait for a receiver to report which chunks it holds
+TRANSFER_MAX_ROUNDS = 5  # Times a chunked transfer resends missing chunks before giving up
+TRANSFER_INITIAL_WINDOW = 4  # Chunks in flight when a transfer starts
+TRANSFER_MAX_WINDOW = 64  # Most chunks in flight on one transfer
+TRANSFER_REORDER_THRESHOLD = 8  # Chunks acknowledged past a gap before it is resent early
+TRANSFER_STALL_TIMEOUT = 15  # Seconds without acknowledgement progress before a round is abandoned
+FILE_ACK_EVERY = 4  # Chunks received in order between acknowledgements
+CC_TARGET_QUEUE_DELAY = 0.1  # Seconds of queueing above the path's minimum RTT before bulk flows back off
+MULTIPATH_MAX_PATHS = 3  # Most next hops one chunked transfer stripes across
+MULTIPATH_PATH_FAIL_TIMEOUTS = 3  # Timeouts in a row before a path is dropped from a multipath transfer
+FILE_HASHES_PER_PACKET = 8192  # Chunk hashes per file_hashes packet (256 KB), so any file's hashes fit well under MAX_FRAME_SIZE
+RELAY_VERIFY_CHUNKS = False  # Relays decrypt file chunk bodies and check their hashes before forwarding; costs a decryption per chunk on every relay, while the destination checks them anyway
+RELAY_HASH_CACHE_SIZE = 16  # Files whose chunk hashes a relay remembers
+CUT_THROUGH_TRANSFERS = True  # Stream multi-hop files through relays that pipe the bytes on, before falling back to chunks
+FLOW_BUFFER_SIZE = 256 * 1024  # Bytes a relay holds per cut-through flow
+FLOW_STATUS_TIMEOUT = 30  # Seconds to wait for the destination to confirm a flow stream
+CHUNK_OVERHEAD_BYTES = 1024  # Per-chunk cost (headers, acknowledgements, syscalls) weighed against resending big chunks
+CHUNKS_PER_RTT = 8  # Chunks a path should have in flight per round trip at its measured rate
+CHUNK_SIZING_MIN_SAMPLES = 32  # Chunks a path must send before its measurements size chunks
+CHUNK_RESIZE_FACTOR = 4  # How far the ideal chunk size must drift before a transfer switches to it
 
 # Save configuration
 def save_config():
@@ -9,7 +9,12 @@ import socket
 from client.sender import send_message, send_file, broadcast_message
 from config import MY_ID, MY_IP, KNOWN_PEERS, save_config, IS_HOTSPOT_HOST, PORT
 from routing.router import router
-from routing.cache import file_cache
+from routing.cache import file_cache, chunk_hash_cache
+from server.dispatcher import ingress_dispatcher
+from client.connection_pool import connection_pool
+from client.rate_limit import rate_limiter
+from client.transfer import get_transfer_stats
+from utils.compression import flow_compressor
 from utils.logger import get_message_history, gui_logger
 from client.gateway_discovery import start_gateway_service
 
@@ -29,17 +34,20 @@ class MeshNetworkApp:
         self.routing_tab = ttk.Frame(self.notebook)
         self.files_tab = ttk.Frame(self.notebook)
         self.settings_tab = ttk.Frame(self.notebook)
+        self.statistics_tab = ttk.Frame(self.notebook)
         
         self.notebook.add(self.messages_tab, text="Messages")
         self.notebook.add(self.routing_tab, text="Routing")
         self.notebook.add(self.files_tab, text="Files")
         self.notebook.add(self.settings_tab, text="Settings")
+        self.notebook.add(self.statistics_tab, text="Statistics")
         
         # Set up each tab
         self.setup_messages_tab()
         self.setup_routing_tab()
         self.setup_files_tab()
         self.setup_settings_tab()
+        self.setup_statistics_tab()
         
         # Status bar
         self.status_var = tk.StringVar()
@@ -108,20 +116,20 @@ class MeshNetworkApp:
         top_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         
         # Create Treeview widget
-        columns = ("node_id", "next_hop", "ttl", "age", "node_type")
+        columns = ("node_id", "next_hop", "hops", "age", "node_type")
         self.routing_tree = ttk.Treeview(top_frame, columns=columns, show="headings")
         
         # Define headings
         self.routing_tree.heading("node_id", text="Node ID")
         self.routing_tree.heading("next_hop", text="Next Hop")
-        self.routing_tree.heading("ttl", text="TTL")
+        self.routing_tree.heading("hops", text="Hops")
         self.routing_tree.heading("age", text="Age (s)")
         self.routing_tree.heading("node_type", text="Node Type")
         
         # Define columns
         self.routing_tree.column("node_id", width=150)
         self.routing_tree.column("next_hop", width=150)
-        self.routing_tree.column("ttl", width=50)
+        self.routing_tree.column("hops", width=50)
         self.routing_tree.column("age", width=70)
         self.routing_tree.column("node_type", width=100)
         
@@ -254,6 +262,21 @@ Restart the application for changes to take effect."""
         ttk.Entry(peer_entry_frame, textvariable=self.peer_ip_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         ttk.Button(peer_entry_frame, text="Add Peer", command=self.add_peer).pack(side=tk.LEFT, padx=5)
         
+        # Bandwidth limits
+        limits_frame = ttk.LabelFrame(self.settings_tab, text="Bandwidth Limits (KB/s, 0 for unlimited)")
+        limits_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        limits_entry_frame = ttk.Frame(limits_frame)
+        limits_entry_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        limits = rate_limiter.get_limits()
+        self.limit_vars = {}
+        for key, label in (("transfer_rate", "Per transfer:"), ("peer_rate", "Per neighbor:"), ("forward_rate", "Forwarded:")):
+            ttk.Label(limits_entry_frame, text=label).pack(side=tk.LEFT, padx=5)
+            self.limit_vars[key] = tk.StringVar(value=str(limits[key] // 1024))
+            ttk.Entry(limits_entry_frame, textvariable=self.limit_vars[key], width=8).pack(side=tk.LEFT, padx=5)
+        ttk.Button(limits_entry_frame, text="Apply", command=self.apply_rate_limits).pack(side=tk.LEFT, padx=5)
+        
         # Network discovery
         discovery_frame = ttk.LabelFrame(self.settings_tab, text="Network Discovery")
         discovery_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -268,7 +291,32 @@ Restart the application for changes to take effect."""
         button_frame.pack(padx=10, pady=10)
         
         ttk.Button(button_frame, text="Save Configuration", command=self.save_config).pack(side=tk.LEFT, padx=5)
-
+    
+    def setup_statistics_tab(self):
+        """Set up the node statistics tab"""
+        stats_frame = ttk.LabelFrame(self.statistics_tab, text="Node Statistics")
+        stats_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        # Create Treeview widget
+        columns = ("section", "metric", "value")
+        self.stats_tree = ttk.Treeview(stats_frame, columns=columns, show="headings")
+        
+        # Define headings
+        self.stats_tree.heading("section", text="Section")
+        self.stats_tree.heading("metric", text="Metric")
+        self.stats_tree.heading("value", text="Value")
+        
+        # Define columns
+        self.stats_tree.column("section", width=150)
+        self.stats_tree.column("metric", width=200)
+        self.stats_tree.column("value", width=250)
+        
+        # Add scrollbar
+        scrollbar = ttk.Scrollbar(stats_frame, orient=tk.VERTICAL, command=self.stats_tree.yview)
+        self.stats_tree.configure(yscroll=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.stats_tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+    
     def setup_periodic_updates(self):
         """Set up periodic updates for the UI"""
         # Start a thread to update the UI
@@ -284,6 +332,7 @@ Restart the application for changes to take effect."""
                 self.update_peer_list()
                 self.update_routing_table()
                 self.update_file_transfers()
+                self.update_statistics()
                 self.update_status_bar()
             except Exception as e:
                 gui_logger.error(f"Error updating UI: {e}")
@@ -375,7 +424,7 @@ Restart the application for changes to take effect."""
             self.routing_tree.insert("", tk.END, values=(
                 node_id,
                 route["next_hop"],
-                route["ttl"],
+                route["hops"],
                 route["age"],
                 node_type_str
             ))
@@ -424,7 +473,94 @@ Restart the application for changes to take effect."""
             
         except Exception as e:
             gui_logger.error(f"Error updating file transfers: {e}")
-
+    
+    def collect_statistics(self):
+        """Collect (section, metric, value) rows for the statistics tab"""
+        rows = []
+        
+        # Ingress queue and worker pool
+        ingress = ingress_dispatcher.get_stats()
+        rows.append(("Ingress", "Workers / queue size", f"{ingress['workers']} / {ingress['queue_size']}"))
+        rows.append(("Ingress", "Overload policy", ingress["policy"]))
+        rows.append(("Ingress", "Queue depth (max)", f"{ingress['depth']} ({ingress['max_depth']})"))
+        rows.append(("Ingress", "Wait avg / max", f"{ingress['avg_wait_ms']:.1f} ms / {ingress['max_wait_ms']:.1f} ms"))
+        rows.append(("Ingress", "Processed / blocked", f"{ingress['processed']} / {ingress['blocked']}"))
+        for class_name, count in ingress["enqueued"].items():
+            rows.append(("Ingress", f"{class_name} queued / dropped", f"{count} / {ingress['dropped'][class_name]}"))
+        
+        # Outgoing frames waiting for each neighbor, by traffic class
+        egress = connection_pool.get_stats()
+        for class_name, class_stats in egress["total"].items():
+            if class_name == "promoted":
+                continue
+            rows.append(("Egress", f"{class_name} queued (max) / sent / dropped", f"{class_stats['depth']} ({class_stats['max_depth']}) / {class_stats['sent']} / {class_stats['dropped']}"))
+            rows.append(("Egress", f"{class_name} wait avg / max", f"{class_stats['avg_wait_ms']:.1f} ms / {class_stats['max_wait_ms']:.1f} ms"))
+        rows.append(("Egress", "Sent past higher priority", egress["total"]["promoted"]))
+        for ip, peer_stats in egress["peers"].items():
+            depths = " / ".join(str(peer_stats[name]["depth"]) for name in ("control", "interactive", "bulk"))
+            rows.append(("Egress", f"{ip} queued control / interactive / bulk", depths))
+        
+        # Traffic held back by the bandwidth limits
+        limits = rate_limiter.get_stats()
+        for label, limit_stats in (("Per transfer", limits["transfer"]), ("Forwarded", limits["forward"])):
+            rate = f"{limit_stats['rate_bps'] // 1024} KB/s" if limit_stats["rate_bps"] else "unlimited"
+            rows.append(("Bandwidth", f"{label} limit", rate))
+            rows.append(("Bandwidth", f"{label} throttled / sent", f"{limit_stats['throttled_bytes'] / 1024:.0f} KB / {limit_stats['passed_bytes'] / 1024:.0f} KB ({limit_stats['throttled_time']:.1f} s waited)"))
+        for ip, limit_stats in limits["peers"].items():
+            rows.append(("Bandwidth", f"{ip} throttled / sent", f"{limit_stats['throttled_bytes'] / 1024:.0f} KB / {limit_stats['passed_bytes'] / 1024:.0f} KB ({limit_stats['throttled_time']:.1f} s waited)"))
+        
+        # Topology the routes are computed from
+        routing = router.get_stats()
+        rows.append(("Routing", "Nodes / links / neighbors", f"{routing['nodes']} / {routing['links']} / {routing['neighbors']}"))
+        rows.append(("Routing", "Routes", routing["routes"]))
+        rows.append(("Routing", "Route computations (last)", f"{routing['computations']} ({routing['last_computation_ms']:.1f} ms)"))
+        updates = routing["updates_sent"]
+        rows.append(("Routing", "Updates sent (snapshot / delta / unchanged)", f"{updates['snapshot']} / {updates['delta']} / {updates['refresh']}"))
+        rows.append(("Routing", "Updates missed (awaiting snapshot)", routing["missed_updates"]))
+        
+        # Measured quality of each link, and the cost routes use for it
+        for node_id, link in router.get_link_quality().items():
+            rtt = f"{link['rtt_ms']:.1f} ms" if link["rtt_ms"] is not None else "unmeasured"
+            rows.append(("Links", f"{node_id} ({link['ip']}) RTT / loss", f"{rtt} / {link['loss'] * 100:.0f}% over {link['samples']} probes"))
+            rows.append(("Links", f"{node_id} ETX / cost", f"{link['etx']:.2f} / {link['cost']:.1f}"))
+        
+        # Chunks rejected by hash checks here and on the way through
+        relay_hashes = chunk_hash_cache.get_stats()
+        rows.append(("Integrity", "Corrupt chunks rejected", file_cache.corrupt_chunks))
+        rows.append(("Integrity", "Relayed chunks checked / dropped", f"{relay_hashes['checked']} / {relay_hashes['dropped']}"))
+        
+        # Bytes saved by compressing packet bodies, per file or packet type
+        for flow, flow_stats in flow_compressor.get_stats().items():
+            saved = flow_stats["saved_bytes"] / flow_stats["raw_bytes"] * 100 if flow_stats["raw_bytes"] else 0.0
+            rows.append(("Compression", f"{flow[:8]} bytes in / out", f"{flow_stats['raw_bytes']} / {flow_stats['wire_bytes']} ({saved:.0f}% saved)"))
+            rows.append(("Compression", f"{flow[:8]} compressed / skipped", f"{flow_stats['compressed']} / {flow_stats['skipped']}"))
+        
+        # Congestion-controlled file transfers in progress
+        for file_id, transfer in get_transfer_stats().items():
+            section = f"Transfer {file_id[:8]} to {transfer['destination']}"
+            rows.append((section, "Acked / total chunks", f"{transfer['acked_chunks']} / {transfer['total_chunks']}"))
+            rows.append((section, "Chunk size", f"{transfer['chunk_size'] // 1024} KB"))
+            rows.append((section, "Rate", f"{transfer['rate_bps'] / 1024:.1f} KB/s"))
+            rows.append((section, "Retransmits / failed paths", f"{transfer['retransmits']} / {transfer['failed_paths']}"))
+            rows.append((section, "Throttled", f"{transfer['throttled_bytes'] / 1024:.0f} KB"))
+            for ip, path in transfer["paths"].items():
+                label = f"Path {ip}" if path["alive"] else f"Path {ip} (failed)"
+                rows.append((section, f"{label} rate / goodput", f"{path['rate_bps'] / 1024:.1f} KB/s / {path['goodput_bps'] / 1024:.1f} KB/s"))
+                rows.append((section, f"{label} window (ssthresh) / in flight", f"{path['cwnd']:.1f} ({path['ssthresh']:.1f}) / {path['in_flight']}"))
+                rows.append((section, f"{label} RTT smoothed / min", f"{path['srtt_ms']:.1f} ms / {path['min_rtt_ms']:.1f} ms"))
+                rows.append((section, f"{label} losses / timeouts / delay backoffs", f"{path['losses']} / {path['timeouts']} / {path['delay_backoffs']}"))
+        
+        return rows
+    
+    def update_statistics(self):
+        """Update the statistics display"""
+        # Clear the statistics tree
+        for item in self.stats_tree.get_children():
+            self.stats_tree.delete(item)
+        
+        for row in self.collect_statistics():
+            self.stats_tree.insert("", tk.END, values=row)
+    
     def update_status_bar(self):
         """Update the status bar with current information"""
         gateway_status = "Gateway: ✓" if IS_HOTSPOT_HOST else ""
@@ -485,10 +621,6 @@ Restart the application for changes to take effect."""
             # Update progress bar
             self.progress_var.set(0)
             
-            # Get the total file size
-            file_size = os.path.getsize(file_path)
-            chunk_size = self.calculate_chunk_count(file_size)
-            
             # Start a separate thread to update the progress bar while the transfer is ongoing
             stop_progress_update = threading.Event()
             
@@ -522,12 +654,7 @@ Restart the application for changes to take effect."""
             gui_logger.error(f"Error in file transfer: {e}")
             self.show_error(f"File transfer error: {e}")
             self.progress_var.set(0)
-            
-    def calculate_chunk_count(self, file_size):
-        """Calculate the number of chunks for a file"""
-        from config import CHUNK_SIZE
-        return (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-
+    
     def open_downloads(self):
         """Open the downloads folder"""
         try:
@@ -558,7 +685,8 @@ Restart the application for changes to take effect."""
     def force_routing_update(self):
         """Force a routing update"""
         from client.broadcast import broadcast_routing_update
-        threading.Thread(target=broadcast_routing_update, daemon=True).start()
+        from routing.hsls import WIDEST_SCOPE
+        threading.Thread(target=broadcast_routing_update, args=(WIDEST_SCOPE, True), daemon=True).start()
         self.add_routing_log("Forced routing update sent")
 
     def clear_routing_log(self):
@@ -613,7 +741,7 @@ Restart the application for changes to take effect."""
                     
                     # Trigger a routing update
                     from client.broadcast import broadcast_routing_update
-                    threading.Thread(target=broadcast_routing_update, daemon=True).start()
+                    threading.Thread(target=broadcast_routing_update, kwargs={"snapshot": True}, daemon=True).start()
                 else:
                     self.show_info(f"Peer {peer_ip} already in list")
             else:
@@ -623,6 +751,21 @@ Restart the application for changes to take effect."""
             self.show_error(f"Error connecting to peer: {e}")
             self.add_routing_log(f"Connection error: {e}")
 
+    def apply_rate_limits(self):
+        """Apply the bandwidth limits entered in the settings tab"""
+        try:
+            limits = {key: int(float(var.get() or 0) * 1024) for key, var in self.limit_vars.items()}
+        except ValueError:
+            self.show_error("Bandwidth limits must be numbers")
+            return
+        if any(rate < 0 for rate in limits.values()):
+            self.show_error("Bandwidth limits can't be negative")
+            return
+        
+        rate_limiter.set_limits(**limits)
+        self.add_routing_log(f"Bandwidth limits set: per transfer {limits['transfer_rate'] // 1024} KB/s, "
+                             f"per neighbor {limits['peer_rate'] // 1024} KB/s, forwarded {limits['forward_rate'] // 1024} KB/s")
+
     def run_discovery(self):
         """Run network discovery"""
         from client.broadcast import discover_peers
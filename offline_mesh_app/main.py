@@ -12,6 +12,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from server.listener import start_server
 from client.broadcast import broadcast_routing, periodic_discovery
 from client.gateway_discovery import start_gateway_service
+from client.link_probe import probe_links
 from gui.app import run_app
 from utils.logger import network_logger, routing_logger
 from config import MY_ID, MY_IP, PORT, IS_HOTSPOT_HOST
@@ -93,6 +94,11 @@ def main():
         routing_thread = Thread(target=broadcast_routing, daemon=True)
         routing_thread.start()
 
+        # Start link quality probing
+        routing_logger.info("Starting link probing...")
+        probe_thread = Thread(target=probe_links, daemon=True)
+        probe_thread.start()
+        
         # Start periodic peer discovery
         network_logger.info("Starting peer discovery...")
         discovery_thread = Thread(target=periodic_discovery, daemon=True)
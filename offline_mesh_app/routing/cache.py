@@ -3,9 +3,14 @@ import time
 import json
 import threading
 import base64
+import hashlib
 from collections import OrderedDict
-from config import MESSAGE_CACHE_SIZE, FILE_CACHE_SIZE, DOWNLOAD_DIR
+from config import (
+    MESSAGE_CACHE_SIZE, FILE_CACHE_SIZE, FILE_CACHE_MAX_BYTES, FILE_CACHE_PERSIST_INTERVAL,
+    FILE_ACK_EVERY, DOWNLOAD_DIR, CHUNK_SIZE, RELAY_HASH_CACHE_SIZE
+)
 from utils.logger import log_routing
+from utils.merkle import chunk_hash, verify_chunk, PartialHashes, IntegrityError, HASH_SIZE
 
 class MessageCache:
     def __init__(self, max_size=MESSAGE_CACHE_SIZE):
@@ -64,76 +69,558 @@ class MessageCache:
 
 
 class FileCache:
-    def __init__(self, max_size=FILE_CACHE_SIZE):
-        self.cache = OrderedDict()  # {file_id: {"chunks": {chunk_index: data}, "total_chunks": total, "filename": name, "timestamp": time}}
+    """Incomplete incoming transfers, written straight into sparse files on disk"""
+    def __init__(self, max_size=FILE_CACHE_SIZE, max_bytes=FILE_CACHE_MAX_BYTES):
+        # {file_id: {"fd": fd, "path": part path, "bitmap": bytearray, "received": count,
+        #            "total_chunks": total, "chunk_size": size, "size": bytes, "filename": name,
+        #            "timestamp": time, "persisted_at": time,
+        #            "next_expected": first missing chunk, "last_received": chunk index,
+        #            "unacked": count, "ack_due": bool,
+        #            "hashes": packed chunk hashes or None, "corrupt": count,
+        #            "pending_hashes": PartialHashes still arriving, or None,
+        #            "needs_hashes": bool, "seen_hashes": leaf hashes of the chunks an unverified stream wrote, or None}}
+        self.cache = OrderedDict()
+        self.completed = OrderedDict()  # {file_id: output path} of recently finished files
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.reserved_bytes = 0  # Sum of the expected sizes of all cached files
+        self.corrupt_chunks = 0  # Chunks rejected because they didn't match their hash
         self.lock = threading.RLock()
         
         # Create cache directory if it doesn't exist
         self.cache_dir = os.path.join(DOWNLOAD_DIR, "cache")
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
+        
+        # Pick up transfers interrupted by a restart
+        self._load_persisted()
+    
+    def _part_path(self, file_id):
+        """Path of the partial file for a file ID, safe for any ID a peer sends"""
+        digest = hashlib.sha256(str(file_id).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{digest}.part")
+    
+    def _meta_path(self, part_path):
+        """Path of the sidecar recording which chunks a partial file holds"""
+        return part_path[:-len(".part")] + ".json"
+    
+    def _hashes_path(self, part_path):
+        """Path of the sidecar holding a partial file's chunk hashes"""
+        return part_path[:-len(".part")] + ".hashes"
+    
+    def _persist(self, file_id, entry, force=False):
+        """Save an entry's bitmap and metadata, at most once per FILE_CACHE_PERSIST_INTERVAL"""
+        now = time.time()
+        if not force and now - entry["persisted_at"] < FILE_CACHE_PERSIST_INTERVAL:
+            return
+        entry["persisted_at"] = now
+        
+        # Flush the chunks first so the bitmap never claims data that isn't on disk
+        os.fsync(entry["fd"])
+        
+        meta = {
+            "file_id": file_id,
+            "filename": entry["filename"],
+            "total_chunks": entry["total_chunks"],
+            "chunk_size": entry["chunk_size"],
+            "size": entry["size"],
+            "timestamp": entry["timestamp"],
+            "bitmap": base64.b64encode(entry["bitmap"]).decode('utf-8'),
+            "needs_hashes": entry["needs_hashes"]
+        }
+        meta_path = self._meta_path(entry["path"])
+        temp_path = meta_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, meta_path)
+    
+    def _load_persisted(self):
+        """Reopen partial files recorded by an earlier run"""
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            part_path = meta_path[:-len(".json")] + ".part"
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                bitmap = bytearray(base64.b64decode(meta["bitmap"]))
+                hashes = None
+                hashes_path = self._hashes_path(part_path)
+                if os.path.exists(hashes_path):
+                    with open(hashes_path, "rb") as f:
+                        hashes = f.read()
+                fd = os.open(part_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+            except Exception as e:
+                log_routing(name, "CACHE_LOAD_ERROR", str(e))
+                for path in (meta_path, part_path, self._hashes_path(part_path)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                continue
+            
+            self.cache[meta["file_id"]] = {
+                "fd": fd,
+                "path": part_path,
+                "bitmap": bitmap,
+                "received": sum(bin(byte).count("1") for byte in bitmap),
+                "total_chunks": meta["total_chunks"],
+                "chunk_size": meta["chunk_size"],
+                "size": meta["size"],
+                "filename": meta["filename"],
+                "timestamp": meta["timestamp"],
+                "persisted_at": time.time(),
+                "next_expected": 0,
+                "last_received": None,
+                "unacked": 0,
+                "ack_due": False,
+                "hashes": hashes,
+                "corrupt": 0,
+                "pending_hashes": None,
+                "needs_hashes": meta.get("needs_hashes", False),
+                "seen_hashes": None
+            }
+            self._advance_next_expected(self.cache[meta["file_id"]])
+            self.reserved_bytes += meta["size"]
+        
+        # Oldest first, so eviction order survives the restart
+        for file_id in sorted(self.cache, key=lambda file_id: self.cache[file_id]["timestamp"]):
+            self.cache.move_to_end(file_id)
     
-    def add_file_chunk(self, file_id, chunk_index, chunk_data, total_chunks, filename):
-        """Add a file chunk to the cache"""
+    def _get_or_create(self, file_id, total_chunks, filename, chunk_size, filesize=None):
+        """Get the entry for a file, allocating its sparse partial file on first use"""
+        entry = self.cache.get(file_id)
+        if entry is not None:
+            if entry["total_chunks"] == total_chunks and entry["chunk_size"] == chunk_size:
+                return entry
+            # The sender switched chunk size; the partial file is laid out by
+            # byte offset, so what we hold still lines up with the new chunks
+            if filesize is not None and filesize == entry["size"]:
+                self._rechunk(file_id, entry, total_chunks, chunk_size)
+                return entry
+            # The file itself changed; what we hold no longer lines up
+            self._discard(file_id)
+        
+        # Reserve the full size up front; the file stays sparse until chunks land
+        size = filesize if filesize is not None else total_chunks * chunk_size
+        path = self._part_path(file_id)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        os.ftruncate(fd, size)
+        
+        entry = {
+            "fd": fd,
+            "path": path,
+            "bitmap": bytearray((total_chunks + 7) // 8),
+            "received": 0,
+            "total_chunks": total_chunks,
+            "chunk_size": chunk_size,
+            "size": size,
+            "filename": filename,
+            "timestamp": time.time(),
+            "persisted_at": 0,
+            "next_expected": 0,
+            "last_received": None,
+            "unacked": 0,
+            "ack_due": False,
+            "hashes": None,
+            "corrupt": 0,
+            "pending_hashes": None,
+            "needs_hashes": False,
+            "seen_hashes": None
+        }
+        self.cache[file_id] = entry
+        self.reserved_bytes += size
+        
+        # Evict the oldest transfers while over the count or byte budget
+        while len(self.cache) > 1 and (len(self.cache) > self.max_size or self.reserved_bytes > self.max_bytes):
+            oldest_id = next(iter(self.cache))
+            log_routing(oldest_id, "FILE_EVICTED", "File cache budget exceeded")
+            self._discard(oldest_id)
+        
+        return entry
+    
+    def _rechunk(self, file_id, entry, total_chunks, chunk_size):
+        """Switch an entry to a new chunk size, keeping every new chunk whose bytes we already hold"""
+        old_bitmap = entry["bitmap"]
+        old_size = entry["chunk_size"]
+        bitmap = bytearray((total_chunks + 7) // 8)
+        received = 0
+        for chunk_index in range(total_chunks):
+            start = chunk_index * chunk_size
+            end = min(start + chunk_size, entry["size"])
+            first, last = start // old_size, max(start, end - 1) // old_size
+            if all(old_bitmap[i // 8] & (1 << (i % 8)) for i in range(first, last + 1)):
+                bitmap[chunk_index // 8] |= 1 << (chunk_index % 8)
+                received += 1
+        
+        entry.update({
+            "bitmap": bitmap,
+            "received": received,
+            "total_chunks": total_chunks,
+            "chunk_size": chunk_size,
+            "next_expected": 0,
+            "last_received": None,
+            "unacked": 0,
+            "hashes": None,  # The old hashes cover the old chunks; the file info brings new ones
+            "pending_hashes": None,
+            "seen_hashes": None
+        })
+        hashes_path = self._hashes_path(entry["path"])
+        if os.path.exists(hashes_path):
+            os.remove(hashes_path)
+        self._advance_next_expected(entry)
+        log_routing(file_id, "FILE_RECHUNKED", f"{old_size} -> {chunk_size} bytes per chunk, {received}/{total_chunks} chunks held")
+    
+    def register_file(self, file_id, filename, total_chunks, filesize, chunk_size=CHUNK_SIZE, root=None, needs_hashes=False):
+        """Prepare for an incoming file announced by a file_info packet, collecting its chunk hashes if it has a Merkle root; with needs_hashes, the file can't complete until a root and hashes follow"""
         with self.lock:
-            # If this is a new file, initialize its entry
-            if file_id not in self.cache:
-                self.cache[file_id] = {
-                    "chunks": {},
-                    "total_chunks": total_chunks,
-                    "filename": filename,
-                    "timestamp": time.time()
-                }
-                self.cache.move_to_end(file_id)
-                
-                # Remove oldest if exceeding max size
-                if len(self.cache) > self.max_size:
-                    oldest = self.cache.popitem(last=False)
-                    # Also clean up the file if it exists
-                    self._cleanup_file(oldest[0])
+            # A repeated announcement of a file we already finished
+            if file_id in self.completed:
+                return
+            
+            entry = self._get_or_create(file_id, total_chunks, filename, chunk_size, filesize)
+            entry["filename"] = filename
+            
+            # Trim the reservation to the exact size now that it is known
+            if entry["size"] != filesize:
+                os.ftruncate(entry["fd"], filesize)
+                self.reserved_bytes += filesize - entry["size"]
+                entry["size"] = filesize
+            
+            # The hashes follow in file_hashes packets; until they are all in
+            # and match the root, chunks are kept but the file isn't complete
+            if root is not None and total_chunks and entry["hashes"] is None:
+                pending = entry["pending_hashes"]
+                if pending is None or (pending.total_chunks, pending.root) != (total_chunks, root):
+                    entry["pending_hashes"] = PartialHashes(total_chunks, root)
+            
+            # Unauthenticated bytes with nothing to check them against yet; remember
+            # what they hash to, so checking them later needn't read them back
+            elif needs_hashes and total_chunks and entry["hashes"] is None and not entry["needs_hashes"]:
+                entry["needs_hashes"] = True
+                entry["seen_hashes"] = bytearray()
+            
+            self._persist(file_id, entry, force=True)
+    
+    def add_file_hashes(self, file_id, start, data, total_chunks, chunk_size):
+        """Take a batch of a file's chunk hashes, returning True once they are all in and the file is complete"""
+        with self.lock:
+            entry = self.cache.get(file_id)
+            if entry is None or (entry["total_chunks"], entry["chunk_size"]) != (total_chunks, chunk_size):
+                return False
+            pending = entry["pending_hashes"]
+            if pending is None:
+                return False
+            
+            try:
+                hashes = pending.add(start, data)
+            except IntegrityError as e:
+                log_routing(file_id, "HASHES_CORRUPT", str(e))
+                return False
+            if hashes is None:
+                return False
+            
+            entry["pending_hashes"] = None
+            self._set_hashes(file_id, entry, hashes)
+            self._persist(file_id, entry, force=True)
+            return self.is_file_complete(file_id)
+    
+    def _set_hashes(self, file_id, entry, hashes):
+        """Start verifying a file's chunks, rechecking any that arrived before its hashes"""
+        hashes_path = self._hashes_path(entry["path"])
+        temp_path = hashes_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(hashes)
+        os.replace(temp_path, hashes_path)
+        entry["hashes"] = hashes
+        seen = entry["seen_hashes"] or b''
+        entry["needs_hashes"] = False
+        entry["seen_hashes"] = None
+        
+        bitmap = entry["bitmap"]
+        for chunk_index in range(entry["total_chunks"]):
+            if not bitmap[chunk_index // 8] & (1 << (chunk_index % 8)):
+                continue
+            start = chunk_index * HASH_SIZE
+            if start < len(seen):
+                matches = seen[start:start + HASH_SIZE] == hashes[start:start + HASH_SIZE]
+            else:
+                matches = verify_chunk(hashes, chunk_index, self.get_file_chunk(file_id, chunk_index))
+            if not matches:
+                self._reject_chunk(file_id, entry, chunk_index)
+                bitmap[chunk_index // 8] &= ~(1 << (chunk_index % 8))
+                entry["received"] -= 1
+                entry["next_expected"] = min(entry["next_expected"], chunk_index)
+    
+    def _reject_chunk(self, file_id, entry, chunk_index):
+        """Count a chunk that failed verification; it stays missing, so only it is sent again"""
+        entry["corrupt"] += 1
+        self.corrupt_chunks += 1
+        entry["ack_due"] = True
+        log_routing(file_id, "CHUNK_CORRUPT", f"Chunk {chunk_index} doesn't match its hash")
+    
+    def get_have_map(self, file_id):
+        """Get which chunks of a file we hold, for a sender resuming a transfer"""
+        with self.lock:
+            if file_id in self.completed:
+                return {"complete": True}
+            entry = self.cache.get(file_id)
+            if entry is None:
+                return None
+            return {
+                "complete": False,
+                "total_chunks": entry["total_chunks"],
+                "chunk_size": entry["chunk_size"],
+                "bitmap": bytes(entry["bitmap"]),
+                "hashes": entry["pending_hashes"] is None and not entry["needs_hashes"]  # False while we still wait for chunk hashes
+            }
+    
+    def add_file_chunk(self, file_id, chunk_index, chunk_data, total_chunks, filename, chunk_size=CHUNK_SIZE, ack_now=False):
+        """Write a file chunk into its partial file, returning True once the file is complete"""
+        with self.lock:
+            # A late duplicate of a file we already finished
+            if file_id in self.completed:
+                return False
+            
+            # Sent before the sender switched chunk size; the file info that
+            # announced the switch set the layout, so it can't be placed
+            entry = self.cache.get(file_id)
+            if entry is not None and (entry["total_chunks"], entry["chunk_size"]) != (total_chunks, chunk_size):
+                return False
+            
+            entry = self._get_or_create(file_id, total_chunks, filename, chunk_size)
             
             # Update the timestamp
-            self.cache[file_id]["timestamp"] = time.time()
+            entry["timestamp"] = time.time()
             self.cache.move_to_end(file_id)
             
-            # Add the chunk
-            self.cache[file_id]["chunks"][chunk_index] = chunk_data
+            if not 0 <= chunk_index < entry["total_chunks"] or len(chunk_data) > entry["chunk_size"]:
+                raise ValueError(f"Chunk {chunk_index} out of range for file {file_id}")
+            
+            # Duplicates (retransmissions, multiple paths) are already on disk,
+            # but the sender may have missed our acknowledgement, so repeat it
+            byte_index, bit = divmod(chunk_index, 8)
+            entry["last_received"] = chunk_index
+            if entry["bitmap"][byte_index] & (1 << bit):
+                entry["ack_due"] = True
+                return self.is_file_complete(file_id)
+            
+            # Check the chunk against the hash tree before it touches the disk
+            if entry["hashes"] is not None and not verify_chunk(entry["hashes"], chunk_index, chunk_data):
+                self._reject_chunk(file_id, entry, chunk_index)
+                return False
+            
+            offset = chunk_index * entry["chunk_size"]
+            if hasattr(os, "pwrite"):
+                os.pwrite(entry["fd"], chunk_data, offset)
+            else:
+                os.lseek(entry["fd"], offset, os.SEEK_SET)
+                os.write(entry["fd"], chunk_data)
+            
+            # The last chunk fixes the exact file size
+            if chunk_index == entry["total_chunks"] - 1:
+                size = offset + len(chunk_data)
+                if size != entry["size"]:
+                    os.ftruncate(entry["fd"], size)
+                    self.reserved_bytes += size - entry["size"]
+                    entry["size"] = size
+            
+            entry["bitmap"][byte_index] |= 1 << bit
+            entry["received"] += 1
+            self._persist(file_id, entry)
+            
+            # Acknowledge every few in-order chunks, and at once when there is
+            # a gap so the sender can resend the missing chunk early
+            entry["unacked"] += 1
+            if chunk_index != entry["next_expected"] or chunk_index == entry["total_chunks"] - 1:
+                entry["ack_due"] = True
+            self._advance_next_expected(entry)
+            if entry["unacked"] >= FILE_ACK_EVERY or ack_now:
+                entry["ack_due"] = True
             
             # Check if file is complete
             return self.is_file_complete(file_id)
     
-    def get_file_chunk(self, file_id, chunk_index):
-        """Get a file chunk from the cache"""
+    def add_file_span(self, file_id, first_chunk, data):
+        """Write a run of whole chunks from a stream in one go, returning True once the file is complete"""
+        with self.lock:
+            entry = self.cache.get(file_id)
+            if entry is None:
+                return False
+            chunk_size = entry["chunk_size"]
+            count = (len(data) + chunk_size - 1) // chunk_size
+            if first_chunk < 0 or first_chunk + count > entry["total_chunks"]:
+                raise ValueError(f"Chunks {first_chunk} to {first_chunk + count} out of range for file {file_id}")
+            if len(data) % chunk_size and first_chunk + count != entry["total_chunks"]:
+                raise ValueError(f"Span of {len(data)} bytes ends mid-chunk in file {file_id}")
+            hashes = entry["hashes"]
+            needs_hashes = entry["needs_hashes"]
+        
+        # Check the whole span before taking the lock again; only a file that
+        # already has its hashes from an earlier round can be checked here,
+        # and one still waiting for them has the span's hashes kept instead
+        view = memoryview(data)
+        bad = set()
+        seen = None
+        if hashes is not None:
+            bad = {i for i in range(count) if not verify_chunk(hashes, first_chunk + i, view[i * chunk_size:(i + 1) * chunk_size])}
+        elif needs_hashes:
+            seen = b''.join(chunk_hash(view[i * chunk_size:(i + 1) * chunk_size]) for i in range(count))
+        
+        with self.lock:
+            if self.cache.get(file_id) is not entry:
+                return False
+            entry["timestamp"] = time.time()
+            self.cache.move_to_end(file_id)
+            
+            # Streams write from the first chunk on; one that starts over replaces what the last one saw
+            if seen is not None and entry["seen_hashes"] is not None and first_chunk * HASH_SIZE <= len(entry["seen_hashes"]):
+                entry["seen_hashes"][first_chunk * HASH_SIZE:] = seen
+            
+            # One write for the span, or one per run of good chunks around bad ones
+            runs = []
+            for i in range(count):
+                if i in bad:
+                    continue
+                if runs and runs[-1][1] == i:
+                    runs[-1][1] = i + 1
+                else:
+                    runs.append([i, i + 1])
+            for start, end in runs:
+                offset = (first_chunk + start) * chunk_size
+                span = view[start * chunk_size:end * chunk_size]
+                if hasattr(os, "pwrite"):
+                    os.pwrite(entry["fd"], span, offset)
+                else:
+                    os.lseek(entry["fd"], offset, os.SEEK_SET)
+                    os.write(entry["fd"], span)
+            
+            bitmap = entry["bitmap"]
+            for i in range(count):
+                if i in bad:
+                    self._reject_chunk(file_id, entry, first_chunk + i)
+                    continue
+                byte_index, bit = divmod(first_chunk + i, 8)
+                if not bitmap[byte_index] & (1 << bit):
+                    bitmap[byte_index] |= 1 << bit
+                    entry["received"] += 1
+            
+            self._persist(file_id, entry)
+            self._advance_next_expected(entry)
+            return self.is_file_complete(file_id)
+    
+    def _advance_next_expected(self, entry):
+        """Move an entry's cumulative acknowledgement point past the chunks it holds"""
+        bitmap = entry["bitmap"]
+        index = entry["next_expected"]
+        while index < entry["total_chunks"] and bitmap[index // 8] & (1 << (index % 8)):
+            index += 1
+        entry["next_expected"] = index
+    
+    def take_ack(self, file_id, max_ranges=8):
+        """Get the acknowledgement to send for a file if one is due, or None"""
         with self.lock:
-            if file_id in self.cache and chunk_index in self.cache[file_id]["chunks"]:
-                self.cache.move_to_end(file_id)  # Mark as recently used
-                return self.cache[file_id]["chunks"][chunk_index]
+            if file_id in self.completed:
+                return {"complete": True}
+            
+            entry = self.cache.get(file_id)
+            if entry is None or not entry["ack_due"]:
+                return None
+            entry["ack_due"] = False
+            entry["unacked"] = 0
+            
+            # Cumulative point plus ranges [start, end) received beyond it. The
+            # range holding the latest chunk goes first, as in TCP SACK, so a
+            # sender striping over several paths hears about each path's newest
+            # chunks even when the other paths leave more holes than fit
+            bitmap = entry["bitmap"]
+            total = entry["total_chunks"]
+            latest = self._run_around(bitmap, total, entry["last_received"], entry["next_expected"])
+            ranges = [latest] if latest else []
+            start = None
+            index = entry["next_expected"]
+            while index < total and len(ranges) < max_ranges:
+                # Skip whole bytes that don't change the current run
+                if index % 8 == 0:
+                    byte = bitmap[index // 8]
+                    if (byte == 0xFF and start is not None) or (byte == 0 and start is None):
+                        index += 8
+                        continue
+                
+                held = bitmap[index // 8] & (1 << (index % 8))
+                if held and start is None:
+                    start = index
+                elif not held and start is not None:
+                    if [start, index] != latest:
+                        ranges.append([start, index])
+                    start = None
+                index += 1
+            if start is not None and len(ranges) < max_ranges and [start, total] != latest:
+                ranges.append([start, total])
+            
+            return {"complete": False, "ack": entry["next_expected"], "sack": ranges, "chunk_size": entry["chunk_size"]}
+    
+    def _run_around(self, bitmap, total, index, floor):
+        """Find the run [start, end) of held chunks containing a chunk above the cumulative point, or None"""
+        if index is None or index <= floor or index >= total:
             return None
+        if not bitmap[index // 8] & (1 << (index % 8)):
+            return None
+        
+        start = index
+        while start > floor and bitmap[(start - 1) // 8] & (1 << ((start - 1) % 8)):
+            start -= 1
+        end = index + 1
+        while end < total and bitmap[end // 8] & (1 << (end % 8)):
+            end += 1
+        return [start, end]
+    
+    def get_file_chunk(self, file_id, chunk_index):
+        """Read a received file chunk back from disk"""
+        with self.lock:
+            entry = self.cache.get(file_id)
+            if entry is None or not 0 <= chunk_index < entry["total_chunks"]:
+                return None
+            if not entry["bitmap"][chunk_index // 8] & (1 << (chunk_index % 8)):
+                return None
+            
+            self.cache.move_to_end(file_id)  # Mark as recently used
+            offset = chunk_index * entry["chunk_size"]
+            length = min(entry["chunk_size"], entry["size"] - offset)
+            if hasattr(os, "pread"):
+                return os.pread(entry["fd"], length, offset)
+            os.lseek(entry["fd"], offset, os.SEEK_SET)
+            return os.read(entry["fd"], length)
     
     def is_file_complete(self, file_id):
-        """Check if all chunks of a file have been received"""
+        """Check if all chunks of a file have been received and checked against its hashes"""
         with self.lock:
             if file_id not in self.cache:
                 return False
             
-            file_data = self.cache[file_id]
-            return len(file_data["chunks"]) == file_data["total_chunks"]
+            entry = self.cache[file_id]
+            return entry["received"] == entry["total_chunks"] and entry["pending_hashes"] is None and not entry["needs_hashes"]
+    
+    def awaits_hashes(self, file_id):
+        """Check if a file holds every chunk and is only waiting for its hashes"""
+        with self.lock:
+            entry = self.cache.get(file_id)
+            if entry is None:
+                return False
+            return entry["received"] == entry["total_chunks"] and (entry["pending_hashes"] is not None or entry["needs_hashes"])
     
     def save_complete_file(self, file_id):
-        """Save a complete file to disk"""
+        """Move a complete file into the downloads directory"""
         with self.lock:
             if not self.is_file_complete(file_id):
                 return None
             
-            file_data = self.cache[file_id]
-            filename = file_data["filename"]
+            entry = self.cache[file_id]
+            filename = entry["filename"]
             
             # Create a safe filename (avoid path traversal)
             safe_filename = os.path.basename(filename)
             
             # Add a timestamp to avoid overwriting existing files
-            import time
             timestamp = int(time.time())
             name_parts = os.path.splitext(safe_filename)
             new_filename = f"{name_parts[0]}_{timestamp}{name_parts[1]}"
@@ -145,27 +632,25 @@ class FileCache:
             output_path = os.path.join(DOWNLOAD_DIR, new_filename)
             
             try:
-                # Combine chunks in order
-                with open(output_path, "wb") as f:
-                    for i in range(file_data["total_chunks"]):
-                        if i not in file_data["chunks"]:
-                            raise ValueError(f"Missing chunk {i} when saving file {filename}")
-                        
-                        chunk = file_data["chunks"][i]
-                        # If chunk is base64 encoded string, decode it
-                        if isinstance(chunk, str):
-                            try:
-                                chunk = base64.b64decode(chunk)
-                            except:
-                                # If decoding fails, try using it as-is
-                                chunk = chunk.encode() if isinstance(chunk, str) else chunk
-                        f.write(chunk)
+                # Flush the data, then publish it with an atomic rename; the
+                # cache directory is inside DOWNLOAD_DIR, so it's the same filesystem
+                os.fsync(entry["fd"])
+                os.close(entry["fd"])
+                entry["fd"] = None
+                os.replace(entry["path"], output_path)
+                os.remove(self._meta_path(entry["path"]))
+                if entry["hashes"] is not None:
+                    os.remove(self._hashes_path(entry["path"]))
                 
                 # Log success
                 log_routing(file_id, "FILE_SAVED", f"Saved to {output_path}")
                 
-                # Remove from cache (no longer needed)
+                # Remove from cache (no longer needed), remembering it for have-map queries
+                self.reserved_bytes -= entry["size"]
                 del self.cache[file_id]
+                self.completed[file_id] = output_path
+                if len(self.completed) > MESSAGE_CACHE_SIZE:
+                    self.completed.popitem(last=False)
                 
                 return output_path
                 
@@ -173,24 +658,33 @@ class FileCache:
                 log_routing(file_id, "FILE_SAVE_ERROR", str(e))
                 return None
     
-    def _cleanup_file(self, file_id):
-        """Clean up any temporary files for a file ID"""
-        temp_path = os.path.join(self.cache_dir, file_id)
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except Exception as e:
-                log_routing(file_id, "CACHE_CLEANUP_ERROR", str(e))
+    def _discard(self, file_id):
+        """Drop a cached file and its partial data"""
+        entry = self.cache.pop(file_id)
+        self.reserved_bytes -= entry["size"]
+        self._cleanup_file(entry)
+    
+    def _cleanup_file(self, entry):
+        """Close and remove the partial file of a cache entry"""
+        try:
+            if entry["fd"] is not None:
+                os.close(entry["fd"])
+                entry["fd"] = None
+            for path in (entry["path"], self._meta_path(entry["path"]), self._hashes_path(entry["path"])):
+                if os.path.exists(path):
+                    os.remove(path)
+        except Exception as e:
+            log_routing(entry["path"], "CACHE_CLEANUP_ERROR", str(e))
     
     def get_pending_files(self):
         """Get list of files in progress and their completion status"""
         with self.lock:
             pending = {}
-            for file_id, file_data in self.cache.items():
+            for file_id, entry in self.cache.items():
                 pending[file_id] = {
-                    "filename": file_data["filename"],
-                    "progress": len(file_data["chunks"]) / file_data["total_chunks"],
-                    "total_chunks": file_data["total_chunks"]
+                    "filename": entry["filename"],
+                    "progress": entry["received"] / entry["total_chunks"] if entry["total_chunks"] else 1.0,
+                    "total_chunks": entry["total_chunks"]
                 }
             return pending
     
@@ -200,17 +694,70 @@ class FileCache:
             current_time = time.time()
             to_remove = []
             
-            for file_id, file_data in self.cache.items():
-                if current_time - file_data["timestamp"] > max_age_seconds:
+            for file_id, entry in self.cache.items():
+                if current_time - entry["timestamp"] > max_age_seconds:
                     to_remove.append(file_id)
             
             for file_id in to_remove:
-                self._cleanup_file(file_id)
-                del self.cache[file_id]
+                self._discard(file_id)
             
             return len(to_remove)
 
 
+
+class ChunkHashCache:
+    """Chunk hashes of files a relay forwards, so it can drop corrupt chunks instead of passing them on"""
+    def __init__(self, max_files=RELAY_HASH_CACHE_SIZE):
+        self.hashes = OrderedDict()  # {file_id: PartialHashes}
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.dropped = 0
+    
+    def expect(self, file_id, total_chunks, root):
+        """Start collecting the chunk hashes of a file announced by a relayed file_info packet"""
+        with self.lock:
+            partial = self.hashes.get(file_id)
+            if partial is None or (partial.total_chunks, partial.root) != (total_chunks, root):
+                self.hashes[file_id] = PartialHashes(total_chunks, root)
+            self.hashes.move_to_end(file_id)
+            if len(self.hashes) > self.max_files:
+                self.hashes.popitem(last=False)
+    
+    def add(self, file_id, start, data):
+        """Record a batch of chunk hashes from a relayed file_hashes packet"""
+        with self.lock:
+            partial = self.hashes.get(file_id)
+            if partial is None:
+                return
+            try:
+                partial.add(start, data)
+            except IntegrityError as e:
+                # The receiver rejects them too and the sender sends them again
+                log_routing(file_id, "HASHES_CORRUPT", str(e))
+    
+    def check(self, file_id, chunk_index, chunk_data):
+        """Check a relayed chunk; False only when its hash is known and doesn't match"""
+        with self.lock:
+            partial = self.hashes.get(file_id)
+            hashes = partial.verified if partial is not None else None
+        if hashes is None:
+            return True
+        
+        ok = verify_chunk(hashes, chunk_index, chunk_data)
+        with self.lock:
+            self.checked += 1
+            if not ok:
+                self.dropped += 1
+        return ok
+    
+    def get_stats(self):
+        """Get relay verification counters"""
+        with self.lock:
+            return {"files": len(self.hashes), "checked": self.checked, "dropped": self.dropped}
+
+
 # Create global instances
 message_cache = MessageCache()
 file_cache = FileCache()
+chunk_hash_cache = ChunkHashCache()
@@ -0,0 +1,25 @@
+from config import HSLS_SLOT, HSLS_LEVELS, HSLS_EXPIRY_FACTOR, ROUTING_TIMEOUT
+
+# Hazy-Sighted Link State scheduling: a node's link state reaches nearby nodes
+# often and distant ones rarely, so what each update costs stays bounded by the
+# size of its neighborhood rather than the size of the network
+LOCAL_SCOPE = 2  # Hops reached by every update, and by those triggered by link changes
+WIDEST_SCOPE = 1 << HSLS_LEVELS  # Hops reached by the least frequent updates
+
+def scope_for_slot(slot):
+    """TTL of the update sent in a slot: 2^k for the highest level k whose interval of 2^(k-1) slots divides it"""
+    level = 1
+    while level < HSLS_LEVELS and slot % (1 << level) == 0:
+        level += 1
+    return 1 << level
+
+def refresh_interval(distance):
+    """Seconds between the updates that reach a node `distance` hops away"""
+    level = 1
+    while level < HSLS_LEVELS and (1 << level) < distance:
+        level += 1
+    return HSLS_SLOT * (1 << (level - 1))
+
+def link_state_lifetime(distance):
+    """Seconds a link state from `distance` hops away is kept without being refreshed"""
+    return max(ROUTING_TIMEOUT, HSLS_EXPIRY_FACTOR * refresh_interval(distance))
@@ -1,86 +1,397 @@
 import time
+import heapq
 import json
 import threading
 import uuid
-from config import MY_ID, MY_IP, KNOWN_PEERS, MAX_TTL, ROUTING_TIMEOUT, IS_HOTSPOT_HOST
+from collections import deque
+from config import (
+    MY_ID, MY_IP, KNOWN_PEERS, MAX_TTL, ROUTING_TIMEOUT, IS_HOTSPOT_HOST,
+    LINK_PROBE_TIMEOUT, LINK_PROBE_WINDOW, LINK_PROBE_MIN_SAMPLES, LINK_RTT_UNIT, LINK_MAX_COST,
+    LINK_COST_HYSTERESIS, ROUTE_SWITCH_HYSTERESIS
+)
+from routing.hsls import link_state_lifetime
 from utils.logger import log_routing, routing_logger
 
+# Weight of the newest round trip in a link's smoothed RTT
+LINK_RTT_WEIGHT = 0.125
+
 class Router:
     def __init__(self):
-        self.routing_table = {}  # {node_id: {"next_hop": ip, "ttl": remaining_ttl, "seq": sequence_num, "timestamp": time}}
+        self.routing_table = {}  # {node_id: {"next_hop": ip, "next_hops": [ip, ...], "cost": path cost, "hops": hop count, "seq": sequence_num, "timestamp": time, "via_bridge": bool, "is_gateway": bool}}
+        self.link_states = {}  # {node_id: {"seq": sequence_num, "ip": ip, "version": link version, "links": {neighbor_id: cost} or None, "bridges": bool, "is_gateway": bool, "timestamp": time, "expires": time, "indexed": time}}
+        self.neighbor_ids = {}  # {node_id: {"ip": ip, "timestamp": time, "expires": time, "indexed": time, "acked": version of our links it holds, link quality fields}} for neighbors we hear from directly
+        self.expiry_heap = []  # [(time, kind, node_id)], one entry per link state and neighbor at the time it was indexed
         self.sequence_numbers = {}  # {node_id: latest_sequence_number}
         self.neighbors = set()  # Direct neighbors (1-hop)
         self.message_ids_seen = set()  # Track message IDs to prevent loops
-        self.secondary_routes = {}  # Backup routes for resilience
         self.lock = threading.RLock()  # Lock for thread safety
         self.bridge_nodes = set()  # Nodes that can bridge between networks
         self.gateway_nodes = set()  # Nodes that act as hotspot hosts (gateways)
+        self.announced_gateways = set()  # Gateways we heard from through gateway updates rather than link states
+        self.links_changed = threading.Event()  # Set when our own links change, to trigger a local routing update
+        
+        # Our advertised links, numbered so updates can carry just the changes
+        self.link_version = 0
+        self.advertised = None  # (links, bridges, is_gateway) of the current version
+        self.link_history = {}  # {version: links} for versions a delta may still build on
+        self.scope_versions = {}  # {scope: version the last update of that scope carried}
+        
+        # Counters
+        self.route_computations = 0
+        self.last_computation_ms = 0.0
+        self.updates_sent = {"snapshot": 0, "delta": 0, "refresh": 0}
+        self.missed_updates = 0  # Deltas and refreshes we couldn't apply, waiting on a snapshot
+    
+    def _update_neighbor(self, node_id, ip):
+        """Record a node we heard from directly, returning True if our own links changed; call with the lock held"""
+        if ip not in self.neighbors:
+            self.neighbors.add(ip)
+            log_routing(node_id, "NEW_NEIGHBOR", f"IP: {ip}")
+        
+        now = time.time()
+        known = self.neighbor_ids.get(node_id)
+        if known is not None and known["ip"] == ip:
+            known["timestamp"] = now
+            known["expires"] = now + ROUTING_TIMEOUT
+            return False
+        
+        self.neighbor_ids[node_id] = {
+            "ip": ip,
+            "timestamp": now,
+            "expires": now + ROUTING_TIMEOUT,
+            "acked": known["acked"] if known is not None else None,
+            
+            # Link quality, measured by probing; a new address is a new link
+            "probes": {},  # {seq: time sent} for probes awaiting replies
+            "outcomes": deque(maxlen=LINK_PROBE_WINDOW),  # Round trip of each settled probe, None if lost
+            "next_seq": 0,
+            "rtt": None,  # Smoothed round trip, in seconds
+            "loss": 0.0,
+            "etx": 1.0,  # Expected transmissions for a packet to cross the link and be answered
+            "cost": 1.0  # What we advertise the link at and route by
+        }
+        self._index_expiry("neighbor", node_id, self.neighbor_ids[node_id])
+        self.links_changed.set()
+        return True
+    
+    def _index_expiry(self, kind, node_id, entry):
+        """Put a link state or neighbor on the expiry heap at its current expiry time; call with the lock held"""
+        entry["indexed"] = entry["expires"]
+        heapq.heappush(self.expiry_heap, (entry["expires"], kind, node_id))
+    
+    def next_expiry(self):
+        """Get when the next link state or neighbor may expire, or None if there are none"""
+        with self.lock:
+            return self.expiry_heap[0][0] if self.expiry_heap else None
+            
+    def get_neighbor_ids(self):
+        """Get the IDs of the neighbors we hear from directly"""
+        with self.lock:
+            return list(self.neighbor_ids)
+    
+    def start_probe(self, node_id):
+        """Settle a neighbor's overdue probes and number a new one, returning (ip, seq) or None if it's gone"""
+        with self.lock:
+            neighbor = self.neighbor_ids.get(node_id)
+            if neighbor is None:
+                return None
+            
+            now = time.time()
+            overdue = [seq for seq, sent in neighbor["probes"].items() if now - sent > LINK_PROBE_TIMEOUT]
+            for seq in overdue:
+                del neighbor["probes"][seq]
+                neighbor["outcomes"].append(None)
+            if overdue:
+                self._update_link_cost(node_id)
+            
+            seq = neighbor["next_seq"]
+            neighbor["next_seq"] += 1
+            neighbor["probes"][seq] = now
+            return neighbor["ip"], seq
     
-    def update_link_state(self, sender_id, sender_ip, link_state, seq_num, ttl):
-        """Update routing table with new link state information"""
+    def record_probe_reply(self, node_id, seq, received=None, held=0.0):
+        """Record the answer to a probe, received at `received` after the neighbor held the probe for `held` seconds, updating the link's round trip and cost"""
         with self.lock:
-            # Update direct neighbor
-            if sender_ip not in self.neighbors:
-                self.neighbors.add(sender_ip)
-                log_routing(sender_id, "NEW_NEIGHBOR", f"IP: {sender_ip}")
-            
-            # Check if this is a gateway node
-            if link_state.get("is_gateway", False) or (sender_id in self.gateway_nodes):
-                self.gateway_nodes.add(sender_id)
-                routing_logger.info(f"Node {sender_id} identified as a gateway/hotspot host")
-                # Also update in routing table
-                if sender_id in self.routing_table:
-                    self.routing_table[sender_id]["is_gateway"] = True
-            
-            # Check if this is a newer update
-            if sender_id not in self.sequence_numbers or seq_num > self.sequence_numbers[sender_id]:
-                self.sequence_numbers[sender_id] = seq_num
+            neighbor = self.neighbor_ids.get(node_id)
+            sent = neighbor["probes"].pop(seq, None) if neighbor is not None else None
+            if sent is None:
+                return
+            
+            # Time the probe and its reply spent queued inside either node is
+            # load on the node, not the link
+            rtt = max(0.0, (received or time.time()) - sent - held)
+            neighbor["outcomes"].append(rtt)
+            if neighbor["rtt"] is None:
+                neighbor["rtt"] = rtt
+            else:
+                neighbor["rtt"] = (1 - LINK_RTT_WEIGHT) * neighbor["rtt"] + LINK_RTT_WEIGHT * rtt
+            self._update_link_cost(node_id)
+    
+    def record_link_failure(self, ip):
+        """Count a failed send to a neighbor as a lost probe, so a broken link costs more before its probes time out"""
+        with self.lock:
+            for node_id, neighbor in self.neighbor_ids.items():
+                if neighbor["ip"] == ip:
+                    # Probes in flight on the failed connection are lost with it; count
+                    # the failure once rather than again as they time out
+                    neighbor["probes"].clear()
+                    neighbor["outcomes"].append(None)
+                    self._update_link_cost(node_id)
+    
+    def _update_link_cost(self, node_id):
+        """Work out a neighbor's loss, ETX and cost, changing the cost we route by only when it moves past the hysteresis; call with the lock held"""
+        neighbor = self.neighbor_ids[node_id]
+        outcomes = neighbor["outcomes"]
+        
+        # Peers that never answer probes predate them; their links keep the default cost
+        if neighbor["rtt"] is None or len(outcomes) < LINK_PROBE_MIN_SAMPLES:
+            return
+        
+        # A probe and its reply both have to get through, so the share answered
+        # is the two-way delivery ratio, and ETX its inverse. Slow links cost
+        # more in proportion to their round trip
+        answered = sum(1 for rtt in outcomes if rtt is not None)
+        neighbor["loss"] = 1 - answered / len(outcomes)
+        neighbor["etx"] = len(outcomes) / answered if answered else LINK_MAX_COST
+        cost = min(LINK_MAX_COST, round(neighbor["etx"] * max(1.0, neighbor["rtt"] / LINK_RTT_UNIT), 1))
+        if abs(cost - neighbor["cost"]) <= neighbor["cost"] * LINK_COST_HYSTERESIS:
+            return
+        
+        log_routing(node_id, "LINK_COST", f"{neighbor['cost']:.1f} -> {cost:.1f} (ETX {neighbor['etx']:.2f}, RTT {neighbor['rtt'] * 1000:.0f} ms)")
+        neighbor["cost"] = cost
+        self.links_changed.set()
+        self._compute_routes()
+    
+    def update_link_state(self, sender_id, sender_ip, link_state, seq_num, ttl, direct=True, scope=None):
+        """Merge the link states in a routing update into our topology, recomputing routes if it changed"""
+        with self.lock:
+            # Updates that travelled further are refreshed less often, so they
+            # are kept longer; those without a scope come from neighbors
+            # passing on whole tables every broadcast
+            lifetime = link_state_lifetime(scope - ttl + 1) if scope else ROUTING_TIMEOUT
+            
+            topology_changed = False
+            was_updated = False
+            
+            # Whoever sent us the packet directly is one of our links
+            if direct and sender_id != MY_ID:
+                topology_changed = self._update_neighbor(sender_id, sender_ip)
+            
+            now = time.time()
+            for node, state in link_state.items():
+                # We're the authority on our own links
+                if node == MY_ID or not isinstance(state, dict) or "seq" not in state:
+                    continue
+                
+                # A neighbor tells us which version of our links it holds
+                if node == sender_id and direct:
+                    acks = state.get("acks")
+                    self.neighbor_ids[node]["acked"] = acks.get(MY_ID) if isinstance(acks, dict) else None
                 
-                # Extract any bridging information from the link state
-                if "bridges" in link_state and link_state["bridges"]:
-                    # This node connects to multiple networks - mark it as a bridge
-                    self.bridge_nodes.add(sender_id)
-                    routing_logger.info(f"Node {sender_id} identified as a bridge between networks")
+                # Only a newer link state from its origin replaces what we hold;
+                # neighbors re-advertising an old one don't keep it alive
+                known = self.link_states.get(node)
+                if known is not None and state["seq"] <= known["seq"]:
+                    continue
                 
-                # Update routing information
-                for node, routes in link_state.items():
-                    # Skip if this is our own ID
-                    if node == MY_ID:
+                # Deltas and refreshes only apply to the version they build on;
+                # if we missed it, the origin's next snapshot repairs it
+                links = state.get("links")
+                version = state.get("version")
+                if links is None and version is not None:
+                    if known is None or known["links"] is None or known["version"] != state.get("base", version):
+                        self.missed_updates += 1
                         continue
-                    
-                    # Calculate new TTL
-                    new_ttl = ttl - 1
-                    
-                    # Only update if the route is valid (TTL > 0) or it's a direct neighbor
-                    if new_ttl > 0 or sender_id == node:
-                        # For direct neighbors, always set the next hop to their IP
-                        next_hop = sender_ip if sender_id == node else sender_ip
-                        
-                        # Update or add routing entry
-                        if node not in self.routing_table or self.routing_table[node]["seq"] < routes["seq"]:
-                            # Record the old route as a secondary if it exists
-                            if node in self.routing_table:
-                                self.secondary_routes[node] = self.routing_table[node].copy()
-                            
-                            self.routing_table[node] = {
-                                "next_hop": next_hop,
-                                "ttl": new_ttl,
-                                "seq": routes["seq"],
-                                "timestamp": time.time(),
-                                "via_bridge": sender_id in self.bridge_nodes,
-                                "is_gateway": sender_id in self.gateway_nodes
-                            }
-                            log_routing(node, "ROUTE_UPDATE", f"Via {next_hop}, TTL: {new_ttl}")
+                    links = dict(known["links"])
+                    links.update(state.get("added", {}))
+                    for neighbor_id in state.get("removed", []):
+                        links.pop(neighbor_id, None)
+                
+                # Entries from peers without link lists only describe the sender itself
+                if links is None and node != sender_id:
+                    continue
                 
-                return True  # Return True if routing table was updated
+                new_state = {
+                    "seq": state["seq"],
+                    "ip": state.get("ip"),
+                    "version": version,
+                    "links": dict(links) if links is not None else None,
+                    "bridges": bool(state.get("bridges", False)),
+                    "is_gateway": bool(state.get("is_gateway", False)),
+                    "timestamp": now,
+                    "expires": now + lifetime
+                }
+                self.link_states[node] = new_state
+                self.sequence_numbers[node] = state["seq"]
+                was_updated = True
+                
+                # Refreshes keep the heap entry they have, which re-files itself
+                # when it comes up; only an earlier expiry needs a new one
+                if known is not None and known["indexed"] <= new_state["expires"]:
+                    new_state["indexed"] = known["indexed"]
+                else:
+                    self._index_expiry("link_state", node, new_state)
+                            
+                if known is None or any(known[key] != new_state[key] for key in ("links", "bridges", "is_gateway")):
+                    topology_changed = True
+                elif node in self.routing_table:
+                    # Same topology, just fresher; the route stands
+                    self.routing_table[node]["seq"] = new_state["seq"]
+                    self.routing_table[node]["timestamp"] = now
             
-            return False  # Return False if no update was needed
+            if topology_changed:
+                self._compute_routes()
+            
+            return was_updated or topology_changed
     
-    def get_link_state(self):
-        """Get our current link state information for broadcasting"""
+    def mark_gateway(self, node_id, ip):
+        """Record a gateway that announced itself directly with a gateway update"""
+        with self.lock:
+            changed = self._update_neighbor(node_id, ip)
+            if node_id not in self.announced_gateways:
+                self.announced_gateways.add(node_id)
+                routing_logger.info(f"Node {node_id} identified as a gateway/hotspot host")
+                changed = True
+            if changed:
+                self._compute_routes()
+    
+    def _own_links(self):
+        """Our links to the neighbors we currently hear from; call with the lock held"""
+        return {node_id: neighbor["cost"] for node_id, neighbor in self.neighbor_ids.items()}
+    
+    def _graph(self):
+        """Adjacency map of the topology, keeping only links both ends agree on; call with the lock held"""
+        graph = {MY_ID: self._own_links()}
+        for node_id, state in self.link_states.items():
+            if state["links"] is not None:
+                graph[node_id] = dict(state["links"])
+            else:
+                graph[node_id] = {MY_ID: self.neighbor_ids[node_id]["cost"]} if node_id in self.neighbor_ids else {}
+        
+        # A link one end no longer lists is on its way out; don't route over it.
+        # Our own links are live connections, and nodes without link lists
+        # can't confirm, so their links are taken as given
+        for node_id, links in graph.items():
+            links.pop(node_id, None)
+            if node_id == MY_ID:
+                continue
+            for neighbor_id in list(links):
+                neighbor_state = self.link_states.get(neighbor_id)
+                if neighbor_id == MY_ID:
+                    if node_id not in self.neighbor_ids:
+                        del links[neighbor_id]
+                elif neighbor_state is not None and neighbor_state["links"] is not None and node_id not in neighbor_state["links"]:
+                    del links[neighbor_id]
+        return graph
+    
+    def _shortest_paths(self, graph, source):
+        """Dijkstra from a node, returning {node_id: (cost, hops, first hop id, passes a bridge)}"""
+        paths = {source: (0.0, 0, None, False)}
+        heap = [(0.0, 0, source, None, False)]
+        done = set()
+        while heap:
+            cost, hops, node_id, first_hop, via_bridge = heapq.heappop(heap)
+            if node_id in done:
+                continue
+            done.add(node_id)
+            
+            # Relaying through a bridge marks every route beyond it
+            relays_bridge = via_bridge or (node_id != source and node_id in self.bridge_nodes)
+            for neighbor_id, link_cost in graph.get(node_id, {}).items():
+                if neighbor_id in done:
+                    continue
+                new_cost = cost + link_cost
+                known = paths.get(neighbor_id)
+                if known is None or new_cost < known[0] or (new_cost == known[0] and hops + 1 < known[1]):
+                    neighbor_first_hop = first_hop if node_id != source else neighbor_id
+                    paths[neighbor_id] = (new_cost, hops + 1, neighbor_first_hop, relays_bridge)
+                    heapq.heappush(heap, (new_cost, hops + 1, neighbor_id, neighbor_first_hop, relays_bridge))
+        return paths
+    
+    def _compute_routes(self, lost_event="ROUTE_LOST"):
+        """Rebuild the next-hop table from the topology, returning how many routes were lost; call with the lock held"""
+        started = time.time()
+        self.bridge_nodes = {node_id for node_id, state in self.link_states.items() if state["bridges"]}
+        self.gateway_nodes = {node_id for node_id, state in self.link_states.items() if state["is_gateway"]}
+        self.gateway_nodes |= self.announced_gateways
+        
+        graph = self._graph()
+        paths = self._shortest_paths(graph, MY_ID)
+        
+        # Other neighbors that reach a destination without coming back through
+        # us are loop-free alternates, used for multipath and when the first
+        # choice is where the packet came from
+        neighbor_paths = {
+            neighbor_id: self._shortest_paths(graph, neighbor_id)
+            for neighbor_id in graph[MY_ID] if neighbor_id in paths
+        }
+        
+        routing_table = {}
+        for node_id, (cost, hops, first_hop, via_bridge) in paths.items():
+            # Packets don't live long enough to reach nodes past the hop limit
+            if node_id == MY_ID or hops > MAX_TTL:
+                continue
+            
+            candidates = [(cost, hops, first_hop)]
+            for neighbor_id, from_neighbor in neighbor_paths.items():
+                if neighbor_id == first_hop or node_id not in from_neighbor:
+                    continue
+                neighbor_cost = from_neighbor[node_id][0]
+                if neighbor_cost < from_neighbor.get(MY_ID, (float("inf"),))[0] + cost:
+                    candidates.append((graph[MY_ID][neighbor_id] + neighbor_cost, from_neighbor[node_id][1] + 1, neighbor_id))
+            candidates.sort()
+            
+            # Stay with the current next hop while it's nearly as cheap as the
+            # best, so small swings in measured link costs don't flap routes
+            old = self.routing_table.get(node_id)
+            if old is not None:
+                for candidate in candidates[1:]:
+                    if (self.neighbor_ids[candidate[2]]["ip"] == old["next_hop"] and candidate[1] <= MAX_TTL
+                            and candidate[0] <= candidates[0][0] * (1 + ROUTE_SWITCH_HYSTERESIS)):
+                        candidates.remove(candidate)
+                        candidates.insert(0, candidate)
+                        break
+            cost, hops = candidates[0][:2]
+            
+            next_hops = []
+            for _, _, neighbor_id in candidates:
+                ip = self.neighbor_ids[neighbor_id]["ip"]
+                if ip not in next_hops:
+                    next_hops.append(ip)
+            
+            # Routes last until the link states they're computed from expire;
+            # nodes we only know from others' links, whose own link state
+            # hasn't reached us yet, last as long as the neighbor they're behind
+            state = self.link_states.get(node_id)
+            heard = self.neighbor_ids.get(node_id) or self.neighbor_ids[first_hop]
+            routing_table[node_id] = {
+                "next_hop": next_hops[0],
+                "next_hops": next_hops,
+                "cost": cost,
+                "hops": hops,
+                "seq": state["seq"] if state is not None else 0,
+                "timestamp": state["timestamp"] if state is not None else heard["timestamp"],
+                "via_bridge": via_bridge,
+                "is_gateway": node_id in self.gateway_nodes
+            }
+        
+        # Log only the routes that changed
+        for node_id, route in routing_table.items():
+            old = self.routing_table.get(node_id)
+            if old is None or old["next_hop"] != route["next_hop"] or old["hops"] != route["hops"]:
+                log_routing(node_id, "ROUTE_UPDATE", f"Via {route['next_hop']}, hops: {route['hops']}, cost: {route['cost']:.1f}")
+        lost = [node_id for node_id in self.routing_table if node_id not in routing_table]
+        for node_id in lost:
+            log_routing(node_id, lost_event)
+        
+        self.routing_table = routing_table
+        self.route_computations += 1
+        self.last_computation_ms = (time.time() - started) * 1000
+        return len(lost)
+    
+    def get_link_state(self, scope=None, snapshot=False):
+        """Get our own link state for a routing update reaching `scope` hops: all our links in a snapshot, else only what changed since the version every node in reach holds"""
         with self.lock:
-            link_state = {}
-            
             # Add ourselves with the latest sequence number
             my_seq = self.sequence_numbers.get(MY_ID, 0) + 1
             self.sequence_numbers[MY_ID] = my_seq
@@ -88,25 +399,56 @@ class Router:
             # Determine if we're a bridge between networks
             is_bridge = self.detect_bridge_status()
             
-            link_state[MY_ID] = {
+            # A new version whenever what we advertise changes
+            links = self._own_links()
+            if (links, is_bridge, IS_HOTSPOT_HOST) != self.advertised:
+                self.advertised = (links, is_bridge, IS_HOTSPOT_HOST)
+                self.link_version += 1
+                self.link_history[self.link_version] = links
+            
+            entry = {
                 "ip": MY_IP,
                 "seq": my_seq,
-                "neighbors": list(self.neighbors),
+                "version": self.link_version,
                 "bridges": is_bridge,
-                "is_gateway": IS_HOTSPOT_HOST
+                "is_gateway": IS_HOTSPOT_HOST,
+                # Which version of each neighbor's links we hold, so they can send us deltas
+                "acks": {
+                    node_id: self.link_states[node_id]["version"]
+                    for node_id in self.neighbor_ids if node_id in self.link_states
+                }
             }
             
-            # Add information about other nodes we know
-            for node_id, route in self.routing_table.items():
-                # Only include fresh routes
-                if time.time() - route["timestamp"] <= ROUTING_TIMEOUT:
-                    link_state[node_id] = {
-                        "seq": route["seq"],
-                        "next_hop": route["next_hop"],
-                        "is_gateway": route.get("is_gateway", False)
-                    }
-            
-            return link_state
+            # Nodes in reach hold the version the last update of this scope or
+            # a wider one carried, and neighbors tell us theirs; build on the
+            # oldest, unless a neighbor hasn't acknowledged any
+            acked = [neighbor["acked"] for neighbor in self.neighbor_ids.values()]
+            carried = [version for carried_scope, version in self.scope_versions.items() if scope is not None and carried_scope >= scope]
+            base = min(acked + [max(carried)]) if carried and None not in acked else None
+            
+            if snapshot or base not in self.link_history:
+                entry["neighbors"] = list(self.neighbors)
+                entry["links"] = links
+                self.updates_sent["snapshot"] += 1
+            elif base != self.link_version:
+                old_links = self.link_history[base]
+                entry["base"] = base
+                entry["added"] = {node_id: cost for node_id, cost in links.items() if old_links.get(node_id) != cost}
+                entry["removed"] = [node_id for node_id in old_links if node_id not in links]
+                self.updates_sent["delta"] += 1
+            else:
+                # Nothing changed that anyone in reach is missing
+                self.updates_sent["refresh"] += 1
+            
+            if scope is not None:
+                self.scope_versions[scope] = self.link_version
+            
+            # Forget versions no future delta can build on
+            oldest = min([version for version in acked if version is not None] + list(self.scope_versions.values()), default=self.link_version)
+            for version in [version for version in self.link_history if version < oldest]:
+                del self.link_history[version]
+            
+            return {MY_ID: entry}
     
     def detect_bridge_status(self):
         """Detect if this node bridges between networks"""
@@ -124,76 +466,55 @@ class Router:
         return is_bridge
     
     def get_next_hop(self, destination_id):
-        """Get the next hop for a given destination"""
+        """Get the next hop for a given destination, or None if there is no route"""
         with self.lock:
             # If it's our ID, no routing needed
             if destination_id == MY_ID:
                 return None
             
-            # Check if we have a route and it's still valid
-            if destination_id in self.routing_table:
-                route = self.routing_table[destination_id]
-                
-                # Check if the route is still valid
-                if time.time() - route["timestamp"] <= ROUTING_TIMEOUT:
+            # Expired routes are dropped as they expire, so any route is live
+            route = self.routing_table.get(destination_id)
+            if route is not None:
+                return route["next_hop"]
+            
+            # Nodes we have no link state for may sit behind a gateway or a
+            # bridge to another network; hand the packet to the nearest one
+            for default_nodes, kind in ((self.gateway_nodes, "gateway"), (self.bridge_nodes, "bridge")):
+                candidates = [
+                    self.routing_table[node_id] for node_id in default_nodes
+                    if node_id in self.routing_table and node_id != destination_id
+                ]
+                if candidates:
+                    route = min(candidates, key=lambda candidate: candidate["cost"])
+                    routing_logger.info(f"No route to {destination_id}, routing via {kind} at {route['next_hop']}")
                     return route["next_hop"]
             
-            # If we don't have a valid primary route, check secondary routes
-            if destination_id in self.secondary_routes:
-                sec_route = self.secondary_routes[destination_id]
-                if time.time() - sec_route["timestamp"] <= ROUTING_TIMEOUT * 1.5:  # Give secondary routes longer validity
-                    routing_logger.info(f"Using secondary route to {destination_id} via {sec_route['next_hop']}")
-                    return sec_route["next_hop"]
-            
-            # Check if any gateway nodes can help reach the destination
-            if self.gateway_nodes:
-                routing_logger.info(f"No direct route to {destination_id}, checking gateway nodes: {self.gateway_nodes}")
-                for gateway_id in self.gateway_nodes:
-                    if gateway_id in self.routing_table:
-                        gateway_route = self.routing_table[gateway_id]
-                        if time.time() - gateway_route["timestamp"] <= ROUTING_TIMEOUT:
-                            routing_logger.info(f"Routing via gateway node {gateway_id} at {gateway_route['next_hop']}")
-                            return gateway_route["next_hop"]
-            
-            # Check if any bridge nodes can help reach the destination
-            if self.bridge_nodes:
-                routing_logger.info(f"No direct route to {destination_id}, checking bridge nodes: {self.bridge_nodes}")
-                for bridge_id in self.bridge_nodes:
-                    if bridge_id in self.routing_table:
-                        bridge_route = self.routing_table[bridge_id]
-                        if time.time() - bridge_route["timestamp"] <= ROUTING_TIMEOUT:
-                            routing_logger.info(f"Routing via bridge node {bridge_id} at {bridge_route['next_hop']}")
-                            return bridge_route["next_hop"]
-            
-            # If we don't have any specific route, return all neighbors for flooding
-            all_neighbors = list(self.neighbors)
-            
-            # Prioritize gateways for flooding if no specific route
-            gateway_neighbors = []
-            for neighbor_ip in all_neighbors:
-                for node_id, route in self.routing_table.items():
-                    if route["next_hop"] == neighbor_ip and route.get("is_gateway", False):
-                        gateway_neighbors.append(neighbor_ip)
-                        break
-            
-            if gateway_neighbors:
-                routing_logger.info(f"No specific route, but found gateway neighbors to try: {gateway_neighbors}")
-                return gateway_neighbors
-            
-            # Next prioritize bridges for flooding if no specific route
-            bridge_neighbors = []
-            for neighbor_ip in all_neighbors:
-                for node_id, route in self.routing_table.items():
-                    if route["next_hop"] == neighbor_ip and route.get("via_bridge", False):
-                        bridge_neighbors.append(neighbor_ip)
-                        break
-            
-            if bridge_neighbors:
-                routing_logger.info(f"No specific route, but found bridge neighbors to try: {bridge_neighbors}")
-                return bridge_neighbors
+            return None
+    
+    def get_next_hops(self, destination_id):
+        """Get every distinct next hop that may reach a destination without looping, preferred first"""
+        with self.lock:
+            route = self.routing_table.get(destination_id)
+            if route is not None:
+                return list(route["next_hops"])
             
-            routing_logger.info(f"No specific route, flooding to all neighbors: {all_neighbors}")
-            return all_neighbors
+            next_hop = self.get_next_hop(destination_id)
+            return [next_hop] if next_hop else []
+    
+    def get_link_quality(self):
+        """Get the measured quality of the link to each neighbor"""
+        with self.lock:
+            return {
+                node_id: {
+                    "ip": neighbor["ip"],
+                    "rtt_ms": neighbor["rtt"] * 1000 if neighbor["rtt"] is not None else None,
+                    "loss": neighbor["loss"],
+                    "etx": neighbor["etx"],
+                    "cost": neighbor["cost"],
+                    "samples": len(neighbor["outcomes"])
+                }
+                for node_id, neighbor in self.neighbor_ids.items()
+            }
     
     def get_all_routes(self):
         """Get all active routes in the routing table"""
@@ -202,18 +523,31 @@ class Router:
             current_time = time.time()
             
             for node_id, route in self.routing_table.items():
-                # Only include fresh routes
-                if current_time - route["timestamp"] <= ROUTING_TIMEOUT:
-                    active_routes[node_id] = {
-                        "next_hop": route["next_hop"],
-                        "ttl": route["ttl"],
-                        "age": int(current_time - route["timestamp"]),
-                        "via_bridge": route.get("via_bridge", False),
-                        "is_gateway": route.get("is_gateway", False)
-                    }
+                active_routes[node_id] = {
+                    "next_hop": route["next_hop"],
+                    "hops": route["hops"],
+                    "cost": route["cost"],
+                    "age": int(current_time - route["timestamp"]),
+                    "via_bridge": route.get("via_bridge", False),
+                    "is_gateway": route.get("is_gateway", False)
+                }
             
             return active_routes
     
+    def get_stats(self):
+        """Get the size of the topology and how often routes were recomputed"""
+        with self.lock:
+            return {
+                "nodes": len(self.link_states),
+                "links": sum(len(state["links"] or {}) for state in self.link_states.values()),
+                "neighbors": len(self.neighbor_ids),
+                "routes": len(self.routing_table),
+                "computations": self.route_computations,
+                "last_computation_ms": self.last_computation_ms,
+                "updates_sent": dict(self.updates_sent),
+                "missed_updates": self.missed_updates
+            }
+    
     def should_forward_message(self, message_id, ttl):
         """Check if a message should be forwarded based on TTL and message ID"""
         with self.lock:
@@ -239,49 +573,41 @@ class Router:
             return True
     
     def cleanup_stale_routes(self):
-        """Remove stale routes from the routing table"""
+        """Drop the link states and neighbors whose time is up, recomputing routes if any went"""
         with self.lock:
             current_time = time.time()
-            stale_nodes = []
-            
-            for node_id, route in self.routing_table.items():
-                if current_time - route["timestamp"] > ROUTING_TIMEOUT:
-                    stale_nodes.append(node_id)
-                    # Move to secondary routes before removing
-                    self.secondary_routes[node_id] = route.copy()
-            
-            for node_id in stale_nodes:
-                del self.routing_table[node_id]
-                log_routing(node_id, "ROUTE_EXPIRED")
-            
-            # Also clean up very old secondary routes
-            stale_secondary = []
-            for node_id, route in self.secondary_routes.items():
-                if current_time - route["timestamp"] > ROUTING_TIMEOUT * 3:  # Keep secondary routes longer
-                    stale_secondary.append(node_id)
-            
-            for node_id in stale_secondary:
-                del self.secondary_routes[node_id]
-            
-            # Update bridge and gateway nodes set
-            stale_bridges = []
-            for bridge_id in self.bridge_nodes:
-                if bridge_id not in self.routing_table and bridge_id not in self.secondary_routes:
-                    stale_bridges.append(bridge_id)
-            
-            for bridge_id in stale_bridges:
-                self.bridge_nodes.remove(bridge_id)
-            
-            # Update gateway nodes set
-            stale_gateways = []
-            for gateway_id in self.gateway_nodes:
-                if gateway_id not in self.routing_table and gateway_id not in self.secondary_routes:
-                    stale_gateways.append(gateway_id)
-            
-            for gateway_id in stale_gateways:
-                self.gateway_nodes.remove(gateway_id)
-            
-            return len(stale_nodes)
+            stale_states = 0
+            stale_neighbors = 0
+            
+            # Only entries due by now are looked at, so this costs nothing
+            # while nothing expires, however large the topology
+            while self.expiry_heap and self.expiry_heap[0][0] <= current_time:
+                indexed, kind, node_id = heapq.heappop(self.expiry_heap)
+                table = self.link_states if kind == "link_state" else self.neighbor_ids
+                entry = table.get(node_id)
+            
+                # Entries replaced since are indexed again under their own time;
+                # those refreshed since go back on the heap at their new expiry
+                if entry is None or entry["indexed"] != indexed:
+                    continue
+                if entry["expires"] > current_time:
+                    self._index_expiry(kind, node_id, entry)
+                    continue
+            
+                del table[node_id]
+                if kind == "link_state":
+                    stale_states += 1
+                else:
+                    stale_neighbors += 1
+                    self.announced_gateways.discard(node_id)
+            
+            if stale_neighbors:
+                self.links_changed.set()
+            
+            if not stale_states and not stale_neighbors:
+                return 0
+            
+            return self._compute_routes("ROUTE_EXPIRED")
 
 
 # Create a global router instance
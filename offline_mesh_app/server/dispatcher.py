@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+from collections import deque
+from config import INGRESS_WORKERS, INGRESS_QUEUE_SIZE, INGRESS_OVERLOAD_POLICY
+from server.handler import handle_packet
+from utils.framing import FLAG_SHEDDABLE, TRAFFIC_CLASS_NAMES, frame_traffic_class
+from utils.logger import network_logger
+
+# Overload policies
+POLICY_DROP_OLDEST_ROUTING = "drop_oldest_routing"  # Shed queued routing and gateway updates, block for everything else
+POLICY_BLOCK = "block"  # Never drop; readers wait for space
+
+
+class IngressDispatcher:
+    """Fixed pool of worker threads fed by a bounded ingress queue"""
+    def __init__(self, handler, workers=INGRESS_WORKERS, max_queue=INGRESS_QUEUE_SIZE,
+                 policy=INGRESS_OVERLOAD_POLICY):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue = deque()  # [(traffic_class, sheddable, enqueue_time, args)]
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.threads = []
+        
+        # Counters
+        self.enqueued = {name: 0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.dropped = {name: 0 for name in TRAFFIC_CLASS_NAMES.values()}
+        self.dequeued = 0
+        self.processed = 0
+        self.blocked = 0  # Times a reader had to wait for queue space
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def start(self):
+        """Start the worker threads"""
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"ingress-worker-{i}", daemon=True)
+                self.threads.append(t)
+                t.start()
+        
+        network_logger.info(f"Ingress dispatcher started with {self.workers} workers, "
+                            f"queue size {self.max_queue}, policy '{self.policy}'")
+    
+    def submit(self, flags, *args, block=True):
+        """Queue a packet for the workers, waiting for space if needed (or raising queue.Full if block is False); returns False if it was dropped"""
+        traffic_class = frame_traffic_class(flags)
+        sheddable = bool(flags & FLAG_SHEDDABLE)
+        class_name = TRAFFIC_CLASS_NAMES.get(traffic_class, "interactive")
+        
+        with self.lock:
+            if len(self.queue) >= self.max_queue and self.policy == POLICY_DROP_OLDEST_ROUTING:
+                # Make room by shedding the oldest routing or gateway update; newer ones supersede it
+                if not self._drop_oldest_sheddable():
+                    if sheddable:
+                        self.dropped[class_name] += 1
+                        return False
+            
+            if len(self.queue) >= self.max_queue:
+                if not block:
+                    raise queue.Full
+                
+                # User traffic is never dropped; make the reader wait instead
+                self.blocked += 1
+                while len(self.queue) >= self.max_queue:
+                    self.not_full.wait()
+            
+            self.queue.append((traffic_class, sheddable, time.time(), args))
+            self.enqueued[class_name] += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.not_empty.notify()
+            return True
+    
+    def _drop_oldest_sheddable(self):
+        """Remove the oldest queued routing or gateway update, returning True if one was found"""
+        for i, item in enumerate(self.queue):
+            if item[1]:
+                del self.queue[i]
+                self.dropped[TRAFFIC_CLASS_NAMES[item[0]]] += 1
+                return True
+        return False
+    
+    def _worker(self):
+        """Take packets off the queue and handle them"""
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.not_empty.wait()
+                traffic_class, sheddable, enqueue_time, args = self.queue.popleft()
+                
+                wait = time.time() - enqueue_time
+                self.dequeued += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                
+                # Wake a reader waiting for space
+                self.not_full.notify()
+            
+            try:
+                self.handler(*args)
+            except Exception as e:
+                network_logger.error(f"Error in ingress worker: {e}")
+            
+            with self.lock:
+                self.processed += 1
+    
+    def get_stats(self):
+        """Get queue depth, wait time and drop counters"""
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.max_queue,
+                "policy": self.policy,
+                "depth": len(self.queue),
+                "max_depth": self.max_depth,
+                "avg_wait_ms": (self.total_wait / self.dequeued * 1000) if self.dequeued else 0.0,
+                "max_wait_ms": self.max_wait * 1000,
+                "processed": self.processed,
+                "blocked": self.blocked,
+                "enqueued": dict(self.enqueued),
+                "dropped": dict(self.dropped)
+            }
+
+
+# Create a global dispatcher for incoming packets
+ingress_dispatcher = IngressDispatcher(handle_packet)
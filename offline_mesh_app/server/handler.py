@@ -1,131 +1,350 @@
-import json
 import os
 import base64
+import shutil
 import threading
 import time
-from config import MY_ID, DOWNLOAD_DIR
+import uuid
+from config import (
+    MY_ID, MAX_TTL, DOWNLOAD_DIR, DIRECT_SEGMENT_SIZE, RELAY_VERIFY_CHUNKS, CHUNK_SIZE,
+    FLOW_BUFFER_SIZE, FLOW_STATUS_TIMEOUT, MAX_FRAME_SIZE
+)
 from routing.router import router
-from routing.cache import message_cache, file_cache
+from routing.cache import message_cache, file_cache, chunk_hash_cache
 from utils.logger import log_message, log_routing, log_file_transfer, network_logger
-from utils.encryption import decrypt_data
-from client.sender import forward_packet
+from utils.encryption import DecryptionError
+from utils.codec import record_peer_codecs, CodecError, CODEC_BINARY
+from utils.compression import record_peer_compressions, CompressionError
+from utils.envelope import open_envelope, open_body, came_direct, EnvelopeError
+from utils.framing import FLAG_SEALED_STREAM, recv_exact
+from utils.file_stream import (
+    SEGMENT_LENGTH, STREAM_ID_SIZE, FLOW_HEADER_LENGTH, FLOW_COMPLETE, FLOW_INCOMPLETE, FLOW_UNVERIFIED,
+    parse_segment_length, parse_flow_header_length, open_segment, flow_stream_id
+)
+from utils.merkle import HASH_SIZE
+from client.sender import forward_packet, forward_next_hop, send_packet, open_flow
+from client.transfer import deliver_have_map, deliver_file_ack
+from client.rate_limit import rate_limiter
 from client.gateway_discovery import handle_gateway_update
+from client.link_probe import handle_probe, handle_probe_reply
 
+# Unicast packet types relays forward by header alone
+RELAYED_TYPES = ("message", "file_info", "file_hashes", "file_chunk", "file_have_query", "file_have_map", "file_ack")
 
-def handle_file_transfer(conn, addr):
-    """Handle an incoming file transfer"""
+# Relayed types whose body is still opened and checked when RELAY_VERIFY_CHUNKS is on
+VERIFIED_RELAY_TYPES = ("file_info", "file_hashes", "file_chunk")
+
+
+def open_incoming_file(addr):
+    """Create the temporary path an incoming direct transfer is written to"""
+    temp_dir = os.path.join(DOWNLOAD_DIR, "temp")
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    # Generate a unique filename; several streams can arrive from one peer at once
+    temp_filename = f"incoming_{addr[0]}_{uuid.uuid4().hex}.dat"
+    return os.path.join(temp_dir, temp_filename)
+
+def store_incoming_file(temp_path, addr, total_received):
+    """Move a fully received direct transfer into the downloads directory"""
+    network_logger.info(f"File received from {addr[0]}: {total_received} bytes")
+    
+    dest_path = os.path.join(DOWNLOAD_DIR, f"received_file_{int(time.time())}_{uuid.uuid4().hex[:8]}.dat")
+    shutil.move(temp_path, dest_path)
+    
+    network_logger.info(f"File saved to {dest_path}")
+    return dest_path
+
+def handle_file_transfer(conn, addr, length, flags=0):
+    """Handle an incoming file stream of exactly `length` bytes"""
+    temp_path = None
     try:
-        # Create a unique filename based on source and timestamp
-        import tempfile
-        from datetime import datetime
-        
-        # Create a temporary file
-        temp_dir = os.path.join(DOWNLOAD_DIR, "temp")
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Generate a unique filename
-        temp_filename = f"incoming_{addr[0]}_{int(time.time())}.dat"
-        temp_path = os.path.join(temp_dir, temp_filename)
+        temp_path = open_incoming_file(addr)
         
         # Track data received
         total_received = 0
         
-        # Receive the file in chunks
         with open(temp_path, "wb") as f:
-            while True:
-                chunk = conn.recv(4096)
-                if not chunk:
-                    break
-                f.write(chunk)
-                total_received += len(chunk)
-        
-        network_logger.info(f"File received from {addr[0]}: {total_received} bytes")
-        
-        # Now process the file - in a real implementation, you would need to
-        # determine which file_id this belongs to and add it to the correct file cache
-        # For now, we'll just move it to the downloads directory
-        
-        # Check if there's a pending file in the cache that needs this data
-        # This is a simple implementation - in practice you would need a more robust way
-        # to match binary data with file_info packets
-        import shutil
-        dest_path = os.path.join(DOWNLOAD_DIR, f"received_file_{int(time.time())}.dat")
-        shutil.move(temp_path, dest_path)
-        
-        network_logger.info(f"File saved to {dest_path}")
+            if flags & FLAG_SEALED_STREAM:
+                # Verify and decrypt one sealed segment at a time
+                stream_id = recv_exact_or_fail(conn, STREAM_ID_SIZE)
+                total_received = STREAM_ID_SIZE
+                index = 0
+                while total_received < length:
+                    segment_length = parse_segment_length(recv_exact_or_fail(conn, SEGMENT_LENGTH.size))
+                    f.write(open_segment(stream_id, index, recv_exact_or_fail(conn, segment_length)))
+                    total_received += SEGMENT_LENGTH.size + segment_length
+                    index += 1
+            else:
+                # Receive into one large reused buffer, never reading past the end of the frame
+                buffer = bytearray(DIRECT_SEGMENT_SIZE)
+                view = memoryview(buffer)
+                while total_received < length:
+                    count = conn.recv_into(view, min(len(buffer), length - total_received))
+                    if not count:
+                        raise ConnectionError(f"Connection closed after {total_received} of {length} bytes")
+                    f.write(view[:count])
+                    total_received += count
+        
+        store_incoming_file(temp_path, addr, os.path.getsize(temp_path))
     except Exception as e:
         network_logger.error(f"Error handling file transfer from {addr}: {e}")
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def recv_exact_or_fail(conn, size):
+    """Receive exactly `size` bytes of a file stream"""
+    data = recv_exact(conn, size)
+    if data is None:
+        raise ConnectionError("Connection closed mid-stream")
+    return data
+
+
+class FlowSink:
+    """Writes the file bytes of a flow stream addressed to us into the file cache, a read's worth of whole chunks at a time"""
+    def __init__(self, packet, sealed):
+        self.file_id = packet.get("id", "")
+        self.source_id = packet.get("src", "unknown")
+        self.filename = packet.get("filename", "unknown")
+        self.total_chunks = packet.get("total_chunks", 0)
+        self.chunk_size = packet_chunk_size(packet)
+        self.chunk_index = 0
+        self.partial = bytearray()  # Start of a chunk split across reads
+        self.complete = False
+        
+        # Same bookkeeping as a chunked transfer, so an interrupted stream can be
+        # resumed with chunks. Sealed segments are authenticated as they arrive;
+        # plain bytes are only trusted once the sender's chunk hashes vouch for them
+        log_file_transfer(self.filename, self.source_id, MY_ID, "STARTED", f"Streaming {packet.get('filesize', 0)} bytes")
+        file_cache.register_file(
+            self.file_id, self.filename, self.total_chunks, packet.get("filesize", 0),
+            self.chunk_size, root=packet_merkle_root(packet), needs_hashes=not sealed
+        )
+    
+    def _write_span(self, data):
+        """Hand a run of whole chunks to the cache, which writes it with one call"""
+        if file_cache.add_file_span(self.file_id, self.chunk_index, data):
+            self.complete = True
+        self.chunk_index += (len(data) + self.chunk_size - 1) // self.chunk_size
+    
+    def feed(self, data):
+        """Take the next bytes of the stream"""
+        view = memoryview(data)
+        if self.partial:
+            needed = self.chunk_size - len(self.partial)
+            self.partial += view[:needed]
+            view = view[needed:]
+            if len(self.partial) < self.chunk_size:
+                return
+            self._write_span(self.partial)
+            self.partial = bytearray()
+        
+        whole = len(view) - len(view) % self.chunk_size
+        if whole:
+            self._write_span(view[:whole])
+        self.partial += view[whole:]
+    
+    def finish(self):
+        """Write the short last chunk and publish the file, returning the status byte for the sender"""
+        if self.partial:
+            self._write_span(self.partial)
+            self.partial = bytearray()
+        
+        # Empty files are complete as soon as they are registered
+        if self.complete or file_cache.is_file_complete(self.file_id):
+            output_path = file_cache.save_complete_file(self.file_id)
+            if output_path:
+                log_file_transfer(self.filename, self.source_id, MY_ID, "COMPLETED", f"Saved to {output_path}")
+        
+        if self.file_id in file_cache.completed:
+            return FLOW_COMPLETE
+        if file_cache.awaits_hashes(self.file_id):
+            return FLOW_UNVERIFIED
+        return FLOW_INCOMPLETE
+
+
+def open_flow_header(envelope):
+    """Authenticate a flow stream's routing header, opening its body only if the flow ends here"""
+    packet = open_envelope(envelope)
+    if packet.get("type") != "file_info":
+        raise EnvelopeError(f"Flow stream opened with a '{packet.get('type')}' packet")
+    if packet.get("dst") == MY_ID:
+        packet, _ = open_body(packet)
+    return packet
+
+def flow_next_hop(packet, source_ip):
+    """Pick the single next hop a relayed flow continues on, and update its routing header"""
+    if packet.get("ttl", 0) <= 1:
+        raise ConnectionError(f"Flow to {packet.get('dst')} ran out of hops")
+    
+    # Without a route the sender falls back to chunks
+    next_hop = forward_next_hop(packet.get("dst"), source_ip)
+    if next_hop is None:
+        raise ConnectionError(f"No unicast route to {packet.get('dst')} for a relayed flow")
+    
+    packet["ttl"] -= 1
+    return next_hop
+
+def handle_flow_stream(conn, addr, length, flags):
+    """Handle a flow stream: write it to disk if it is for us, or pipe it on to the next hop"""
+    header_length = parse_flow_header_length(recv_exact_or_fail(conn, FLOW_HEADER_LENGTH.size))
+    packet = open_flow_header(recv_exact_or_fail(conn, header_length))
+    stream_length = length - FLOW_HEADER_LENGTH.size - header_length
+    
+    if packet.get("dst") != MY_ID:
+        relay_flow_stream(conn, addr, packet, stream_length, flags)
+        return
+    
+    sink = FlowSink(packet, bool(flags & FLAG_SEALED_STREAM))
+    if flags & FLAG_SEALED_STREAM:
+        # Verify and decrypt one sealed segment at a time
+        stream_id = flow_stream_id(packet)
+        received = 0
+        index = 0
+        while received < stream_length:
+            segment_length = parse_segment_length(recv_exact_or_fail(conn, SEGMENT_LENGTH.size))
+            sink.feed(open_segment(stream_id, index, recv_exact_or_fail(conn, segment_length)))
+            received += SEGMENT_LENGTH.size + segment_length
+            index += 1
+    else:
+        buffer = bytearray(DIRECT_SEGMENT_SIZE)
+        view = memoryview(buffer)
+        received = 0
+        while received < stream_length:
+            count = conn.recv_into(view, min(len(buffer), stream_length - received))
+            if not count:
+                raise ConnectionError(f"Connection closed after {received} of {stream_length} bytes")
+            sink.feed(view[:count])
+            received += count
+    
+    conn.sendall(sink.finish())
+
+def relay_flow_stream(conn, addr, packet, stream_length, flags):
+    """Pipe a flow stream to the next hop through one bounded buffer, without parsing it"""
+    next_hop = flow_next_hop(packet, addr[0])
+    downstream = open_flow(next_hop, packet, stream_length, flags)
+    network_logger.info(f"Relaying flow {packet.get('id')} to {packet.get('dst')} via {next_hop}")
+    try:
+        buffer = bytearray(FLOW_BUFFER_SIZE)
+        view = memoryview(buffer)
+        relayed = 0
+        while relayed < stream_length:
+            count = conn.recv_into(view, min(len(buffer), stream_length - relayed))
+            if not count:
+                raise ConnectionError(f"Upstream closed after {relayed} of {stream_length} bytes")
+            rate_limiter.forward.consume(count)
+            rate_limiter.peer(next_hop).consume(count)
+            downstream.sendall(view[:count])
+            relayed += count
         
+        # Pass the destination's verdict back towards the sender
+        downstream.settimeout(FLOW_STATUS_TIMEOUT)
+        conn.sendall(recv_exact(downstream, 1) or FLOW_INCOMPLETE)
     finally:
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
+        downstream.close()
 
-def handle_packet(data, addr, conn=None):
-    """Handle an incoming packet"""
+def is_relay_only(packet):
+    """Check if a packet is addressed to another node and can be relayed without reading its body"""
+    if RELAY_VERIFY_CHUNKS and packet.get("type") in VERIFIED_RELAY_TYPES:
+        return False
+    return packet.get("type") in RELAYED_TYPES and packet.get("dst") not in (MY_ID, "ALL")
+
+def packet_bytes(value):
+    """Raw bytes of a packet's data field; JSON-encoded packets carry it as base64"""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
     try:
+        return base64.b64decode(value)
+    except:
+        return value.encode()
+
+def packet_chunk_size(packet):
+    """Chunk size a file_info or file_chunk packet uses, checked against its chunk count"""
+    chunk_size = packet.get("chunk_size", CHUNK_SIZE)
+    if not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_FRAME_SIZE:
+        raise ValueError(f"Invalid chunk size {chunk_size!r}")
+    if "filesize" in packet and packet.get("total_chunks") != (packet["filesize"] + chunk_size - 1) // chunk_size:
+        raise ValueError(f"{packet.get('total_chunks')} chunks of {chunk_size} bytes don't make {packet['filesize']} bytes")
+    return chunk_size
+
+def packet_merkle_root(packet):
+    """Merkle root of the chunk hashes a file_info packet announces, or None if it has none"""
+    if "merkle_root" not in packet:
+        return None
+    root = bytes.fromhex(packet["merkle_root"])
+    if len(root) != HASH_SIZE:
+        raise ValueError(f"Invalid Merkle root {packet['merkle_root']!r}")
+    return root
+
+def handle_packet(data, addr, received=None):
+    """Handle an incoming packet frame, read off the connection at `received`"""
+    try:
+        received = received or time.time()
+        
         # Get the source IP
         source_ip = addr[0]
         
-        # First, check if this might be binary file data
+        # Authenticate the routing header before any parsing; frames are
+        # complete, so anything that fails here is tampered, corrupt or foreign
         try:
-            # Try to decode as JSON to see if it's a valid packet
-            json_packet = None
+            packet = open_envelope(data)
+        except EnvelopeError as e:
+            network_logger.warning(f"Dropping unauthenticated packet from {source_ip}: {e}")
+            return
+        
+        # Packets we only relay are handled from the header alone; their body
+        # stays sealed and is passed on untouched. With RELAY_VERIFY_CHUNKS on, file
+        # chunks are opened to catch corruption, though the original sealed body is still what's forwarded
+        codec, compression = packet["_envelope"][2:]
+        if not is_relay_only(packet):
             try:
-                # Try to decrypt the data if it's encrypted
-                try:
-                    decrypted_data = decrypt_data(data)
-                    if isinstance(decrypted_data, bytes):
-                        data = decrypted_data
-                    else:
-                        data = decrypted_data.encode()
-                except Exception as e:
-                    network_logger.debug(f"Failed to decrypt packet from {source_ip}, may be binary data: {e}")
-                
-                # Now try to parse as JSON
-                json_packet = json.loads(data.decode('utf-8'))
-                
-            except UnicodeDecodeError:
-                # This is likely binary data, handle as file transfer
-                network_logger.debug(f"Received binary data from {source_ip}, treating as file transfer")
-                handle_file_transfer(conn, addr)
-                return
-            except json.JSONDecodeError:
-                # This is likely binary data, handle as file transfer
-                network_logger.debug(f"Received data that's not valid JSON from {source_ip}, treating as file transfer")
-                handle_file_transfer(conn, addr)
+                packet, codec = open_body(packet)
+            except (DecryptionError, CompressionError, CodecError) as e:
+                network_logger.warning(f"Dropping packet with unreadable body from {source_ip}: {e}")
                 return
-            
-            # If we get here, we have a valid JSON packet
-            packet = json_packet
-            
-            # Extract packet type
-            packet_type = packet.get("type", "unknown")
-            
-            # Handle different packet types
-            if packet_type == "routing":
-                handle_routing_packet(packet, source_ip)
-            elif packet_type == "message":
-                handle_message_packet(packet, source_ip)
-            elif packet_type == "broadcast":
-                handle_broadcast_packet(packet, source_ip)
-            elif packet_type == "file_info":
-                handle_file_info_packet(packet, source_ip)
-            elif packet_type == "file_chunk":
-                handle_file_chunk_packet(packet, source_ip)
-            elif packet_type == "gateway_update":
-                handle_gateway_update(packet, source_ip)
-            elif packet_type == "file":
-                handle_file_transfer(conn, addr)
-            else:
-                network_logger.warning(f"Unknown packet type '{packet_type}' from {source_ip}")
-                
-        except Exception as e:
-            # If all parsing fails, try to handle as a file transfer
-            network_logger.debug(f"Error processing packet data, trying as file transfer: {e}")
-            handle_file_transfer(conn, addr)
+        
+        # Track which encodings this neighbor can handle; a relayed packet's
+        # body and capabilities are its origin's, not the neighbor's
+        if came_direct(packet):
+            if codec == CODEC_BINARY:
+                record_peer_codecs(source_ip, [CODEC_BINARY])
+            if "codecs" in packet:
+                record_peer_codecs(source_ip, packet["codecs"])
+        
+            # And which compressions it can inflate
+            if compression is not None:
+                record_peer_compressions(source_ip, [compression])
+            if "compressions" in packet:
+                record_peer_compressions(source_ip, packet["compressions"])
+        
+        # Extract packet type
+        packet_type = packet.get("type", "unknown")
+        
+        # Handle different packet types
+        if packet_type == "routing":
+            handle_routing_packet(packet, source_ip)
+        elif packet_type == "message":
+            handle_message_packet(packet, source_ip)
+        elif packet_type == "broadcast":
+            handle_broadcast_packet(packet, source_ip)
+        elif packet_type == "file_info":
+            handle_file_info_packet(packet, source_ip)
+        elif packet_type == "file_hashes":
+            handle_file_hashes_packet(packet, source_ip)
+        elif packet_type == "file_chunk":
+            handle_file_chunk_packet(packet, source_ip)
+        elif packet_type == "gateway_update":
+            handle_gateway_update(packet, source_ip)
+        elif packet_type == "file_have_query":
+            handle_file_have_query_packet(packet, source_ip)
+        elif packet_type == "file_have_map":
+            handle_file_have_map_packet(packet, source_ip)
+        elif packet_type == "file_ack":
+            handle_file_ack_packet(packet, source_ip)
+        elif packet_type == "probe":
+            handle_probe(packet, source_ip, received)
+        elif packet_type == "probe_reply":
+            handle_probe_reply(packet, source_ip, received)
+        else:
+            network_logger.warning(f"Unknown packet type '{packet_type}' from {source_ip}")
             
     except Exception as e:
         network_logger.error(f"Error handling packet from {addr}: {e}")
@@ -137,16 +356,14 @@ def handle_routing_packet(packet, source_ip):
         link_state = packet.get("link_state", {})
         seq_num = packet.get("seq", 0)
         ttl = packet.get("ttl", 0)
+        scope = packet.get("scope")
         
-        # Update routing table
-        was_updated = router.update_link_state(source_id, source_ip, link_state, seq_num, ttl)
+        # Merge the link state into our topology
+        router.update_link_state(source_id, source_ip, link_state, seq_num, ttl, direct=came_direct(packet), scope=scope)
         
-        # Forward if TTL allows and it was a new update
-        if was_updated and ttl > 1:
-            # Decrease TTL
-            packet["ttl"] = ttl - 1
-            
-            # Forward to all neighbors except the source
+        # Scoped updates carry only their origin's link state and flood on
+        # until their TTL runs out; older peers send whole tables instead
+        if scope:
             forward_packet(packet, source_ip)
         
     except Exception as e:
@@ -214,18 +431,63 @@ def handle_file_info_packet(packet, source_ip):
         filesize = packet.get("filesize", 0)
         total_chunks = packet.get("total_chunks", 0)
         
+        try:
+            chunk_size = packet_chunk_size(packet)
+            root = packet_merkle_root(packet)
+        except ValueError as e:
+            network_logger.warning(f"Dropping file info for {file_id} from {source_ip}: {e}")
+            return
+        
         # If we are the intended recipient
         if dest_id == MY_ID:
             log_file_transfer(filename, source_id, MY_ID, "STARTED", 
                              f"Size: {filesize} bytes, Chunks: {total_chunks}")
             network_logger.info(f"Receiving file {filename} from {source_id}")
+            
+            # Allocate the partial file so chunks are written straight to disk
+            file_cache.register_file(file_id, filename, total_chunks, filesize, chunk_size, root=root)
+            
+            # Empty files have no chunks to wait for
+            if file_cache.is_file_complete(file_id):
+                output_path = file_cache.save_complete_file(file_id)
+                if output_path:
+                    log_file_transfer(filename, source_id, MY_ID, "COMPLETED", f"Saved to {output_path}")
         else:
+            # Collect the hashes that follow so the chunks can be checked on the way through
+            if root is not None and RELAY_VERIFY_CHUNKS:
+                chunk_hash_cache.expect(file_id, total_chunks, root)
+            
             # Forward if needed
             forward_packet(packet, source_ip)
             
     except Exception as e:
         network_logger.error(f"Error handling file info packet: {e}")
 
+def handle_file_hashes_packet(packet, source_ip):
+    """Handle a batch of a file's chunk hashes, sent after its file info"""
+    try:
+        source_id = packet.get("src", "unknown")
+        file_id = packet.get("file_id", "")
+        start = packet.get("start", 0)
+        
+        if packet.get("dst") != MY_ID:
+            if "data" in packet:
+                chunk_hash_cache.add(file_id, start, packet_bytes(packet["data"]))
+            forward_packet(packet, source_ip)
+            return
+        
+        # The last batch may complete a file whose chunks all arrived first
+        chunk_size = packet_chunk_size(packet)
+        if file_cache.add_file_hashes(file_id, start, packet_bytes(packet.get("data", b"")), packet.get("total_chunks", 0), chunk_size):
+            # A duplicate chunk handled by another worker may have saved it already
+            filename = file_cache.get_pending_files().get(file_id, {}).get("filename")
+            output_path = file_cache.save_complete_file(file_id)
+            if output_path:
+                log_file_transfer(filename, source_id, MY_ID, "COMPLETED", f"Saved to {output_path}")
+    
+    except Exception as e:
+        network_logger.error(f"Error handling file hashes: {e}")
+
 def handle_file_chunk_packet(packet, source_ip):
     """Handle a file chunk packet"""
     try:
@@ -238,30 +500,111 @@ def handle_file_chunk_packet(packet, source_ip):
         
         # If we are the intended recipient
         if dest_id == MY_ID:
-            # Decode base64 chunk data
-            try:
-                binary_data = base64.b64decode(chunk_data)
-            except:
-                binary_data = chunk_data.encode() if isinstance(chunk_data, str) else chunk_data
+            # Binary-encoded chunks carry raw bytes; JSON ones are base64
+            binary_data = packet_bytes(chunk_data)
             
             # Get filename from packet or use file_id
             filename = packet.get("filename", f"received_{file_id}.bin")
             
             # Add chunk to file cache
-            is_complete = file_cache.add_file_chunk(file_id, chunk_index, binary_data, total_chunks, filename)
+            chunk_size = packet_chunk_size(packet)
+            is_complete = file_cache.add_file_chunk(
+                file_id, chunk_index, binary_data, total_chunks, filename, chunk_size, packet.get("ack_now", False)
+            )
             
             # If file is complete, save it
             if is_complete:
                 output_path = file_cache.save_complete_file(file_id)
                 if output_path:
                     log_file_transfer(filename, source_id, MY_ID, "COMPLETED", f"Saved to {output_path}")
+            
+            # Let the sender's window advance
+            send_file_ack(file_id, source_id, source_ip)
         else:
+            # Don't carry a corrupt chunk any further; the receiver will ask for it again
+            if "data" in packet and not chunk_hash_cache.check(file_id, chunk_index, packet_bytes(chunk_data)):
+                network_logger.warning(f"Dropping corrupt chunk {chunk_index} of {file_id} from {source_ip}")
+                return
+            
             # Forward if needed
             forward_packet(packet, source_ip)
             
     except Exception as e:
         network_logger.error(f"Error handling file chunk packet: {e}")
 
+def send_file_ack(file_id, source_id, source_ip):
+    """Acknowledge received chunks of a file if an acknowledgement is due"""
+    ack = file_cache.take_ack(file_id)
+    if ack is None:
+        return
+    
+    ack_packet = {
+        "type": "file_ack",
+        "file_id": file_id,
+        "src": MY_ID,
+        "dst": source_id,
+        "ttl": MAX_TTL
+    }
+    ack_packet.update(ack)
+    
+    # Answer along the path the chunks came in on
+    send_packet(source_ip, ack_packet, retry=1, wait=False)
+
+def handle_file_ack_packet(packet, source_ip):
+    """Pass a receiver's acknowledgement to the transfer it belongs to"""
+    try:
+        if packet.get("dst") != MY_ID:
+            forward_packet(packet, source_ip)
+            return
+        
+        deliver_file_ack(packet)
+            
+    except Exception as e:
+        network_logger.error(f"Error handling file ack: {e}")
+
+def handle_file_have_query_packet(packet, source_ip):
+    """Tell a sender which chunks of a file we already hold so it can resume"""
+    try:
+        source_id = packet.get("src", "unknown")
+        dest_id = packet.get("dst", "unknown")
+        file_id = packet.get("file_id", "")
+        
+        if dest_id != MY_ID:
+            forward_packet(packet, source_ip)
+            return
+        
+        have_map = file_cache.get_have_map(file_id)
+        reply = {
+            "type": "file_have_map",
+            "file_id": file_id,
+            "src": MY_ID,
+            "dst": source_id,
+            "complete": bool(have_map and have_map["complete"]),
+            "ttl": MAX_TTL
+        }
+        if have_map and not have_map["complete"]:
+            reply["total_chunks"] = have_map["total_chunks"]
+            reply["chunk_size"] = have_map["chunk_size"]
+            reply["data"] = have_map["bitmap"]
+        
+        # Answer along the path the query came in on
+        send_packet(source_ip, reply, retry=2, wait=False)
+            
+    except Exception as e:
+        network_logger.error(f"Error handling file have-map query: {e}")
+
+def handle_file_have_map_packet(packet, source_ip):
+    """Pass a receiver's have-map to the transfer waiting for it"""
+    try:
+        if packet.get("dst") != MY_ID:
+            forward_packet(packet, source_ip)
+            return
+        
+        deliver_have_map(packet)
+            
+    except Exception as e:
+        network_logger.error(f"Error handling file have-map: {e}")
+
 # Optional: Implement a thread that periodically cleans up old cached messages and files
 def start_cleanup_thread():
     """Start a thread to periodically clean up old cached items"""
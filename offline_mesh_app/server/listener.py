@@ -1,52 +1,274 @@
+import os
+import queue
 import socket
+import asyncio
 import threading
-from server.handler import handle_packet
-from config import PORT, BUFFER_SIZE, MY_IP
+import time
+from concurrent.futures import ThreadPoolExecutor
+from server.handler import (
+    handle_file_transfer, open_incoming_file, store_incoming_file,
+    handle_flow_stream, open_flow_header, flow_next_hop, FlowSink
+)
+from server.dispatcher import ingress_dispatcher
+from client.sender import encode_flow_header
+from client.rate_limit import rate_limiter
+from config import (
+    PORT, MY_ID, MY_IP, SERVER_MODE, SERVER_IDLE_TIMEOUT, STREAM_WORKERS, DIRECT_SEGMENT_SIZE, FLOW_STATUS_TIMEOUT
+)
+from utils.framing import (
+    FRAME_PACKET, FRAME_FILE_STREAM, FRAME_FLOW_STREAM, FLAG_SEALED_STREAM,
+    FrameError, read_frame_header, recv_exact, read_frame_header_async
+)
+from utils.file_stream import (
+    SEGMENT_LENGTH, STREAM_ID_SIZE, FLOW_HEADER_LENGTH, FLOW_INCOMPLETE,
+    parse_segment_length, parse_flow_header_length, open_segment, flow_stream_id
+)
 from utils.logger import network_logger
 
+# Decryption and disk writes for streams received on the event loop; each
+# stream waits for its last step before reading on, so a stream has at most
+# one segment queued here and the loop stays free for other connections
+stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="stream")
+
+# Readers on the event loop that find the ingress queue full wait for space
+# here, one at a time, so their packets are queued in the order they arrived
+ingress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingress-wait")
+
 def handle_connection(conn, addr):
-    """Handle a single client connection"""
+    """Handle a client connection, processing frames until the peer closes it"""
     try:
         # Log the incoming connection for debugging
         network_logger.info(f"Received connection from {addr[0]}:{addr[1]}")
         
-        # Set a timeout to avoid hanging
-        conn.settimeout(5)
-        
-        # Collect all data (may be in multiple parts)
-        data = b''
         while True:
+            # Wait for the next frame; pooled senders keep the connection open between frames
+            conn.settimeout(SERVER_IDLE_TIMEOUT)
             try:
-                chunk = conn.recv(BUFFER_SIZE)
-                if not chunk:
-                    break
-                data += chunk
-                
-                # If size is less than buffer, we likely have all the data
-                if len(chunk) < BUFFER_SIZE:
-                    break
+                header = read_frame_header(conn)
             except socket.timeout:
-                # Timeout reached, process what we have
-                network_logger.debug(f"Connection timeout from {addr[0]}, processing available data")
+                network_logger.debug(f"Closing idle connection from {addr[0]}")
                 break
-        
-        if data:
-            network_logger.debug(f"Received {len(data)} bytes from {addr[0]}")
-            # Process the packet in a separate thread to avoid blocking
-            threading.Thread(
-                target=handle_packet, 
-                args=(data, addr, conn), 
-                daemon=True
-            ).start()
-        else:
-            network_logger.warning(f"Empty data received from {addr[0]}")
+            if header is None:
+                break
+            
+            frame_type, flags, length = header
+            
+            # Set a timeout so a stalled peer can't hold a half-sent frame forever
+            conn.settimeout(5)
+            
+            if frame_type == FRAME_FILE_STREAM:
+                # Stream the file straight to disk on this connection
+                conn.settimeout(10)  # Longer timeout for file transfer
+                handle_file_transfer(conn, addr, length, flags)
+            elif frame_type == FRAME_FLOW_STREAM:
+                # Write it to disk, or pipe it on if it is for another node
+                conn.settimeout(10)
+                handle_flow_stream(conn, addr, length, flags)
+            elif frame_type == FRAME_PACKET:
+                data = recv_exact(conn, length)
+                if not data:
+                    network_logger.warning(f"Empty packet frame received from {addr[0]}")
+                    continue
+                
+                network_logger.debug(f"Received {len(data)} bytes from {addr[0]}")
+                # Queue the packet for the worker pool; this blocks when it is overloaded
+                ingress_dispatcher.submit(flags, data, addr, time.time())
+            else:
+                # The payload can't be skipped safely without knowing its meaning
+                network_logger.warning(f"Unknown frame type {frame_type} from {addr[0]}, closing connection")
+                break
+    except FrameError as e:
+        network_logger.warning(f"Invalid frame from {addr[0]}: {e}")
     except Exception as e:
         network_logger.error(f"Error handling connection from {addr}: {e}")
     finally:
         conn.close()
 
+async def run_in_stream_executor(func, *args):
+    """Run blocking stream work off the event loop and wait for it"""
+    return await asyncio.get_running_loop().run_in_executor(stream_executor, func, *args)
+
+def write_segment(f, stream_id, index, segment):
+    """Verify, decrypt and write one sealed segment of a file stream"""
+    f.write(open_segment(stream_id, index, segment))
+
+def feed_segment(sink, stream_id, index, segment):
+    """Verify and decrypt one sealed segment of a flow stream and hand it to its sink"""
+    sink.feed(open_segment(stream_id, index, segment))
+
+async def receive_file_stream_async(reader, addr, length, flags=0):
+    """Stream a file frame from the event loop to disk"""
+    temp_path = open_incoming_file(addr)
+    total_received = 0
+    try:
+        f = await run_in_stream_executor(open, temp_path, "wb")
+        try:
+            if flags & FLAG_SEALED_STREAM:
+                # Verify and decrypt one sealed segment at a time
+                stream_id = await asyncio.wait_for(reader.readexactly(STREAM_ID_SIZE), timeout=10)
+                total_received = STREAM_ID_SIZE
+                index = 0
+                while total_received < length:
+                    header = await asyncio.wait_for(reader.readexactly(SEGMENT_LENGTH.size), timeout=10)
+                    segment_length = parse_segment_length(header)
+                    segment = await asyncio.wait_for(reader.readexactly(segment_length), timeout=10)
+                    await run_in_stream_executor(write_segment, f, stream_id, index, segment)
+                    total_received += SEGMENT_LENGTH.size + segment_length
+                    index += 1
+            else:
+                while total_received < length:
+                    chunk = await asyncio.wait_for(reader.read(min(DIRECT_SEGMENT_SIZE, length - total_received)), timeout=10)
+                    if not chunk:
+                        raise ConnectionError(f"Connection closed after {total_received} of {length} bytes")
+                    await run_in_stream_executor(f.write, chunk)
+                    total_received += len(chunk)
+        finally:
+            await run_in_stream_executor(f.close)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    
+    await run_in_stream_executor(store_incoming_file, temp_path, addr, os.path.getsize(temp_path))
+
+async def receive_flow_stream_async(reader, writer, addr, length, flags):
+    """Handle a flow stream from the event loop: write it to disk, or pipe it on to the next hop"""
+    header_length = parse_flow_header_length(await asyncio.wait_for(reader.readexactly(FLOW_HEADER_LENGTH.size), timeout=10))
+    packet = open_flow_header(await asyncio.wait_for(reader.readexactly(header_length), timeout=10))
+    stream_length = length - FLOW_HEADER_LENGTH.size - header_length
+    
+    if packet.get("dst") != MY_ID:
+        await relay_flow_stream_async(reader, writer, addr, packet, stream_length, flags)
+        return
+    
+    # The sink hashes and writes to the file cache, so it runs on the stream executor
+    sink = await run_in_stream_executor(FlowSink, packet, bool(flags & FLAG_SEALED_STREAM))
+    received = 0
+    if flags & FLAG_SEALED_STREAM:
+        # Verify and decrypt one sealed segment at a time
+        stream_id = flow_stream_id(packet)
+        index = 0
+        while received < stream_length:
+            header = await asyncio.wait_for(reader.readexactly(SEGMENT_LENGTH.size), timeout=10)
+            segment_length = parse_segment_length(header)
+            segment = await asyncio.wait_for(reader.readexactly(segment_length), timeout=10)
+            await run_in_stream_executor(feed_segment, sink, stream_id, index, segment)
+            received += SEGMENT_LENGTH.size + segment_length
+            index += 1
+    else:
+        while received < stream_length:
+            chunk = await asyncio.wait_for(reader.read(min(DIRECT_SEGMENT_SIZE, stream_length - received)), timeout=10)
+            if not chunk:
+                raise ConnectionError(f"Connection closed after {received} of {stream_length} bytes")
+            await run_in_stream_executor(sink.feed, chunk)
+            received += len(chunk)
+    
+    writer.write(await run_in_stream_executor(sink.finish))
+    await writer.drain()
+
+async def relay_flow_stream_async(reader, writer, addr, packet, stream_length, flags):
+    """Pipe a flow stream to the next hop; drain() keeps at most a socket buffer in memory"""
+    # Route lookups wait on the router's lock and the header is resealed, so
+    # neither runs on the loop
+    next_hop = await run_in_stream_executor(flow_next_hop, packet, addr[0])
+    header = await run_in_stream_executor(encode_flow_header, next_hop, packet, stream_length, flags)
+    down_reader, down_writer = await asyncio.wait_for(asyncio.open_connection(next_hop, PORT), timeout=10)
+    network_logger.info(f"Relaying flow {packet.get('id')} to {packet.get('dst')} via {next_hop}")
+    try:
+        down_writer.write(header)
+        relayed = 0
+        while relayed < stream_length:
+            chunk = await asyncio.wait_for(reader.read(min(DIRECT_SEGMENT_SIZE, stream_length - relayed)), timeout=10)
+            if not chunk:
+                raise ConnectionError(f"Upstream closed after {relayed} of {stream_length} bytes")
+            
+            # Hold the flow to the forwarding and next-hop limits without blocking the loop
+            delay = max(rate_limiter.forward.reserve(len(chunk)), rate_limiter.peer(next_hop).reserve(len(chunk)))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            down_writer.write(chunk)
+            await asyncio.wait_for(down_writer.drain(), timeout=10)
+            relayed += len(chunk)
+        
+        # Pass the destination's verdict back towards the sender
+        status = await asyncio.wait_for(down_reader.read(1), timeout=FLOW_STATUS_TIMEOUT)
+        writer.write(status or FLOW_INCOMPLETE)
+        await writer.drain()
+    finally:
+        down_writer.close()
+
+async def handle_connection_async(reader, writer):
+    """Handle a client connection on the event loop, processing frames until it closes"""
+    addr = writer.get_extra_info("peername")
+    try:
+        network_logger.info(f"Received connection from {addr[0]}:{addr[1]}")
+        
+        while True:
+            # Wait for the next frame; pooled senders keep the connection open between frames
+            try:
+                header = await asyncio.wait_for(read_frame_header_async(reader), timeout=SERVER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                network_logger.debug(f"Closing idle connection from {addr[0]}")
+                break
+            if header is None:
+                break
+            
+            frame_type, flags, length = header
+            
+            if frame_type == FRAME_FILE_STREAM:
+                await receive_file_stream_async(reader, addr, length, flags)
+            elif frame_type == FRAME_FLOW_STREAM:
+                await receive_flow_stream_async(reader, writer, addr, length, flags)
+            elif frame_type == FRAME_PACKET:
+                data = await asyncio.wait_for(reader.readexactly(length), timeout=5)
+                if not data:
+                    network_logger.warning(f"Empty packet frame received from {addr[0]}")
+                    continue
+                
+                network_logger.debug(f"Received {len(data)} bytes from {addr[0]}")
+                # Queue the packet for the worker pool; when it is full, wait for
+                # space on the ingress thread so the loop keeps serving other connections
+                received = time.time()
+                try:
+                    ingress_dispatcher.submit(flags, data, addr, received, block=False)
+                except queue.Full:
+                    await asyncio.get_running_loop().run_in_executor(ingress_executor, ingress_dispatcher.submit, flags, data, addr, received)
+            else:
+                # The payload can't be skipped safely without knowing its meaning
+                network_logger.warning(f"Unknown frame type {frame_type} from {addr[0]}, closing connection")
+                break
+    except FrameError as e:
+        network_logger.warning(f"Invalid frame from {addr[0]}: {e}")
+    except Exception as e:
+        network_logger.error(f"Error handling connection from {addr}: {e}")
+    finally:
+        writer.close()
+
+async def serve_async():
+    """Accept and read connections on a single event loop"""
+    server = await asyncio.start_server(handle_connection_async, host='', port=PORT, reuse_address=True, backlog=128)
+    
+    network_logger.info(f"Async server listening on port {PORT} with IP {MY_IP}")
+    network_logger.info(f"Ready to accept connections from other peers")
+    
+    async with server:
+        await server.serve_forever()
+
+def start_async_server():
+    """Start the asyncio-based TCP server"""
+    try:
+        asyncio.run(serve_async())
+    except Exception as e:
+        network_logger.error(f"Async server error: {e}")
+
 def start_server():
     """Start the TCP server to listen for incoming packets"""
+    # Start the workers that handle received packets
+    ingress_dispatcher.start()
+    
+    if SERVER_MODE == "asyncio":
+        start_async_server()
+        return
+    
     try:
         # Create socket
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
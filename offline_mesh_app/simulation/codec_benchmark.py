@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import argparse
+
+# Add the application directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
+from Crypto.Random import get_random_bytes
+from config import CHUNK_SIZE, AES_KEY
+from utils.codec import CODEC_JSON, CODEC_BINARY
+from utils.envelope import seal_packet, open_envelope, open_body
+from utils.framing import encode_frame
+
+
+def make_chunk_packet(chunk):
+    """Build a file_chunk packet the way send_file does"""
+    return {
+        "type": "file_chunk",
+        "file_id": str(uuid.uuid4()),
+        "src": "a1b2c3d4",
+        "dst": "e5f6a7b8",
+        "chunk_index": 42,
+        "total_chunks": 1000,
+        "data": chunk,
+        "ttl": 3,
+        "timestamp": time.time(),
+        "multi_hop": True
+    }
+
+
+def make_message_packet():
+    """Build a message packet the way send_message does"""
+    return {
+        "type": "message",
+        "id": str(uuid.uuid4()),
+        "src": "a1b2c3d4",
+        "src_ip": "192.168.1.20",
+        "dst": "e5f6a7b8",
+        "content": "Meet at the north gate at 5",
+        "message_type": "text",
+        "ttl": 3,
+        "timestamp": time.time(),
+        "hops": [],
+        "multi_hop": True
+    }
+
+
+def legacy_encrypt(data):
+    """Original encryption: AES-CBC with PKCS7 padding, base64-encoded"""
+    iv = get_random_bytes(16)
+    cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
+    return base64.b64encode(iv + cipher.encrypt(pad(data, AES.block_size)))
+
+
+def legacy_decrypt(data):
+    """Original decryption: base64-decode, AES-CBC, unpad"""
+    raw = base64.b64decode(data)
+    cipher = AES.new(AES_KEY, AES.MODE_CBC, raw[:16])
+    return unpad(cipher.decrypt(raw[16:]), AES.block_size)
+
+
+def legacy_encode(packet):
+    """Original path: base64 chunk inside JSON, then encrypt"""
+    packet = dict(packet)
+    if isinstance(packet.get("data"), bytes):
+        packet["data"] = base64.b64encode(packet["data"]).decode('utf-8')
+    return legacy_encrypt(json.dumps(packet).encode('utf-8'))
+
+
+def legacy_decode(data):
+    """Original path: decrypt, parse JSON, decode base64 chunk"""
+    packet = json.loads(legacy_decrypt(data))
+    if "data" in packet:
+        packet["data"] = base64.b64decode(packet["data"])
+    return packet
+
+
+def codec_encode(packet, codec):
+    """New path: routing header plus body encoded with the codec and sealed"""
+    return seal_packet(packet, codec)
+
+
+def codec_decode(data):
+    """New path: verify the header, then decrypt and decode the body"""
+    packet, _ = open_body(open_envelope(data))
+    if isinstance(packet.get("data"), str):
+        packet["data"] = base64.b64decode(packet["data"])
+    return packet
+
+
+def time_per_call(func, arg, iterations):
+    """Average time per call in microseconds"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run_benchmark(packet, label, iterations):
+    """Print wire size and encode/decode time for each encoding of a packet"""
+    variants = [
+        ("legacy json+cbc", legacy_encode, legacy_decode),
+        ("json codec", lambda p: codec_encode(p, CODEC_JSON), codec_decode),
+        ("binary codec", lambda p: codec_encode(p, CODEC_BINARY), codec_decode)
+    ]
+    
+    print(f"\n{label}")
+    print(f"{'encoding':<22}{'wire bytes':>12}{'encode us':>12}{'decode us':>12}")
+    for name, encode, decode in variants:
+        wire = encode_frame(encode(packet))
+        encoded = encode(packet)
+        encode_us = time_per_call(encode, packet, iterations)
+        decode_us = time_per_call(decode, encoded, iterations)
+        print(f"{name:<22}{len(wire):>12}{encode_us:>12.1f}{decode_us:>12.1f}")
+
+
+def legacy_relay(data):
+    """Original relay: decrypt and parse, update the route fields, re-encode and re-encrypt"""
+    packet = legacy_decode(data)
+    packet["ttl"] -= 1
+    return legacy_encode(packet)
+
+
+def envelope_relay(data):
+    """Envelope relay: verify and rewrite the routing header, pass the body through"""
+    packet = open_envelope(data)
+    packet["ttl"] -= 1
+    return seal_packet(packet, packet["_envelope"][2])
+
+
+def run_relay_benchmark(packet, label, iterations):
+    """Print the per-hop cost of forwarding a packet"""
+    print(f"\n{label}")
+    print(f"{'relay':<22}{'us per hop':>12}")
+    for name, encode, relay in [
+        ("legacy re-encrypt", legacy_encode, legacy_relay),
+        ("envelope passthrough", lambda p: codec_encode(p, CODEC_BINARY), envelope_relay)
+    ]:
+        print(f"{name:<22}{time_per_call(relay, encode(packet), iterations):>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare packet encodings")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    
+    chunk = os.urandom(args.chunk_size)
+    run_benchmark(make_chunk_packet(chunk), f"file_chunk with {args.chunk_size}-byte payload", args.iterations)
+    run_benchmark(make_message_packet(), "text message", args.iterations)
+    run_relay_benchmark(make_chunk_packet(chunk), f"relaying file_chunk with {args.chunk_size}-byte payload", args.iterations)
@@ -0,0 +1,305 @@
+import os
+import sys
+import math
+import heapq
+import random
+import argparse
+
+# Add the application directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import MAX_TTL, HSLS_SLOT, HSLS_LEVELS, HSLS_TRIGGER_HOLDDOWN
+from routing.hsls import LOCAL_SCOPE, scope_for_slot
+from utils.codec import CODEC_BINARY, LOCAL_CODECS
+from utils.compression import LOCAL_COMPRESSIONS
+from utils.envelope import seal_packet
+from utils.framing import encode_frame
+
+HOP_DELAY = 0.005  # Seconds a packet takes to cross one link
+
+
+def make_topology(nodes, rng):
+    """Build a connected mesh: a grid of nodes with some diagonal links, returning {node_id: set of neighbor ids} and {node_id: ip}"""
+    side = math.ceil(math.sqrt(nodes))
+    ids = [f"{rng.getrandbits(32):08x}" for _ in range(nodes)]
+    graph = {node_id: set() for node_id in ids}
+    
+    def connect(a, b):
+        graph[ids[a]].add(ids[b])
+        graph[ids[b]].add(ids[a])
+    
+    for index in range(nodes):
+        x, y = index % side, index // side
+        if x + 1 < side and index + 1 < nodes:
+            connect(index, index + 1)
+        if index + side < nodes:
+            connect(index, index + side)
+        if x + 1 < side and index + side + 1 < nodes and rng.random() < 0.3:
+            connect(index, index + side + 1)
+    
+    ips = {node_id: f"10.0.{index // 250}.{index % 250 + 1}" for index, node_id in enumerate(ids)}
+    return graph, ips
+
+
+def hop_distances(graph, source):
+    """Hop count from a node to every node it can reach"""
+    distances = {source: 0}
+    frontier = [source]
+    while frontier:
+        next_frontier = []
+        for node_id in frontier:
+            for neighbor_id in graph[node_id]:
+                if neighbor_id not in distances:
+                    distances[neighbor_id] = distances[node_id] + 1
+                    next_frontier.append(neighbor_id)
+        frontier = next_frontier
+    return distances
+
+
+def link_state_entry(graph, ips, node_id, seq):
+    """A node's entry in a routing update, as Router.get_link_state builds it"""
+    return {
+        "ip": ips[node_id],
+        "seq": seq,
+        "neighbors": [ips[neighbor_id] for neighbor_id in graph[node_id]],
+        "links": {neighbor_id: 1.0 for neighbor_id in graph[node_id]},
+        "bridges": False,
+        "is_gateway": False
+    }
+
+
+def wire_size(node_id, link_state, seq, ttl, scope=None):
+    """Bytes a routing update takes on the wire, built the way broadcast_routing_update does"""
+    packet = {
+        "type": "routing",
+        "id": f"{seq:08x}{node_id}",
+        "src": node_id,
+        "link_state": link_state,
+        "seq": seq,
+        "ttl": ttl,
+        "timestamp": 0.0,
+        "codecs": LOCAL_CODECS,
+        "compressions": LOCAL_COMPRESSIONS
+    }
+    if scope is not None:
+        packet.update({"scope": scope, "hops": [], "multi_hop": True})
+    return len(encode_frame(seal_packet(packet, CODEC_BINARY)))
+
+
+class Simulation:
+    """Routing updates spreading through a mesh under the flat or the HSLS schedule"""
+    def __init__(self, graph, ips, scheme, rng):
+        self.graph = graph
+        self.ips = ips
+        self.scheme = scheme
+        self.events = []
+        self.counter = 0
+        self.now = 0.0
+        self.seq = {node_id: 0 for node_id in graph}
+        self.known = {node_id: {} for node_id in graph}  # {node_id: {origin: (seq, time learnt)}}
+        self.seen = {node_id: set() for node_id in graph}  # Update ids a node has handled, for flooding
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        
+        # A relayed update grows by one hop entry in its header
+        sample = next(iter(graph))
+        self.hop_bytes = len(encode_frame(seal_packet({"type": "routing", "src": sample, "ttl": 1, "hops": [sample]}, CODEC_BINARY)))
+        self.hop_bytes -= len(encode_frame(seal_packet({"type": "routing", "src": sample, "ttl": 1, "hops": []}, CODEC_BINARY)))
+        
+        # Nodes start their schedules at random points in a slot
+        for node_id in graph:
+            self.schedule(rng.uniform(0, HSLS_SLOT), "slot", (node_id, 1))
+    
+    def schedule(self, delay, kind, args):
+        """Queue an event `delay` seconds from now"""
+        self.counter += 1
+        heapq.heappush(self.events, (self.now + delay, self.counter, kind, args))
+    
+    def run_until(self, end, stop=None):
+        """Process events up to a time, or until `stop` returns True"""
+        while self.events and self.events[0][0] <= end:
+            self.now, _, kind, args = heapq.heappop(self.events)
+            if kind == "slot":
+                node_id, slot = args
+                self.send_update(node_id, slot)
+                self.schedule(HSLS_SLOT, "slot", (node_id, slot + 1))
+            elif kind == "trigger":
+                self.originate(args[0], LOCAL_SCOPE)
+            elif kind == "receive":
+                self.receive(*args)
+            if stop is not None and stop():
+                return True
+        self.now = end
+        return False
+    
+    def learn(self, node_id, origin, seq):
+        """Record a link state at a node if it's newer than the one it holds"""
+        held = self.known[node_id].get(origin)
+        if origin != node_id and (held is None or seq > held[0]):
+            self.known[node_id][origin] = (seq, self.now)
+    
+    def send_update(self, node_id, slot):
+        """A node's regular update: its whole table to each neighbor, or its own link state scoped by the slot"""
+        if self.scheme == "hsls":
+            self.originate(node_id, scope_for_slot(slot))
+            return
+        
+        self.seq[node_id] += 1
+        entries = {origin: seq for origin, (seq, _) in self.known[node_id].items()}
+        entries[node_id] = self.seq[node_id]
+        link_state = {origin: link_state_entry(self.graph, self.ips, origin, seq) for origin, seq in entries.items()}
+        size = wire_size(node_id, link_state, self.seq[node_id], MAX_TTL)
+        for neighbor_id in self.graph[node_id]:
+            self.bytes_sent += size
+            self.packets_sent += 1
+            self.schedule(HOP_DELAY, "receive", (neighbor_id, node_id, entries, 0, None, size))
+    
+    def originate(self, node_id, scope):
+        """Flood a node's own link state up to `scope` hops out"""
+        self.seq[node_id] += 1
+        seq = self.seq[node_id]
+        link_state = {node_id: link_state_entry(self.graph, self.ips, node_id, seq)}
+        size = wire_size(node_id, link_state, seq, scope, scope)
+        update_id = (node_id, seq)
+        self.seen[node_id].add(update_id)
+        for neighbor_id in self.graph[node_id]:
+            self.bytes_sent += size
+            self.packets_sent += 1
+            self.schedule(HOP_DELAY, "receive", (neighbor_id, node_id, {node_id: seq}, scope, update_id, size))
+    
+    def receive(self, node_id, sender_id, entries, ttl, update_id, size):
+        """Merge an update at a node, flooding scoped ones on while their TTL lasts"""
+        # The link may have gone while the packet was in flight
+        if sender_id not in self.graph[node_id]:
+            return
+        for origin, seq in entries.items():
+            self.learn(node_id, origin, seq)
+        
+        if update_id is None or update_id in self.seen[node_id]:
+            return
+        self.seen[node_id].add(update_id)
+        if ttl - 1 <= 0:
+            return
+        size += self.hop_bytes
+        for neighbor_id in self.graph[node_id]:
+            if neighbor_id != sender_id:
+                self.bytes_sent += size
+                self.packets_sent += 1
+                self.schedule(HOP_DELAY, "receive", (neighbor_id, node_id, entries, ttl - 1, update_id, size))
+    
+    def change_link(self, a, b, add):
+        """Add or remove a link; its ends notice at once, and under HSLS tell the nodes nearby"""
+        if add:
+            self.graph[a].add(b)
+            self.graph[b].add(a)
+        else:
+            self.graph[a].discard(b)
+            self.graph[b].discard(a)
+        if self.scheme == "hsls":
+            for node_id in (a, b):
+                self.schedule(HSLS_TRIGGER_HOLDDOWN, "trigger", (node_id,))
+        return {node_id: self.seq[node_id] + 1 for node_id in (a, b)}
+
+
+def pick_change(graph, rng):
+    """Pick a link to remove without splitting the mesh, or two nodes two hops apart to link"""
+    if rng.random() < 0.5:
+        links = sorted((a, b) for a in graph for b in graph[a] if a < b)
+        rng.shuffle(links)
+        for a, b in links:
+            graph[a].discard(b)
+            graph[b].discard(a)
+            connected = len(hop_distances(graph, a)) == len(graph)
+            graph[a].add(b)
+            graph[b].add(a)
+            if connected:
+                return a, b, False
+    
+    nodes = sorted(graph)
+    rng.shuffle(nodes)
+    for a in nodes:
+        candidates = sorted(node_id for node_id, hops in hop_distances(graph, a).items() if hops == 2)
+        if candidates:
+            return a, rng.choice(candidates), True
+    return None
+
+
+def run_trial(nodes, scheme, seed):
+    """Measure a scheme's steady-state overhead and how long a link change takes to reach the nodes routing over it"""
+    rng = random.Random(seed)
+    graph, ips = make_topology(nodes, rng)
+    diameter = max(max(hop_distances(graph, node_id).values()) for node_id in graph)
+    cycle = 1 << (HSLS_LEVELS - 1)  # Slots before the HSLS schedule repeats
+    
+    sim = Simulation(graph, ips, scheme, random.Random(seed + 1))
+    warmup = (max(diameter, cycle) + 2) * HSLS_SLOT
+    sim.run_until(warmup)
+    
+    # Overhead over whole schedule cycles with nothing changing
+    window = 2 * cycle * HSLS_SLOT
+    start_bytes, start_packets = sim.bytes_sent, sim.packets_sent
+    sim.run_until(warmup + window)
+    bytes_per_second = (sim.bytes_sent - start_bytes) / window
+    packets_per_second = (sim.packets_sent - start_packets) / window
+    
+    # A link comes or goes partway through a slot. Routes stop using a removed
+    # link once either end's update says so, and use a new one once both do;
+    # nodes past the hop limit never route over it
+    a, b, add = pick_change(graph, rng)
+    sim.run_until(sim.now + rng.uniform(0, HSLS_SLOT))
+    changed_at = sim.now
+    first_seq = sim.change_link(a, b, add)
+    distances = [hop_distances(graph, a), hop_distances(graph, b)]
+    affected = [node_id for node_id in graph if node_id not in (a, b) and min(d.get(node_id, MAX_TTL + 1) for d in distances) <= MAX_TTL]
+    
+    def learnt(node_id, origin):
+        held = sim.known[node_id].get(origin)
+        return held[1] if held is not None and held[0] >= first_seq[origin] else None
+    
+    def node_converged(node_id):
+        times = [learnt(node_id, origin) for origin in (a, b)]
+        if add:
+            return max(times) if None not in times else None
+        return min(time for time in times if time is not None) if any(time is not None for time in times) else None
+    
+    def converged():
+        return all(node_converged(node_id) is not None for node_id in affected)
+    
+    limit = changed_at + (diameter + 2 * cycle + 2) * HSLS_SLOT
+    sim.run_until(limit, converged)
+    times = [node_converged(node_id) for node_id in affected]
+    convergence = max((time if time is not None else limit) - changed_at for time in times) if times else 0.0
+    return {
+        "links": sum(len(neighbors) for neighbors in graph.values()) // 2,
+        "bytes_per_second": bytes_per_second,
+        "packets_per_second": packets_per_second,
+        "convergence": convergence
+    }
+
+
+def run_comparison(sizes, trials, seed):
+    """Print overhead and convergence for each mesh size under both schedules"""
+    print(f"Slot {HSLS_SLOT}s, scopes {', '.join(str(1 << level) for level in range(1, HSLS_LEVELS + 1))} hops, routes up to {MAX_TTL} hops")
+    print(f"\n{'nodes':>6}{'links':>7}{'flat B/s':>12}{'hsls B/s':>12}{'flat pkt/s':>12}{'hsls pkt/s':>12}{'flat conv s':>13}{'hsls conv s':>13}")
+    for nodes in sizes:
+        results = {}
+        for scheme in ("flat", "hsls"):
+            runs = [run_trial(nodes, scheme, seed + trial) for trial in range(trials)]
+            results[scheme] = {key: sum(run[key] for run in runs) / trials for key in runs[0]}
+        flat, hsls = results["flat"], results["hsls"]
+        print(
+            f"{nodes:>6}{flat['links']:>7.0f}"
+            f"{flat['bytes_per_second']:>12.0f}{hsls['bytes_per_second']:>12.0f}"
+            f"{flat['packets_per_second']:>12.1f}{hsls['packets_per_second']:>12.1f}"
+            f"{flat['convergence']:>13.1f}{hsls['convergence']:>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare routing update overhead and convergence of the flat and HSLS schedules")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[16, 36, 64, 100, 144])
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    run_comparison(args.nodes, args.trials, args.seed)
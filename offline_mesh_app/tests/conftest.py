@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules import each other from the app directory, as when run from main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
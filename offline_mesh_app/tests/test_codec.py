@@ -0,0 +1,64 @@
+import uuid
+import pytest
+from utils.codec import (
+    encode_packet, decode_packet, encode_binary, decode_binary, CodecError,
+    CODEC_JSON, CODEC_BINARY, BINARY_MAGIC
+)
+
+
+def test_binary_roundtrip_file_chunk():
+    """Header fields, fixed fields and raw data all come back as they went in"""
+    packet = {
+        "type": "file_chunk",
+        "src": "a1b2c3d4",
+        "dst": "e5f6a7b8",
+        "file_id": str(uuid.uuid4()),
+        "chunk_index": 7,
+        "total_chunks": 9,
+        "chunk_size": 8192,
+        "ttl": 5,
+        "timestamp": 1700000000.25,
+        "multi_hop": True,
+        "data": b"\x00\x01chunk bytes\xff"
+    }
+    encoded = encode_packet(packet, CODEC_BINARY)
+    assert encoded[0] == BINARY_MAGIC
+    decoded, codec = decode_packet(encoded)
+    assert codec == CODEC_BINARY
+    assert decoded == packet
+
+
+def test_binary_roundtrip_file_hashes():
+    """file_hashes packs its start and chunk count as fixed fields"""
+    packet = {"type": "file_hashes", "file_id": str(uuid.uuid4()), "start": 8192, "total_chunks": 10000, "data": b"h" * 64}
+    assert decode_binary(encode_binary(packet)) == packet
+
+
+def test_binary_keeps_fields_that_dont_fit_the_header():
+    """Values the fixed header can't hold travel in the JSON extras instead"""
+    packet = {"type": "message", "src": "a-node-id-longer-than-8", "id": "not-a-uuid", "ttl": 300, "content": "hi"}
+    assert decode_binary(encode_binary(packet)) == packet
+
+
+def test_json_roundtrip_base64_encodes_data():
+    """JSON packets carry raw data as base64"""
+    packet = {"type": "message", "id": "m1", "data": b"raw"}
+    decoded, codec = decode_packet(encode_packet(packet, CODEC_JSON))
+    assert codec == CODEC_JSON
+    assert decoded["data"] == "cmF3"
+    assert decoded["id"] == "m1"
+
+
+def test_binary_rejects_unknown_type_and_missing_fixed_fields():
+    """Packets binary can't encode raise CodecError"""
+    with pytest.raises(CodecError):
+        encode_binary({"type": "no_such_type"})
+    with pytest.raises(CodecError):
+        encode_binary({"type": "file_chunk", "chunk_index": 1})
+
+
+@pytest.mark.parametrize("data", [b"", b"\xb1\x01", b"not json", b"[1, 2]", bytes([BINARY_MAGIC, 9]) + b"\0" * 60])
+def test_decode_rejects_malformed_packets(data):
+    """Truncated, unversioned or non-object packets raise CodecError"""
+    with pytest.raises(CodecError):
+        decode_packet(data)
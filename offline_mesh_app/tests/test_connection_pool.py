@@ -0,0 +1,70 @@
+import threading
+import time
+from client import connection_pool as pool_module
+from client.connection_pool import PeerConnection
+from client.rate_limit import TokenBucket
+from utils.framing import TRAFFIC_CONTROL, TRAFFIC_BULK
+
+
+class StalledPeer(PeerConnection):
+    """A connection whose writes wait until the test lets them through, failing on request"""
+    def __init__(self):
+        super().__init__("10.0.0.9")
+        self.release = threading.Event()
+        self.writing = threading.Event()
+        self.written = []
+        self.fail = False
+    
+    def _write(self, data):
+        self.writing.set()
+        self.release.wait(5)
+        if self.fail:
+            raise OSError("connection reset")
+        self.written.append(data)
+
+
+def test_unwaited_frames_queue_up_to_the_cap(monkeypatch):
+    """Frames sent without waiting return at once and are dropped past the class's byte cap"""
+    monkeypatch.setattr(pool_module, "EGRESS_QUEUE_MAX_BYTES", 300)
+    peer = StalledPeer()
+    assert peer.send(b"first", TRAFFIC_BULK, wait=False)
+    assert peer.writing.wait(5)
+    assert all(peer.send(b"b" * 100, TRAFFIC_BULK, wait=False) for _ in range(3))
+    assert not peer.send(b"b" * 100, TRAFFIC_BULK, wait=False)
+    assert peer.send(b"c" * 100, TRAFFIC_CONTROL, wait=False)
+    assert peer.get_stats()["bulk"]["dropped"] == 1
+    
+    peer.release.set()
+    peer.send(b"done", TRAFFIC_BULK)
+    assert peer.written == [b"first", b"c" * 100] + [b"b" * 100] * 3 + [b"done"]
+    assert peer.queued_bytes[TRAFFIC_BULK] == 0
+
+
+def test_failed_unwaited_frame_reports_its_error():
+    """A write error on a frame nobody waits for goes to its callback"""
+    peer = StalledPeer()
+    peer.fail = True
+    errors = []
+    reported = threading.Event()
+    peer.send(b"x", TRAFFIC_CONTROL, wait=False, on_error=lambda e: (errors.append(e), reported.set()))
+    peer.release.set()
+    assert reported.wait(5)
+    assert isinstance(errors[0], OSError)
+
+
+def test_bulk_frame_waits_in_queue_for_its_limits():
+    """A bulk frame charged to a bucket in debt is held back without holding up control frames"""
+    bucket = TokenBucket(rate=1000, burst=0)
+    bucket.reserve(200, wait=False)
+    peer = StalledPeer()
+    peer.release.set()
+    start = time.time()
+    peer.send(b"relayed", TRAFFIC_BULK, wait=False, limits=(bucket,))
+    peer.send(b"ack", TRAFFIC_CONTROL)
+    assert peer.written == [b"ack"]
+    assert time.time() - start < 0.1
+    
+    peer.send(b"own", TRAFFIC_BULK)
+    assert peer.written == [b"ack", b"relayed", b"own"]
+    assert time.time() - start >= 0.15
+    assert bucket.get_stats()["passed_bytes"] == 200 + len(b"relayed")
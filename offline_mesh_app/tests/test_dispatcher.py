@@ -0,0 +1,42 @@
+import queue
+import pytest
+from server.dispatcher import IngressDispatcher, POLICY_DROP_OLDEST_ROUTING
+from utils.framing import frame_flags_for
+
+
+def queued(dispatcher):
+    """Names of the packets waiting in the dispatcher's queue"""
+    return [item[-1][0] for item in dispatcher.queue]
+
+
+def test_full_queue_sheds_routing_updates_only():
+    """An overloaded queue drops the oldest routing or gateway update, never acks or chat"""
+    dispatcher = IngressDispatcher(lambda *args: None, workers=0, max_queue=3, policy=POLICY_DROP_OLDEST_ROUTING)
+    assert dispatcher.submit(frame_flags_for("file_ack"), "ack")
+    assert dispatcher.submit(frame_flags_for("routing"), "routing")
+    assert dispatcher.submit(frame_flags_for("gateway_update"), "gateway")
+    
+    assert dispatcher.submit(frame_flags_for("message"), "message")
+    assert queued(dispatcher) == ["ack", "gateway", "message"]
+    assert dispatcher.submit(frame_flags_for("file_have_map"), "have_map")
+    assert queued(dispatcher) == ["ack", "message", "have_map"]
+    assert dispatcher.get_stats()["dropped"]["control"] == 2
+
+
+def test_routing_update_dropped_when_nothing_can_be_shed():
+    """With only user traffic and acks queued, a new routing update is the one dropped"""
+    dispatcher = IngressDispatcher(lambda *args: None, workers=0, max_queue=2, policy=POLICY_DROP_OLDEST_ROUTING)
+    dispatcher.submit(frame_flags_for("file_ack"), "ack")
+    dispatcher.submit(frame_flags_for("message"), "message")
+    assert not dispatcher.submit(frame_flags_for("routing"), "routing")
+    assert queued(dispatcher) == ["ack", "message"]
+
+
+def test_full_queue_raises_instead_of_blocking():
+    """Submitting without blocking raises queue.Full where a blocking submit would wait"""
+    dispatcher = IngressDispatcher(lambda *args: None, workers=0, max_queue=1, policy=POLICY_DROP_OLDEST_ROUTING)
+    dispatcher.submit(frame_flags_for("message"), "message")
+    with pytest.raises(queue.Full):
+        dispatcher.submit(frame_flags_for("file_chunk"), "chunk", block=False)
+    assert not dispatcher.submit(frame_flags_for("routing"), "routing", block=False)
+    assert queued(dispatcher) == ["message"]
@@ -0,0 +1,19 @@
+import pytest
+from utils.encryption import encrypt_data, decrypt_data, DecryptionError, SEAL_VERSION, SEAL_VERSION_CHACHA, CHACHA_MAX_SIZE
+
+
+@pytest.mark.parametrize("size, version", [(64, SEAL_VERSION_CHACHA), (CHACHA_MAX_SIZE, SEAL_VERSION_CHACHA), (CHACHA_MAX_SIZE + 1, SEAL_VERSION)])
+def test_cipher_chosen_by_size(size, version):
+    """Small data is sealed with ChaCha20-Poly1305, larger with AES-GCM, and both open"""
+    data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    sealed = encrypt_data(data, b"header")
+    assert sealed[0] == version
+    assert decrypt_data(sealed, b"header") == data
+
+
+def test_seal_bound_to_its_version():
+    """Relabelling a seal as the other cipher's fails authentication instead of opening"""
+    sealed = bytearray(encrypt_data(b"hello", b"header"))
+    sealed[0] = SEAL_VERSION
+    with pytest.raises(DecryptionError):
+        decrypt_data(bytes(sealed), b"header")
@@ -0,0 +1,97 @@
+import pytest
+from utils.codec import CODEC_JSON, CODEC_BINARY
+from utils.encryption import DecryptionError
+from config import MY_ID
+from utils.envelope import seal_packet, open_envelope, open_body, came_direct, EnvelopeError
+
+
+def message_packet():
+    """A multi-hop chat message with every routing field set"""
+    return {
+        "type": "message",
+        "id": "3f2b8c9e-1d4a-4e6f-9a7b-2c5d8e1f0a3b",
+        "src": "a1b2c3d4",
+        "dst": "e5f6a7b8",
+        "ttl": 6,
+        "hops": ["a1b2c3d4"],
+        "multi_hop": True,
+        "timestamp": 1700000000.5,
+        "content": "hello over the mesh"
+    }
+
+
+@pytest.mark.parametrize("codec", [CODEC_JSON, CODEC_BINARY])
+def test_seal_and_open(codec):
+    """The header opens without the body, and the body decrypts to the original packet"""
+    packet = message_packet()
+    opened = open_envelope(seal_packet(packet, codec))
+    for key in ("type", "id", "src", "dst", "ttl", "hops", "multi_hop"):
+        assert opened[key] == packet[key]
+    assert "content" not in opened
+    
+    body, body_codec = open_body(opened)
+    assert body_codec == codec
+    assert {key: value for key, value in body.items() if not key.startswith("_")} == packet
+
+
+def test_relay_rewrites_mutable_header_and_reuses_body():
+    """A relay can change ttl and hops without touching the sealed body"""
+    opened = open_envelope(seal_packet(message_packet()))
+    body = opened["_envelope"][1]
+    opened["ttl"] -= 1
+    opened["hops"] = opened["hops"] + ["c9d8e7f6"]
+    
+    relayed = open_envelope(seal_packet(opened))
+    assert relayed["_envelope"][1] == body
+    assert relayed["ttl"] == 5
+    assert relayed["hops"] == ["a1b2c3d4", "c9d8e7f6"]
+    assert open_body(relayed)[0]["content"] == "hello over the mesh"
+
+
+def test_direct_packets_told_apart_by_previous_hop():
+    """A packet counts as direct only when the node that sent it is its origin, whatever its hops say"""
+    own = message_packet()
+    own["src"] = MY_ID
+    assert came_direct(open_envelope(seal_packet(own)))
+    
+    # A relayed file chunk has no hops list to give it away
+    chunk = {"type": "file_chunk", "file_id": "3f2b8c9e-1d4a-4e6f-9a7b-2c5d8e1f0a3b", "src": "a1b2c3d4", "dst": MY_ID, "ttl": 5}
+    relayed = open_envelope(seal_packet(chunk))
+    assert relayed["_prev_hop"] == MY_ID
+    assert not came_direct(relayed)
+
+
+def test_tampered_header_fails_authentication():
+    """Changing any header byte fails the header tag"""
+    data = bytearray(seal_packet(message_packet()))
+    data[5] ^= 0x01
+    with pytest.raises(EnvelopeError):
+        open_envelope(bytes(data))
+
+
+def test_tampered_body_fails_decryption():
+    """Changing the sealed body passes the header check but fails decryption"""
+    data = bytearray(seal_packet(message_packet()))
+    data[-1] ^= 0x01
+    opened = open_envelope(bytes(data))
+    with pytest.raises(DecryptionError):
+        open_body(opened)
+
+
+def test_body_bound_to_fixed_header():
+    """A body moved under another packet's header fails decryption"""
+    first = open_envelope(seal_packet(message_packet()))
+    other = message_packet()
+    other["dst"] = "0a0b0c0d"
+    second = open_envelope(seal_packet(other))
+    second["_envelope"] = (second["_envelope"][0], first["_envelope"][1]) + second["_envelope"][2:]
+    with pytest.raises(DecryptionError):
+        open_body(second)
+
+
+def test_truncated_envelope():
+    """Packets shorter than their header length are rejected"""
+    with pytest.raises(EnvelopeError):
+        open_envelope(b"\x00")
+    with pytest.raises(EnvelopeError):
+        open_envelope(seal_packet(message_packet())[:10])
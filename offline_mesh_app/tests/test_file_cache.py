@@ -0,0 +1,161 @@
+import os
+import pytest
+from routing import cache as cache_module
+from routing.cache import FileCache
+from utils.merkle import chunk_hash, merkle_root, pack_hashes
+
+CHUNK = 1024
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """A file cache writing under a temporary downloads directory"""
+    monkeypatch.setattr(cache_module, "DOWNLOAD_DIR", str(tmp_path))
+    file_cache = FileCache()
+    yield file_cache
+    for file_id in list(file_cache.cache):
+        file_cache._discard(file_id)
+
+
+def chunks_of(data, size=CHUNK):
+    """Split data into chunks of `size` bytes"""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def held(cache, file_id):
+    """Indexes of the chunks the bitmap marks as held"""
+    entry = cache.cache[file_id]
+    return [i for i in range(entry["total_chunks"]) if entry["bitmap"][i // 8] & (1 << (i % 8))]
+
+
+def test_chunks_complete_a_file(cache, tmp_path):
+    """Chunks in any order, duplicates included, complete the file and save it intact"""
+    data = os.urandom(CHUNK * 9 + 100)
+    chunks = chunks_of(data)
+    cache.register_file("f", "a.bin", len(chunks), len(data), CHUNK)
+    for index in [3, 0, 9, 3, 1, 2, 4, 5, 6, 7]:
+        assert not cache.add_file_chunk("f", index, chunks[index], len(chunks), "a.bin", CHUNK)
+    assert held(cache, "f") == [0, 1, 2, 3, 4, 5, 6, 7, 9]
+    assert cache.get_file_chunk("f", 9) == chunks[9]
+    
+    assert cache.add_file_chunk("f", 8, chunks[8], len(chunks), "a.bin", CHUNK)
+    path = cache.save_complete_file("f")
+    assert open(path, "rb").read() == data
+    assert cache.get_have_map("f") == {"complete": True}
+
+
+def test_have_map_and_resume_after_restart(cache):
+    """The bitmap survives a restart, so a resumed transfer only needs the missing chunks"""
+    data = os.urandom(CHUNK * 12)
+    chunks = chunks_of(data)
+    cache.register_file("f", "a.bin", 12, len(data), CHUNK)
+    for index in (0, 1, 5, 11):
+        cache.add_file_chunk("f", index, chunks[index], 12, "a.bin", CHUNK)
+    cache._persist("f", cache.cache["f"], force=True)
+    
+    have_map = cache.get_have_map("f")
+    assert have_map["bitmap"] == bytes([0b00100011, 0b00001000])
+    assert have_map["hashes"] is True
+    
+    os.close(cache.cache["f"]["fd"])
+    restarted = FileCache()
+    assert held(restarted, "f") == [0, 1, 5, 11]
+    assert restarted.get_file_chunk("f", 5) == chunks[5]
+    restarted._discard("f")
+    cache.cache.pop("f")
+
+
+def test_take_ack_reports_gaps(cache):
+    """Acknowledgements give the cumulative point and the ranges held beyond it, latest first"""
+    data = os.urandom(CHUNK * 10)
+    chunks = chunks_of(data)
+    cache.register_file("f", "a.bin", 10, len(data), CHUNK)
+    for index in (0, 1, 3, 4, 7):
+        cache.add_file_chunk("f", index, chunks[index], 10, "a.bin", CHUNK)
+    
+    ack = cache.take_ack("f")
+    assert ack == {"complete": False, "ack": 2, "sack": [[7, 8], [3, 5]], "chunk_size": CHUNK}
+    assert cache.take_ack("f") is None
+
+
+def test_rechunk_keeps_whole_new_chunks(cache):
+    """After a chunk-size switch, only new chunks whose bytes are all held stay held"""
+    data = os.urandom(CHUNK * 8)
+    chunks = chunks_of(data)
+    cache.register_file("f", "a.bin", 8, len(data), CHUNK)
+    for index in (0, 1, 2, 5):
+        cache.add_file_chunk("f", index, chunks[index], 8, "a.bin", CHUNK)
+    
+    cache.register_file("f", "a.bin", 4, len(data), CHUNK * 2)
+    entry = cache.cache["f"]
+    assert (entry["total_chunks"], entry["chunk_size"], entry["received"]) == (4, CHUNK * 2, 1)
+    assert held(cache, "f") == [0]
+    assert cache.get_file_chunk("f", 0) == data[:CHUNK * 2]
+
+
+def test_file_waits_for_its_hashes(cache):
+    """A file announced with a Merkle root isn't complete until its hashes are in, and bad chunks are dropped"""
+    data = os.urandom(CHUNK * 4)
+    chunks = chunks_of(data)
+    leaves = [chunk_hash(chunk) for chunk in chunks]
+    cache.register_file("f", "a.bin", 4, len(data), CHUNK, root=merkle_root(leaves))
+    assert cache.get_have_map("f")["hashes"] is False
+    
+    for index, chunk in enumerate(chunks[:3] + [b"x" * CHUNK]):
+        assert not cache.add_file_chunk("f", index, chunk, 4, "a.bin", CHUNK)
+    assert not cache.add_file_hashes("f", 0, pack_hashes(leaves[:2]), 4, CHUNK)
+    assert not cache.add_file_hashes("f", 2, pack_hashes(leaves[2:]), 4, CHUNK)
+    
+    # The corrupt last chunk went once the hashes arrived; its resend completes the file
+    assert held(cache, "f") == [0, 1, 2]
+    assert cache.corrupt_chunks == 1
+    assert not cache.add_file_chunk("f", 3, b"y" * CHUNK, 4, "a.bin", CHUNK)
+    assert cache.add_file_chunk("f", 3, chunks[3], 4, "a.bin", CHUNK)
+
+
+def test_add_file_span(cache):
+    """A span of whole chunks is written at once, skipping only the chunks that fail their hashes"""
+    data = os.urandom(CHUNK * 6 + 10)
+    chunks = chunks_of(data)
+    leaves = [chunk_hash(chunk) for chunk in chunks]
+    cache.register_file("f", "a.bin", 7, len(data), CHUNK, root=merkle_root(leaves))
+    cache.add_file_hashes("f", 0, pack_hashes(leaves), 7, CHUNK)
+    
+    spoiled = bytearray(data[:CHUNK * 4])
+    spoiled[CHUNK * 2] ^= 0xFF
+    assert not cache.add_file_span("f", 0, bytes(spoiled))
+    assert held(cache, "f") == [0, 1, 3]
+    assert cache.corrupt_chunks == 1
+    
+    assert cache.add_file_span("f", 2, data[CHUNK * 2:])
+    assert open(cache.save_complete_file("f"), "rb").read() == data
+
+
+def test_add_file_span_rejects_partial_chunks(cache):
+    """A span must cover whole chunks, except at the end of the file"""
+    cache.register_file("f", "a.bin", 4, CHUNK * 4, CHUNK)
+    with pytest.raises(ValueError):
+        cache.add_file_span("f", 0, b"x" * (CHUNK + 1))
+    with pytest.raises(ValueError):
+        cache.add_file_span("f", 3, b"x" * CHUNK * 2)
+    assert not cache.add_file_span("unknown", 0, b"x" * CHUNK)
+
+
+def test_unverified_stream_waits_for_hashes(cache, monkeypatch):
+    """A plain stream's chunks don't complete the file; the hashes that follow check them without reading them back"""
+    data = os.urandom(CHUNK * 4)
+    leaves = [chunk_hash(chunk) for chunk in chunks_of(data)]
+    cache.register_file("f", "a.bin", 4, len(data), CHUNK, needs_hashes=True)
+    spoiled = bytearray(data)
+    spoiled[CHUNK] ^= 0xFF
+    assert not cache.add_file_span("f", 0, bytes(spoiled))
+    assert not cache.is_file_complete("f")
+    assert cache.awaits_hashes("f")
+    assert cache.get_have_map("f")["hashes"] is False
+    
+    monkeypatch.setattr(cache, "get_file_chunk", None)
+    cache.register_file("f", "a.bin", 4, len(data), CHUNK, root=merkle_root(leaves))
+    assert not cache.add_file_hashes("f", 0, pack_hashes(leaves), 4, CHUNK)
+    assert held(cache, "f") == [0, 2, 3]
+    assert cache.add_file_span("f", 1, data[CHUNK:CHUNK * 2])
+    assert open(cache.save_complete_file("f"), "rb").read() == data
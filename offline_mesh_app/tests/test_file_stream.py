@@ -0,0 +1,37 @@
+import io
+import pytest
+from utils.encryption import DecryptionError
+from utils.file_stream import SEGMENT_LENGTH, send_file_stream, open_segment
+
+
+class Progress:
+    """A transfer progress that ignores what it is told"""
+    def add(self, count):
+        pass
+
+
+def sealed_segments(path, stream_id):
+    """The sealed segments a stream of `path` would carry"""
+    sock = io.BytesIO()
+    sock.sendall = sock.write
+    send_file_stream(sock, path, 10, True, Progress(), segment_size=4, stream_id=stream_id)
+    data, segments = sock.getvalue(), []
+    while data:
+        (length,) = SEGMENT_LENGTH.unpack_from(data)
+        segments.append(data[SEGMENT_LENGTH.size:SEGMENT_LENGTH.size + length])
+        data = data[SEGMENT_LENGTH.size + length:]
+    return segments
+
+
+def test_segments_bound_to_stream_and_position(tmp_path):
+    """A segment opens only at its own index of its own stream"""
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"0123456789")
+    first = sealed_segments(str(path), b"a" * 16)
+    second = sealed_segments(str(path), b"b" * 16)
+    assert b"".join(open_segment(b"a" * 16, i, s) for i, s in enumerate(first)) == b"0123456789"
+    
+    with pytest.raises(DecryptionError):
+        open_segment(b"a" * 16, 1, second[1])
+    with pytest.raises(DecryptionError):
+        open_segment(b"a" * 16, 0, first[1])
@@ -0,0 +1,73 @@
+import os
+import pytest
+from utils.merkle import (
+    chunk_hash, merkle_root, file_chunk_hashes, pack_hashes, check_hashes, verify_chunk,
+    PartialHashes, IntegrityError, HASH_SIZE
+)
+
+
+def leaves_for(count):
+    """Leaf hashes of `count` distinct chunks"""
+    return [chunk_hash(f"chunk {i}".encode()) for i in range(count)]
+
+
+def test_root_depends_on_every_leaf_and_its_position():
+    """Changing or reordering leaves changes the root"""
+    leaves = leaves_for(5)
+    root = merkle_root(leaves)
+    assert merkle_root(leaves[:4] + [chunk_hash(b"other")]) != root
+    assert merkle_root([leaves[1], leaves[0]] + leaves[2:]) != root
+    assert merkle_root(leaves[:1]) == leaves[0]
+
+
+def test_file_chunk_hashes(tmp_path):
+    """Hashing a file gives one leaf per chunk, the last one short"""
+    data = os.urandom(2500)
+    path = tmp_path / "f.bin"
+    path.write_bytes(data)
+    assert file_chunk_hashes(str(path), 1000) == [chunk_hash(data[i:i + 1000]) for i in range(0, 2500, 1000)]
+
+
+def test_check_hashes_and_verify_chunk():
+    """Packed hashes check against their root, and each chunk against its hash"""
+    leaves = leaves_for(3)
+    packed = check_hashes(pack_hashes(leaves), 3, merkle_root(leaves))
+    assert verify_chunk(packed, 1, b"chunk 1")
+    assert not verify_chunk(packed, 1, b"chunk 2")
+    
+    with pytest.raises(IntegrityError):
+        check_hashes(pack_hashes(leaves), 4, merkle_root(leaves))
+    with pytest.raises(IntegrityError):
+        check_hashes(pack_hashes(leaves[::-1]), 3, merkle_root(leaves))
+
+
+def test_partial_hashes_in_any_order():
+    """Batches may arrive out of order and repeat; the hashes are returned once all are in"""
+    leaves = leaves_for(10)
+    partial = PartialHashes(10, merkle_root(leaves))
+    assert partial.add(6, pack_hashes(leaves[6:])) is None
+    assert partial.add(0, pack_hashes(leaves[:4])) is None
+    assert partial.add(0, pack_hashes(leaves[:4])) is None
+    assert partial.missing == 2
+    assert partial.add(4, pack_hashes(leaves[4:6])) == pack_hashes(leaves)
+    assert partial.verified == pack_hashes(leaves)
+
+
+def test_partial_hashes_reset_after_a_bad_batch():
+    """A batch that spoils the root is dropped along with the rest, so the next round starts clean"""
+    leaves = leaves_for(4)
+    partial = PartialHashes(4, merkle_root(leaves))
+    partial.add(0, pack_hashes(leaves[:2]))
+    with pytest.raises(IntegrityError):
+        partial.add(2, pack_hashes(leaves[:2]))
+    assert partial.missing == 4
+    assert partial.add(0, pack_hashes(leaves)) == pack_hashes(leaves)
+
+
+@pytest.mark.parametrize("start, data", [(3, b"x" * HASH_SIZE * 2), (-1, b"x" * HASH_SIZE), (0, b"x" * (HASH_SIZE + 1))])
+def test_partial_hashes_reject_batches_that_dont_fit(start, data):
+    """Batches past the end or not a whole number of hashes are refused"""
+    partial = PartialHashes(4, merkle_root(leaves_for(4)))
+    with pytest.raises(IntegrityError):
+        partial.add(start, data)
+    assert partial.missing == 4
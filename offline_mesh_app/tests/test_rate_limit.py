@@ -0,0 +1,91 @@
+import pytest
+from types import SimpleNamespace
+from client import rate_limit
+from client.rate_limit import TokenBucket, RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock the tests move by hand, in place of the rate limiter's"""
+    clock = SimpleNamespace(now=1000.0, slept=[])
+    clock.time = lambda: clock.now
+    clock.sleep = clock.slept.append
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_burst_then_debt(clock):
+    """A full bucket lets a burst through, then a send beyond it waits off the debt"""
+    bucket = TokenBucket(rate=1000, burst=500)
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(250) == pytest.approx(0.25)
+    assert bucket.get_stats()["throttled_bytes"] == 250
+    
+    clock.now += 0.5
+    assert bucket.reserve(100) == 0.0
+    assert bucket.tokens == pytest.approx(150)
+
+
+def test_send_larger_than_burst_goes_through_once(clock):
+    """One oversized send leaves the bucket in debt rather than blocking forever"""
+    bucket = TokenBucket(rate=1000, burst=500)
+    assert bucket.reserve(2000, wait=False) == 0.0
+    assert bucket.debt_delay() == pytest.approx(1.5)
+    clock.now += 1.0
+    assert bucket.debt_delay() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.debt_delay() == 0.0
+
+
+def test_debt_delay_takes_no_tokens(clock):
+    """Checking the debt leaves the bucket as it was"""
+    bucket = TokenBucket(rate=1000, burst=500)
+    bucket.reserve(300)
+    for _ in range(3):
+        assert bucket.debt_delay() == 0.0
+    assert bucket.tokens == pytest.approx(200)
+
+
+def test_consume_sleeps_only_when_waiting(clock):
+    """consume sleeps off debt, unless told not to wait"""
+    bucket = TokenBucket(rate=1000, burst=0)
+    bucket.consume(100, wait=False)
+    assert clock.slept == []
+    bucket.consume(100)
+    assert clock.slept == [pytest.approx(0.2)]
+
+
+def test_refill_is_capped_at_burst(clock):
+    """A long quiet spell earns no more than one burst"""
+    bucket = TokenBucket(rate=1000, burst=500)
+    bucket.reserve(500)
+    clock.now += 60
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(1) > 0
+
+
+def test_unlimited_and_rate_change(clock):
+    """A zero rate never holds traffic back, and lifting a limit clears any debt"""
+    bucket = TokenBucket(rate=0, burst=500)
+    assert bucket.reserve(10 ** 9) == 0.0
+    
+    bucket.set_rate(1000)
+    bucket.reserve(2000)
+    assert bucket.debt_delay() > 0
+    bucket.set_rate(0)
+    assert bucket.debt_delay() == 0.0
+
+
+def test_limiter_keeps_finished_transfer_counters(clock):
+    """Closing a transfer folds its counters into the totals"""
+    limiter = RateLimiter(transfer_rate=1000, peer_rate=0, forward_rate=0)
+    limiter.open_transfer("f1").reserve(300)
+    limiter.close_transfer("f1")
+    limiter.open_transfer("f2").reserve(200)
+    stats = limiter.get_stats()
+    assert stats["transfer"]["passed_bytes"] == 500
+    assert list(stats["transfers"]) == ["f2"]
+    
+    limiter.set_limits(transfer_rate=2000, peer_rate=10)
+    assert limiter.open_transfer("f2").rate == 2000
+    assert limiter.peer("10.0.0.2").rate == 10
@@ -0,0 +1,136 @@
+import pytest
+from types import SimpleNamespace
+from config import MY_ID, ROUTING_TIMEOUT
+from routing import router as router_module
+from routing.router import Router
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock the tests move by hand, in place of the router's"""
+    clock = SimpleNamespace(now=1000.0)
+    clock.time = lambda: clock.now
+    monkeypatch.setattr(router_module, "time", clock)
+    return clock
+
+
+def snapshot(seq, version, links):
+    """A link state carrying every link of its origin"""
+    return {"seq": seq, "ip": "10.0.0.2", "version": version, "links": dict(links)}
+
+
+def delta(seq, version, base, added=None, removed=None):
+    """A link state carrying only what changed since `base`"""
+    return {"seq": seq, "ip": "10.0.0.2", "version": version, "base": base, "added": added or {}, "removed": removed or []}
+
+
+def test_delta_applies_to_its_base(clock):
+    """A delta builds on the version it names"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0, "C": 1.0})}, 1, 1)
+    router.update_link_state("B", "10.0.0.2", {"B": delta(2, 2, 1, added={"D": 2.0}, removed=["C"])}, 2, 1)
+    
+    assert router.link_states["B"]["links"] == {MY_ID: 1.0, "D": 2.0}
+    assert router.link_states["B"]["version"] == 2
+    assert router.missed_updates == 0
+    assert router.routing_table["D"]["next_hop"] == "10.0.0.2"
+    assert "C" not in router.routing_table
+
+
+def test_delta_on_a_missed_version_waits_for_a_snapshot(clock):
+    """A delta whose base we don't hold is counted and dropped; the next snapshot repairs it"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0, "C": 1.0})}, 1, 1)
+    router.update_link_state("B", "10.0.0.2", {"B": delta(3, 3, 2, added={"D": 1.0})}, 3, 1)
+    
+    assert router.missed_updates == 1
+    assert router.link_states["B"]["links"] == {MY_ID: 1.0, "C": 1.0}
+    
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(4, 3, {MY_ID: 1.0, "D": 1.0})}, 4, 1)
+    assert router.link_states["B"]["links"] == {MY_ID: 1.0, "D": 1.0}
+
+
+def test_old_sequence_numbers_are_ignored(clock):
+    """A re-advertised older link state doesn't replace a newer one"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(5, 2, {MY_ID: 1.0, "C": 1.0})}, 5, 1)
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(4, 1, {MY_ID: 1.0})}, 4, 1)
+    assert router.link_states["B"]["seq"] == 5
+    assert "C" in router.link_states["B"]["links"]
+
+
+def test_own_link_state_snapshot_then_delta(clock):
+    """Once a neighbor acknowledges our links, the next update carries only the changes"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0})}, 1, 1)
+    first = router.get_link_state(scope=2)[MY_ID]
+    assert first["links"] == {"B": 1.0}
+    
+    router.update_link_state("B", "10.0.0.2", {"B": dict(snapshot(2, 1, {MY_ID: 1.0}), acks={MY_ID: first["version"]})}, 2, 1)
+    router.update_link_state("C", "10.0.0.3", {"C": snapshot(1, 1, {MY_ID: 1.0})}, 1, 1)
+    router.neighbor_ids["C"]["acked"] = first["version"]
+    second = router.get_link_state(scope=2)[MY_ID]
+    assert "links" not in second
+    assert second["base"] == first["version"]
+    assert second["added"] == {"C": 1.0}
+    assert second["removed"] == []
+
+
+def test_expiry_drops_stale_entries(clock):
+    """Link states and neighbors go once their time is up, and routes through them with them"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0, "C": 1.0})}, 1, 1)
+    assert "C" in router.routing_table
+    assert router.next_expiry() == pytest.approx(1000.0 + ROUTING_TIMEOUT)
+    
+    clock.now += ROUTING_TIMEOUT - 1
+    router.cleanup_stale_routes()
+    assert "B" in router.link_states and "B" in router.neighbor_ids
+    
+    clock.now += 2
+    router.cleanup_stale_routes()
+    assert router.link_states == {}
+    assert router.neighbor_ids == {}
+    assert router.routing_table == {}
+    assert router.expiry_heap == []
+
+
+def test_refreshed_entries_outlive_their_heap_entry(clock):
+    """An entry refreshed since it was indexed is put back at its new expiry, not dropped"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0})}, 1, 1)
+    clock.now += ROUTING_TIMEOUT / 2
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(2, 1, {MY_ID: 1.0})}, 2, 1)
+    
+    clock.now += ROUTING_TIMEOUT / 2 + 1
+    router.cleanup_stale_routes()
+    assert "B" in router.link_states and "B" in router.neighbor_ids
+    assert router.next_expiry() == pytest.approx(1000.0 + ROUTING_TIMEOUT * 1.5)
+    
+    clock.now += ROUTING_TIMEOUT / 2
+    router.cleanup_stale_routes()
+    assert router.link_states == {} and router.neighbor_ids == {}
+
+
+def test_probe_rtt_leaves_out_time_held_at_either_end(clock):
+    """A probe's round trip counts only the link, not time it waited in either node's queues"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0})}, 1, 1)
+    _, seq = router.start_probe("B")
+    
+    clock.now += 0.5
+    router.record_probe_reply("B", seq, received=1000.03, held=0.01)
+    assert router.neighbor_ids["B"]["rtt"] == pytest.approx(0.02)
+
+
+def test_link_failure_counts_pending_probes_once(clock):
+    """Probes in flight on a failed connection are forgotten, not counted again when they time out"""
+    router = Router()
+    router.update_link_state("B", "10.0.0.2", {"B": snapshot(1, 1, {MY_ID: 1.0})}, 1, 1)
+    router.start_probe("B")
+    router.record_link_failure("10.0.0.2")
+    assert list(router.neighbor_ids["B"]["outcomes"]) == [None]
+    
+    clock.now += 10
+    router.start_probe("B")
+    assert list(router.neighbor_ids["B"]["outcomes"]) == [None]
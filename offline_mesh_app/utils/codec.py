@@ -0,0 +1,264 @@
+import json
+import base64
+import struct
+import threading
+import uuid
+from config import WIRE_CODEC
+
+# Codec names
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+
+# Codecs this node can decode, advertised to peers in routing updates
+LOCAL_CODECS = [CODEC_JSON, CODEC_BINARY] if WIRE_CODEC == CODEC_BINARY else [CODEC_JSON]
+
+# Binary packets start with this byte; JSON packets always start with '{'
+BINARY_MAGIC = 0xB1
+BINARY_VERSION = 1
+
+# Fixed header: magic, version, type code, flags, ttl, timestamp, src, dst, id
+BINARY_HEADER = struct.Struct("!BBBBBd8s8s16s")
+EXTRAS_LENGTH = struct.Struct("!I")
+
+# Header flags: which optional fields are present in the fixed header
+FLAG_SRC = 0x01
+FLAG_DST = 0x02
+FLAG_ID = 0x04
+FLAG_TTL = 0x08
+FLAG_TIMESTAMP = 0x10
+FLAG_MULTI_HOP = 0x20
+FLAG_DATA = 0x40  # Raw "data" bytes follow the extras
+
+PACKET_TYPE_CODES = {
+    "routing": 1,
+    "message": 2,
+    "broadcast": 3,
+    "file_info": 4,
+    "file_chunk": 5,
+    "gateway_update": 6,
+    "file_have_query": 7,
+    "file_have_map": 8,
+    "file_ack": 9,
+    "file_hashes": 10,
+    "probe": 11,
+    "probe_reply": 12
+}
+PACKET_TYPE_NAMES = {code: name for name, code in PACKET_TYPE_CODES.items()}
+
+# Field carried in the fixed 16-byte id slot for each packet type
+ID_FIELDS = {
+    "file_chunk": "file_id", "file_have_query": "file_id", "file_have_map": "file_id", "file_ack": "file_id",
+    "file_hashes": "file_id"
+}
+
+# Per-type fixed fields packed straight after the header
+TYPE_FIELDS = {
+    "file_info": (struct.Struct("!QI"), ("filesize", "total_chunks")),
+    "file_chunk": (struct.Struct("!II"), ("chunk_index", "total_chunks")),
+    "file_hashes": (struct.Struct("!II"), ("start", "total_chunks"))
+}
+
+# Codecs each peer has told us it can decode
+peer_codecs = {}  # {ip: set(codec names)}
+peer_codecs_lock = threading.Lock()
+
+
+class CodecError(ValueError):
+    """Raised when a packet can't be encoded or decoded"""
+
+
+def record_peer_codecs(ip, codecs):
+    """Remember which codecs a peer can decode"""
+    with peer_codecs_lock:
+        peer_codecs.setdefault(ip, set()).update(codecs)
+
+
+def codec_for_peer(ip):
+    """Choose the most compact codec a peer supports, falling back to JSON"""
+    if WIRE_CODEC != CODEC_BINARY:
+        return CODEC_JSON
+    with peer_codecs_lock:
+        if CODEC_BINARY in peer_codecs.get(ip, ()):
+            return CODEC_BINARY
+    return CODEC_JSON
+
+
+def _pack_node_id(node_id):
+    """Pack a node ID into 8 bytes, or None if it doesn't fit"""
+    if not isinstance(node_id, str):
+        return None
+    try:
+        raw = node_id.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    if not raw or len(raw) > 8 or b'\0' in raw:
+        return None
+    return raw.ljust(8, b'\0')
+
+
+def _pack_uuid(value):
+    """Pack a UUID string into 16 bytes, or None if it isn't one in canonical form"""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = uuid.UUID(value)
+    except ValueError:
+        return None
+    return parsed.bytes if str(parsed) == value else None
+
+
+def encode_binary(packet):
+    """Encode a packet dict with the fixed binary header plus raw payload"""
+    packet_type = packet.get("type")
+    if packet_type not in PACKET_TYPE_CODES:
+        raise CodecError(f"No binary encoding for packet type '{packet_type}'")
+    
+    extras = dict(packet)
+    del extras["type"]
+    flags = 0
+    
+    src = _pack_node_id(extras.get("src"))
+    if src is not None:
+        flags |= FLAG_SRC
+        del extras["src"]
+    
+    dst = _pack_node_id(extras.get("dst"))
+    if dst is not None:
+        flags |= FLAG_DST
+        del extras["dst"]
+    
+    id_field = ID_FIELDS.get(packet_type, "id")
+    packet_id = _pack_uuid(extras.get(id_field))
+    if packet_id is not None:
+        flags |= FLAG_ID
+        del extras[id_field]
+    
+    ttl = extras.get("ttl")
+    if isinstance(ttl, int) and not isinstance(ttl, bool) and 0 <= ttl <= 255:
+        flags |= FLAG_TTL
+        del extras["ttl"]
+    else:
+        ttl = 0
+    
+    timestamp = extras.get("timestamp")
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        flags |= FLAG_TIMESTAMP
+        del extras["timestamp"]
+    else:
+        timestamp = 0.0
+    
+    if extras.get("multi_hop") is True:
+        flags |= FLAG_MULTI_HOP
+        del extras["multi_hop"]
+    
+    data = extras.get("data")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        flags |= FLAG_DATA
+        del extras["data"]
+    
+    header = BINARY_HEADER.pack(
+        BINARY_MAGIC, BINARY_VERSION, PACKET_TYPE_CODES[packet_type], flags, ttl, timestamp,
+        src or b'\0' * 8, dst or b'\0' * 8, packet_id or b'\0' * 16
+    )
+    
+    # Pack per-type fixed fields when they are all present and in range
+    type_fields = b''
+    if packet_type in TYPE_FIELDS:
+        fields_struct, names = TYPE_FIELDS[packet_type]
+        try:
+            type_fields = fields_struct.pack(*(extras[name] for name in names))
+            for name in names:
+                del extras[name]
+        except (KeyError, struct.error):
+            raise CodecError(f"Packet '{packet_type}' is missing fixed fields {names}")
+    
+    # Everything else travels as compact JSON
+    extras_json = json.dumps(extras, separators=(',', ':')).encode('utf-8') if extras else b''
+    
+    parts = [header, type_fields, EXTRAS_LENGTH.pack(len(extras_json)), extras_json]
+    if flags & FLAG_DATA:
+        parts.append(bytes(data))
+    return b''.join(parts)
+
+
+def decode_binary(data):
+    """Decode a packet produced by encode_binary"""
+    data = memoryview(data)
+    if len(data) < BINARY_HEADER.size + EXTRAS_LENGTH.size:
+        raise CodecError("Binary packet is truncated")
+    
+    magic, version, type_code, flags, ttl, timestamp, src, dst, packet_id = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise CodecError(f"Unsupported binary packet version {version}")
+    if type_code not in PACKET_TYPE_NAMES:
+        raise CodecError(f"Unknown binary packet type {type_code}")
+    
+    packet_type = PACKET_TYPE_NAMES[type_code]
+    offset = BINARY_HEADER.size
+    packet = {"type": packet_type}
+    
+    if packet_type in TYPE_FIELDS:
+        fields_struct, names = TYPE_FIELDS[packet_type]
+        packet.update(zip(names, fields_struct.unpack_from(data, offset)))
+        offset += fields_struct.size
+    
+    (extras_length,) = EXTRAS_LENGTH.unpack_from(data, offset)
+    offset += EXTRAS_LENGTH.size
+    if extras_length:
+        packet.update(json.loads(bytes(data[offset:offset + extras_length])))
+        offset += extras_length
+    
+    if flags & FLAG_SRC:
+        packet["src"] = src.rstrip(b'\0').decode('ascii')
+    if flags & FLAG_DST:
+        packet["dst"] = dst.rstrip(b'\0').decode('ascii')
+    if flags & FLAG_ID:
+        packet[ID_FIELDS.get(packet_type, "id")] = str(uuid.UUID(bytes=packet_id))
+    if flags & FLAG_TTL:
+        packet["ttl"] = ttl
+    if flags & FLAG_TIMESTAMP:
+        packet["timestamp"] = timestamp
+    if flags & FLAG_MULTI_HOP:
+        packet["multi_hop"] = True
+    if flags & FLAG_DATA:
+        packet["data"] = bytes(data[offset:])
+    
+    return packet
+
+
+def encode_json(packet):
+    """Encode a packet dict as JSON, base64-encoding raw data"""
+    data = packet.get("data")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        packet = dict(packet)
+        packet["data"] = base64.b64encode(data).decode('utf-8')
+    return json.dumps(packet).encode('utf-8')
+
+
+def encode_packet(packet, codec=CODEC_JSON):
+    """Encode a packet dict with the given codec"""
+    if codec == CODEC_BINARY:
+        return encode_binary(packet)
+    return encode_json(packet)
+
+
+def decode_packet(data):
+    """Decode a packet in either codec, returning (packet, codec)"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if not data:
+        raise CodecError("Empty packet")
+    
+    if data[0] == BINARY_MAGIC:
+        try:
+            return decode_binary(data), CODEC_BINARY
+        except (struct.error, UnicodeDecodeError, ValueError) as e:
+            raise CodecError(f"Malformed binary packet: {e}")
+    
+    try:
+        packet = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise CodecError(f"Malformed JSON packet: {e}")
+    if not isinstance(packet, dict):
+        raise CodecError("JSON packet is not an object")
+    return packet, CODEC_JSON
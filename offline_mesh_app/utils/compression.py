@@ -0,0 +1,147 @@
+import zlib
+import lzma
+import threading
+from collections import OrderedDict
+from config import (
+    COMPRESSION, COMPRESSION_MIN_SIZE, COMPRESSION_SAMPLE_SIZE, COMPRESSION_MIN_SAVING,
+    COMPRESSION_RECHECK_INTERVAL, COMPRESSION_STATS_FLOWS, MAX_FRAME_SIZE
+)
+
+# Compression names; codes go in the high nibble of the envelope's body format byte
+COMPRESSION_NONE = None
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZMA = "lzma"
+COMPRESSION_CODES = {COMPRESSION_NONE: 0, COMPRESSION_ZLIB: 1, COMPRESSION_LZMA: 2}
+COMPRESSION_NAMES = {code: name for name, code in COMPRESSION_CODES.items()}
+
+# Compressions this node can decode, advertised to peers in routing updates
+LOCAL_COMPRESSIONS = [COMPRESSION_ZLIB, COMPRESSION_LZMA]
+
+# Compression each peer has told us it can decode
+peer_compressions = {}  # {ip: set(compression names)}
+peer_compressions_lock = threading.Lock()
+
+
+class CompressionError(ValueError):
+    """Raised when a compressed body can't be decompressed"""
+
+
+def record_peer_compressions(ip, compressions):
+    """Remember which compressions a peer can decode"""
+    with peer_compressions_lock:
+        peer_compressions.setdefault(ip, set()).update(name for name in compressions if name in LOCAL_COMPRESSIONS)
+
+def compression_for_peer(ip):
+    """Choose the configured compression if the peer can decode it, else none"""
+    if COMPRESSION not in LOCAL_COMPRESSIONS:
+        return COMPRESSION_NONE
+    with peer_compressions_lock:
+        if COMPRESSION in peer_compressions.get(ip, ()):
+            return COMPRESSION
+    return COMPRESSION_NONE
+
+def compress(data, compression):
+    """Compress data with the named compression"""
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, 6)
+    if compression == COMPRESSION_LZMA:
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=1)
+    return data
+
+def decompress(data, compression, max_size=MAX_FRAME_SIZE):
+    """Decompress a body, refusing anything that inflates past max_size"""
+    try:
+        if compression == COMPRESSION_ZLIB:
+            decompressor = zlib.decompressobj()
+            out = decompressor.decompress(data, max_size)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise CompressionError("Compressed body is truncated or too large")
+            return out
+        if compression == COMPRESSION_LZMA:
+            decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+            out = decompressor.decompress(data, max_size)
+            if not decompressor.eof:
+                raise CompressionError("Compressed body is truncated or too large")
+            return out
+    except (zlib.error, lzma.LZMAError) as e:
+        raise CompressionError(f"Malformed compressed body: {e}")
+    return data
+
+
+class FlowCompressor:
+    """Decides per flow whether bodies are worth compressing, and tracks the bytes it saves"""
+    def __init__(self, max_flows=COMPRESSION_STATS_FLOWS):
+        # {flow: {"raw": bytes, "wire": bytes, "compressed": count, "skipped": count,
+        #         "enabled": bool or None, "recheck_at": packet count, "packets": count}}
+        self.flows = OrderedDict()
+        self.max_flows = max_flows
+        self.lock = threading.Lock()
+    
+    def _flow(self, flow):
+        """Get the state of a flow, evicting the least recently used ones"""
+        state = self.flows.get(flow)
+        if state is None:
+            state = {"raw": 0, "wire": 0, "compressed": 0, "skipped": 0, "enabled": None, "recheck_at": 0, "packets": 0}
+            self.flows[flow] = state
+            if len(self.flows) > self.max_flows:
+                self.flows.popitem(last=False)
+        self.flows.move_to_end(flow)
+        return state
+    
+    def _worth_compressing(self, data):
+        """Quick check on a slice from the middle of the data; JPEG, zip and the like barely shrink"""
+        start = max(0, len(data) // 2 - COMPRESSION_SAMPLE_SIZE // 2)
+        sample = bytes(data[start:start + COMPRESSION_SAMPLE_SIZE])
+        return len(zlib.compress(sample, 1)) <= len(sample) * (1 - COMPRESSION_MIN_SAVING)
+    
+    def compress(self, data, flow, compression):
+        """Compress a body for a flow if it pays off, returning (body, compression used)"""
+        if compression is COMPRESSION_NONE or len(data) < COMPRESSION_MIN_SIZE:
+            return data, COMPRESSION_NONE
+        
+        # Small bodies are cheap enough to just try; larger ones follow the flow's
+        # last sample, taken again now and then so a flow can change its mind mid-file
+        small = len(data) <= 2 * COMPRESSION_SAMPLE_SIZE
+        with self.lock:
+            state = self._flow(flow)
+            state["packets"] += 1
+            if not small and (state["enabled"] is None or state["packets"] >= state["recheck_at"]):
+                state["recheck_at"] = state["packets"] + COMPRESSION_RECHECK_INTERVAL
+                state["enabled"] = self._worth_compressing(data)
+            enabled = small or state["enabled"]
+        
+        body, used = data, COMPRESSION_NONE
+        if enabled:
+            compressed = compress(data, compression)
+            if len(compressed) <= len(data) * (1 - COMPRESSION_MIN_SAVING):
+                body, used = compressed, compression
+        
+        with self.lock:
+            state = self._flow(flow)
+            state["raw"] += len(data)
+            state["wire"] += len(body)
+            if used is COMPRESSION_NONE:
+                state["skipped"] += 1
+                if not small:
+                    state["enabled"] = False  # Didn't pay off; wait for the next sample
+            else:
+                state["compressed"] += 1
+        return body, used
+    
+    def get_stats(self):
+        """Get bytes in and out per flow, most recently active first"""
+        with self.lock:
+            stats = {}
+            for flow, state in reversed(self.flows.items()):
+                stats[flow] = {
+                    "raw_bytes": state["raw"],
+                    "wire_bytes": state["wire"],
+                    "saved_bytes": state["raw"] - state["wire"],
+                    "compressed": state["compressed"],
+                    "skipped": state["skipped"]
+                }
+            return stats
+
+
+# Create a global flow compressor
+flow_compressor = FlowCompressor()
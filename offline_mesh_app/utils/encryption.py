@@ -1,69 +1,80 @@
-# AES encryption utils
-# from Crypto.Cipher import AES
-# from Crypto.Random import get_random_bytes
+# Authenticated encryption utils
 
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
+import hmac
+import hashlib
+from Crypto.Cipher import AES, ChaCha20_Poly1305
 from Crypto.Random import get_random_bytes
-import base64
 from config import AES_KEY, USE_ENCRYPTION
 
-def encrypt_data(data):
-    """Encrypt data using AES encryption"""
+# Sealed packet layout: version (1 byte), nonce (12), ciphertext, tag (16);
+# the version byte says which cipher sealed it
+SEAL_VERSION = 0x01  # AES-GCM
+SEAL_VERSION_CHACHA = 0x02  # ChaCha20-Poly1305
+NONCE_SIZE = 12
+TAG_SIZE = 16
+SEAL_OVERHEAD = 1 + NONCE_SIZE + TAG_SIZE
+
+# Setting up an AES-GCM cipher costs more than sealing a small packet with
+# it, and it can't be reused across nonces, so data up to this size goes
+# through ChaCha20-Poly1305, whose setup is cheap; AES-GCM is faster beyond it
+CHACHA_MAX_SIZE = 12 * 1024
+
+# ChaCha20 takes a 32-byte key; derive one so the two ciphers never share a key
+CHACHA_KEY = hmac.new(AES_KEY, b"mesh chacha20-poly1305", hashlib.sha256).digest()
+
+
+class DecryptionError(ValueError):
+    """Raised when data is not a sealed packet or fails authentication"""
+
+
+def _new_cipher(version, nonce):
+    """Create the cipher a seal version names, keyed for a single nonce"""
+    if version == SEAL_VERSION_CHACHA:
+        return ChaCha20_Poly1305.new(key=CHACHA_KEY, nonce=nonce)
+    return AES.new(AES_KEY, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+def encrypt_data(data, associated_data=b''):
+    """Encrypt and authenticate data using ChaCha20-Poly1305 or AES-GCM by size, returning raw bytes"""
+    # Convert data to bytes if it's a string
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    
     if not USE_ENCRYPTION:
         return data
     
-    try:
-        # Convert data to bytes if it's a string
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-        
-        # Generate a random initialization vector
-        iv = get_random_bytes(16)
-        
-        # Create the cipher
-        cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
+    # A fresh random nonce per packet; never reuse one with the same key
+    nonce = get_random_bytes(NONCE_SIZE)
+    version = SEAL_VERSION_CHACHA if len(data) <= CHACHA_MAX_SIZE else SEAL_VERSION
+    cipher = _new_cipher(version, nonce)
         
-        # Pad the data to be a multiple of 16 bytes
-        padded_data = pad(data, AES.block_size)
+    # Associated data is authenticated but sent in the clear by the caller
+    if associated_data:
+        cipher.update(associated_data)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
         
-        # Encrypt the data
-        ciphertext = cipher.encrypt(padded_data)
-        
-        # Combine IV and ciphertext
-        encrypted_data = iv + ciphertext
-        
-        # Encode as base64 for easy transmission
-        return base64.b64encode(encrypted_data)
-    except Exception as e:
-        print(f"Encryption error: {e}")
-        return data
+    return bytes([version]) + nonce + ciphertext + tag
 
-def decrypt_data(encrypted_data):
-    """Decrypt data using AES encryption"""
+def decrypt_data(encrypted_data, associated_data=b''):
+    """Verify and decrypt data produced by encrypt_data, returning raw bytes"""
+    if isinstance(encrypted_data, str):
+        encrypted_data = encrypted_data.encode('utf-8')
+    
     if not USE_ENCRYPTION:
         return encrypted_data
     
+    # Reject foreign or truncated data before doing any crypto
+    if len(encrypted_data) < SEAL_OVERHEAD or encrypted_data[0] not in (SEAL_VERSION, SEAL_VERSION_CHACHA):
+        raise DecryptionError("Not a sealed packet")
+    
+    view = memoryview(encrypted_data)
+    nonce = view[1:1 + NONCE_SIZE]
+    ciphertext = view[1 + NONCE_SIZE:-TAG_SIZE]
+    tag = view[-TAG_SIZE:]
+    
+    cipher = _new_cipher(encrypted_data[0], bytes(nonce))
+    if associated_data:
+        cipher.update(associated_data)
     try:
-        # Decode from base64
-        raw_data = base64.b64decode(encrypted_data)
-        
-        # Extract IV (first 16 bytes)
-        iv = raw_data[:16]
-        ciphertext = raw_data[16:]
-        
-        # Create the cipher
-        cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
-        
-        # Decrypt and unpad the data
-        padded_data = cipher.decrypt(ciphertext)
-        data = unpad(padded_data, AES.block_size)
-        
-        # Return as string if it was originally a string
-        try:
-            return data.decode('utf-8')
-        except UnicodeDecodeError:
-            return data
-    except Exception as e:
-        print(f"Decryption error: {e}")
-        return encrypted_data
+        return cipher.decrypt_and_verify(ciphertext, tag)
+    except ValueError:
+        raise DecryptionError("Packet failed authentication")
@@ -0,0 +1,231 @@
+import hmac
+import struct
+import hashlib
+from config import AES_KEY, MY_ID
+from utils.encryption import encrypt_data, decrypt_data
+from utils.codec import (
+    encode_packet, decode_packet, CodecError, CODEC_JSON, CODEC_BINARY,
+    PACKET_TYPE_CODES, PACKET_TYPE_NAMES, ID_FIELDS
+)
+from utils.compression import (
+    flow_compressor, decompress, COMPRESSION_NONE, COMPRESSION_CODES, COMPRESSION_NAMES
+)
+
+# Every packet frame is a routing header followed by an end-to-end sealed body:
+# header length (2 bytes), routing header, header tag (16), sealed body
+#
+# The routing header has a fixed part set by the origin (version, type, body
+# codec, src, dst, id), which is also bound to the body as associated data,
+# and a mutable part relays rewrite (ttl, flags, hops, previous hop). Relays
+# only need the header, so they forward the body bytes without decrypting them.
+HEADER_VERSION = 1
+HEADER_LENGTH = struct.Struct("!H")
+FIXED_HEADER = struct.Struct("!BBB")  # version, type code, body format
+MUTABLE_HEADER = struct.Struct("!BBB")  # ttl, route flags, hop count
+HEADER_TAG_SIZE = 16
+
+# Body format byte: codec code in the low nibble, compression code in the high
+# nibble, so uncompressed bodies look the same as before compression existed
+BODY_CODECS = {CODEC_JSON: 0, CODEC_BINARY: 1}
+BODY_CODEC_NAMES = {code: name for name, code in BODY_CODECS.items()}
+COMPRESSION_SHIFT = 4
+
+# Packet types whose bodies belong to a file's flow for compression decisions;
+# file_hashes stays out, as chunk hashes never compress whatever the file holds
+FILE_FLOW_TYPES = ("file_chunk",)
+
+# Route flags
+ROUTE_TTL = 0x01
+ROUTE_MULTI_HOP = 0x02
+ROUTE_HOPS = 0x04
+ROUTE_PREV_HOP = 0x08  # The node that sent this copy follows the hops
+
+# Fields carried in the routing header rather than the body
+HEADER_FIELDS = ("src", "dst", "ttl", "hops", "multi_hop")
+
+# Separate key for header tags so they can't be confused with body ciphertext
+HEADER_KEY = hmac.new(AES_KEY, b"mesh routing header", hashlib.sha256).digest()
+
+
+class EnvelopeError(ValueError):
+    """Raised when a packet's routing header is malformed or fails authentication"""
+
+
+def _pack_str(value):
+    """Pack a string with a one-byte length prefix; None packs as empty"""
+    raw = value.encode('utf-8') if value is not None else b''
+    if len(raw) > 255:
+        raise CodecError(f"Header field too long: {value!r}")
+    return bytes([len(raw)]) + raw
+
+def _unpack_str(data, offset):
+    """Unpack a length-prefixed string, returning (value, new offset)"""
+    length = data[offset]
+    offset += 1
+    if offset + length > len(data):
+        raise EnvelopeError("Routing header is truncated")
+    value = bytes(data[offset:offset + length]).decode('utf-8') if length else None
+    return value, offset + length
+
+def _header_tag(header):
+    """Compute the truncated HMAC over a routing header"""
+    return hmac.new(HEADER_KEY, header, hashlib.sha256).digest()[:HEADER_TAG_SIZE]
+
+def _pack_fixed_header(packet, codec, compression=COMPRESSION_NONE):
+    """Pack the origin-set part of the routing header"""
+    packet_type = packet.get("type")
+    if packet_type not in PACKET_TYPE_CODES:
+        raise CodecError(f"No envelope for packet type '{packet_type}'")
+    
+    id_field = ID_FIELDS.get(packet_type, "id")
+    return b''.join([
+        FIXED_HEADER.pack(
+            HEADER_VERSION, PACKET_TYPE_CODES[packet_type],
+            BODY_CODECS[codec] | COMPRESSION_CODES[compression] << COMPRESSION_SHIFT
+        ),
+        _pack_str(packet.get("src")),
+        _pack_str(packet.get("dst")),
+        _pack_str(packet.get(id_field))
+    ])
+
+def _pack_mutable_header(packet):
+    """Pack the part of the routing header relays rewrite"""
+    flags = 0
+    ttl = packet.get("ttl")
+    if isinstance(ttl, int) and 0 <= ttl <= 255:
+        flags |= ROUTE_TTL
+    else:
+        ttl = 0
+    if packet.get("multi_hop"):
+        flags |= ROUTE_MULTI_HOP
+    hops = packet.get("hops")
+    if isinstance(hops, list):
+        flags |= ROUTE_HOPS
+    else:
+        hops = []
+    
+    # Whoever seals the header is the hop it arrives from
+    flags |= ROUTE_PREV_HOP
+    return MUTABLE_HEADER.pack(ttl, flags, len(hops)) + b''.join(_pack_str(hop) for hop in hops) + _pack_str(MY_ID)
+
+def _assemble(fixed, packet, body):
+    """Build the envelope from a fixed header, the packet's routing fields and a sealed body"""
+    header = fixed + _pack_mutable_header(packet)
+    return HEADER_LENGTH.pack(len(header)) + header + _header_tag(header) + body
+
+def _flow_key(packet):
+    """Flow a packet's body counts towards: its file for file transfers, else its type"""
+    packet_type = packet["type"]
+    if packet_type in FILE_FLOW_TYPES:
+        return packet.get(ID_FIELDS.get(packet_type, "id")) or packet_type
+    return packet_type
+
+def seal_packet(packet, codec=CODEC_JSON, compression=COMPRESSION_NONE):
+    """Encode, compress and encrypt a packet into an envelope, reusing the sealed body of a relayed packet"""
+    envelope = packet.get("_envelope")
+    if envelope is not None:
+        fixed, body, body_codec, body_compression = envelope
+        
+        # Any peer can read JSON; only re-encode a binary body for a JSON-only
+        # peer, or a compressed one for a peer that can't inflate it
+        codec_ok = body_codec == codec or body_codec == CODEC_JSON
+        compression_ok = body_compression is COMPRESSION_NONE or body_compression == compression
+        if codec_ok and compression_ok:
+            return _assemble(fixed, packet, body)
+        packet, _ = open_body(packet)
+    
+    id_field = ID_FIELDS.get(packet["type"], "id")
+    body_packet = {
+        key: value for key, value in packet.items()
+        if key not in HEADER_FIELDS and key != id_field and not key.startswith("_")
+    }
+    
+    # Compress before encrypting; ciphertext doesn't compress
+    plain, used = flow_compressor.compress(encode_packet(body_packet, codec), _flow_key(packet), compression)
+    fixed = _pack_fixed_header(packet, codec, used)
+    body = encrypt_data(plain, fixed)
+    return _assemble(fixed, packet, body)
+
+def open_envelope(data):
+    """Verify and parse the routing header, leaving the body sealed"""
+    data = memoryview(data)
+    if len(data) < HEADER_LENGTH.size:
+        raise EnvelopeError("Packet is truncated")
+    
+    (header_length,) = HEADER_LENGTH.unpack_from(data)
+    header_end = HEADER_LENGTH.size + header_length
+    if len(data) < header_end + HEADER_TAG_SIZE:
+        raise EnvelopeError("Packet is truncated")
+    
+    # Check the tag before parsing anything
+    header = bytes(data[HEADER_LENGTH.size:header_end])
+    if not hmac.compare_digest(_header_tag(header), bytes(data[header_end:header_end + HEADER_TAG_SIZE])):
+        raise EnvelopeError("Routing header failed authentication")
+    
+    try:
+        version, type_code, body_format = FIXED_HEADER.unpack_from(header)
+        if version != HEADER_VERSION:
+            raise EnvelopeError(f"Unsupported routing header version {version}")
+        codec_code = body_format & ((1 << COMPRESSION_SHIFT) - 1)
+        compression_code = body_format >> COMPRESSION_SHIFT
+        if type_code not in PACKET_TYPE_NAMES or codec_code not in BODY_CODEC_NAMES or compression_code not in COMPRESSION_NAMES:
+            raise EnvelopeError(f"Unknown packet type {type_code} or body format {body_format}")
+        
+        packet_type = PACKET_TYPE_NAMES[type_code]
+        packet = {"type": packet_type}
+        
+        offset = FIXED_HEADER.size
+        src, offset = _unpack_str(header, offset)
+        dst, offset = _unpack_str(header, offset)
+        packet_id, offset = _unpack_str(header, offset)
+        fixed_end = offset
+        
+        ttl, flags, hop_count = MUTABLE_HEADER.unpack_from(header, offset)
+        offset += MUTABLE_HEADER.size
+        hops = []
+        for _ in range(hop_count):
+            hop, offset = _unpack_str(header, offset)
+            hops.append(hop)
+        prev_hop = None
+        if flags & ROUTE_PREV_HOP:
+            prev_hop, offset = _unpack_str(header, offset)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise EnvelopeError(f"Malformed routing header: {e}")
+    
+    for key, value in (("src", src), ("dst", dst), (ID_FIELDS.get(packet_type, "id"), packet_id)):
+        if value is not None:
+            packet[key] = value
+    if flags & ROUTE_TTL:
+        packet["ttl"] = ttl
+    if flags & ROUTE_MULTI_HOP:
+        packet["multi_hop"] = True
+    if flags & ROUTE_HOPS:
+        packet["hops"] = hops
+    if prev_hop is not None:
+        packet["_prev_hop"] = prev_hop
+    
+    # Keep the sealed body so relays can pass it on untouched
+    packet["_envelope"] = (
+        header[:fixed_end], bytes(data[header_end + HEADER_TAG_SIZE:]),
+        BODY_CODEC_NAMES[codec_code], COMPRESSION_NAMES[compression_code]
+    )
+    return packet
+
+def came_direct(packet):
+    """Whether an opened packet came straight from its origin rather than through a relay"""
+    prev_hop = packet.get("_prev_hop")
+    if prev_hop is not None:
+        return prev_hop == packet.get("src")
+    
+    # Headers from nodes that don't name the previous hop; only multi-hop
+    # packets list their relays
+    return not packet.get("hops")
+
+def open_body(packet):
+    """Decrypt, decompress and decode the body of an opened envelope, returning (packet, codec)"""
+    fixed, body, body_codec, body_compression = packet["_envelope"]
+    body_packet, codec = decode_packet(decompress(decrypt_data(body, fixed), body_compression))
+    
+    # Routing fields come from the authenticated header, which relays may have updated
+    body_packet.update(packet)
+    return body_packet, codec
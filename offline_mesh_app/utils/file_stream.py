@@ -0,0 +1,120 @@
+import struct
+import threading
+from tqdm import tqdm
+from config import DIRECT_SEGMENT_SIZE, MAX_FRAME_SIZE, RATE_LIMIT_BURST
+from utils.encryption import encrypt_data, decrypt_data, SEAL_OVERHEAD
+
+# A sealed file stream is a sequence of segments: sealed length (4 bytes), sealed bytes.
+# Each segment is bound to its stream's id and its position so segments can't be
+# reordered, dropped or spliced in from another stream. A flow stream's id is
+# its file id; a direct stream has no header, so it starts with a random id.
+SEGMENT_LENGTH = struct.Struct("!I")
+SEGMENT_INDEX = struct.Struct("!Q")
+STREAM_ID_SIZE = 16
+
+# A flow stream payload is: envelope length (4 bytes), sealed file_info envelope,
+# then the file stream. Only the envelope is read by relays; the rest is piped.
+# The destination answers with one status byte, which relays pass back upstream.
+FLOW_HEADER_LENGTH = struct.Struct("!I")
+FLOW_COMPLETE = b'\x01'
+FLOW_INCOMPLETE = b'\x00'
+FLOW_UNVERIFIED = b'\x02'  # Every byte arrived, but an unsealed stream waits for its chunk hashes
+
+
+class TransferProgress:
+    """Byte counter for a transfer, reported to a progress bar from its own thread"""
+    def __init__(self, total, desc, interval=0.5):
+        self.total = total
+        self.desc = desc
+        self.interval = interval
+        self.done_bytes = 0
+        self.finished = threading.Event()
+        self.thread = None
+    
+    def add(self, count):
+        """Record bytes transferred; cheap enough to call from the send loop"""
+        self.done_bytes += count
+    
+    def _report(self):
+        """Refresh the progress bar until the transfer finishes"""
+        with tqdm(total=self.total, desc=self.desc, unit="B", unit_scale=True) as pbar:
+            while not self.finished.wait(self.interval):
+                pbar.update(self.done_bytes - pbar.n)
+            pbar.update(self.done_bytes - pbar.n)
+    
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._report, daemon=True)
+        self.thread.start()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.finished.set()
+        self.thread.join()
+
+
+def file_stream_length(filesize, sealed, segment_size=DIRECT_SEGMENT_SIZE):
+    """Bytes on the wire for a file stream of `filesize` bytes"""
+    if not sealed:
+        return filesize
+    segments = (filesize + segment_size - 1) // segment_size
+    return filesize + segments * (SEGMENT_LENGTH.size + SEAL_OVERHEAD)
+
+def flow_stream_id(packet):
+    """Id a flow stream's segments are bound to: the file id in its authenticated file info"""
+    return packet.get("id", "").encode('utf-8')
+
+def send_file_stream(sock, file_path, filesize, sealed, progress, segment_size=DIRECT_SEGMENT_SIZE, limits=(), stream_id=b''):
+    """Write a file stream payload to a socket, holding it to the rate of each token bucket in `limits`"""
+    if not sealed:
+        # Let the kernel copy straight from the page cache to the socket
+        with open(file_path, "rb") as f:
+            offset = 0
+            if limits:
+                # Smaller steps, so a limited stream trickles rather than bursts
+                segment_size = min(segment_size, RATE_LIMIT_BURST)
+            while offset < filesize:
+                count = min(segment_size, filesize - offset)
+                for limit in limits:
+                    limit.consume(count)
+                sent = sock.sendfile(f, offset, count)
+                if sent == 0:
+                    raise ConnectionError(f"File ended after {offset} of {filesize} bytes")
+                offset += sent
+                progress.add(sent)
+        return
+    
+    # Read large segments into one reused buffer and seal each in a single pass
+    buffer = bytearray(segment_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        index = 0
+        remaining = filesize
+        while remaining > 0:
+            count = f.readinto(view[:min(segment_size, remaining)])
+            if not count:
+                raise ConnectionError(f"File ended after {filesize - remaining} of {filesize} bytes")
+            for limit in limits:
+                limit.consume(count)
+            segment = encrypt_data(view[:count], stream_id + SEGMENT_INDEX.pack(index))
+            sock.sendall(SEGMENT_LENGTH.pack(len(segment)) + segment)
+            progress.add(count)
+            remaining -= count
+            index += 1
+
+def parse_segment_length(header):
+    """Get the sealed length from a segment header, rejecting oversized segments"""
+    (length,) = SEGMENT_LENGTH.unpack(header)
+    if length < SEAL_OVERHEAD or length > MAX_FRAME_SIZE:
+        raise ValueError(f"Invalid sealed segment length {length}")
+    return length
+
+def parse_flow_header_length(header):
+    """Get the envelope length from a flow stream header, rejecting oversized envelopes"""
+    (length,) = FLOW_HEADER_LENGTH.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Flow header of {length} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    return length
+
+def open_segment(stream_id, index, segment):
+    """Verify and decrypt the segment at `index` of the sealed stream `stream_id`"""
+    return decrypt_data(segment, stream_id + SEGMENT_INDEX.pack(index))
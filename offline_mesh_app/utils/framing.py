@@ -0,0 +1,149 @@
+import struct
+from config import MAX_FRAME_SIZE
+
+# Every TCP message starts with this header:
+# magic (2 bytes), version (1), frame type (1), flags (2), payload length (8)
+FRAME_MAGIC = b'MN'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBHQ")
+
+# Frame types
+FRAME_PACKET = 1  # Encrypted packet, read whole and handed to handle_packet
+FRAME_FILE_STREAM = 2  # Raw file bytes of a direct transfer, streamed to disk
+FRAME_FLOW_STREAM = 3  # Routing header, then file bytes that relays pipe on to the destination
+
+# Traffic classes, carried in the low bits of the frame flags so receivers
+# can prioritize a packet before decrypting it
+TRAFFIC_CONTROL = 1  # Routing and gateway updates, link probes
+TRAFFIC_INTERACTIVE = 2  # User messages and broadcasts
+TRAFFIC_BULK = 3  # File transfer packets
+TRAFFIC_CLASS_MASK = 0x0003
+
+# File stream frames whose payload is a sequence of sealed segments rather than raw bytes
+FLAG_SEALED_STREAM = 0x0004
+
+# Packets a newer one of their kind replaces, which an overloaded receiver sheds first
+FLAG_SHEDDABLE = 0x0008
+
+TRAFFIC_CLASS_NAMES = {
+    TRAFFIC_CONTROL: "control",
+    TRAFFIC_INTERACTIVE: "interactive",
+    TRAFFIC_BULK: "bulk"
+}
+
+# Traffic class of each packet type
+PACKET_TRAFFIC_CLASSES = {
+    "routing": TRAFFIC_CONTROL,
+    "gateway_update": TRAFFIC_CONTROL,
+    "message": TRAFFIC_INTERACTIVE,
+    "broadcast": TRAFFIC_INTERACTIVE,
+    "file_info": TRAFFIC_BULK,
+    "file_chunk": TRAFFIC_BULK,
+    "file_hashes": TRAFFIC_BULK,
+    "file_have_query": TRAFFIC_CONTROL,
+    "file_have_map": TRAFFIC_CONTROL,
+    "file_ack": TRAFFIC_CONTROL,
+    "probe": TRAFFIC_CONTROL,
+    "probe_reply": TRAFFIC_CONTROL
+}
+
+# Packet types marked sheddable: routing and gateway updates are resent
+# periodically, so dropping one under load only delays the next
+SHEDDABLE_TYPES = ("routing", "gateway_update")
+
+
+class FrameError(Exception):
+    """Raised when a frame header is malformed or unsupported"""
+
+
+def traffic_class_for(packet_type):
+    """Get the traffic class for a packet type, treating unknown types as interactive"""
+    return PACKET_TRAFFIC_CLASSES.get(packet_type, TRAFFIC_INTERACTIVE)
+
+
+def frame_flags_for(packet_type):
+    """Get the frame flags for a packet type: its traffic class, and whether receivers may shed it"""
+    return traffic_class_for(packet_type) | (FLAG_SHEDDABLE if packet_type in SHEDDABLE_TYPES else 0)
+
+
+def frame_traffic_class(flags):
+    """Get the traffic class from frame flags, treating unmarked frames as interactive"""
+    return (flags & TRAFFIC_CLASS_MASK) or TRAFFIC_INTERACTIVE
+
+
+def encode_frame_header(length, frame_type=FRAME_PACKET, flags=0):
+    """Build the header for a frame carrying `length` payload bytes"""
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, flags, length)
+
+
+def encode_frame(payload, frame_type=FRAME_PACKET, flags=0):
+    """Wrap a payload in a frame"""
+    # Convert payload to bytes if it's not already
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return encode_frame_header(len(payload), frame_type, flags) + payload
+
+
+def decode_frame_header(header):
+    """Parse a frame header, returning (frame_type, flags, length)"""
+    magic, version, frame_type, flags, length = FRAME_HEADER.unpack(header)
+    
+    if magic != FRAME_MAGIC:
+        raise FrameError(f"Bad frame magic {magic!r}")
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version {version}")
+    
+    # Only packets are buffered in memory, so only they are size-limited
+    if frame_type == FRAME_PACKET and length > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {length} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    
+    return frame_type, flags, length
+
+
+def recv_exact(sock, size):
+    """Receive exactly `size` bytes, or None if the peer closed before sending any"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            if received == 0:
+                return None
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    
+    return bytes(buffer)
+
+
+def read_frame_header(sock):
+    """Read one frame header from a socket, or None on a clean close"""
+    header = recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    return decode_frame_header(header)
+
+
+def read_frame(sock):
+    """Read one complete frame, returning (frame_type, flags, payload) or None on a clean close"""
+    header = read_frame_header(sock)
+    if header is None:
+        return None
+    
+    frame_type, flags, length = header
+    payload = recv_exact(sock, length) if length else b''
+    if payload is None:
+        raise ConnectionError("Connection closed before frame payload")
+    
+    return frame_type, flags, payload
+
+
+async def read_frame_header_async(reader):
+    """Read one frame header from an asyncio stream, or None on a clean close"""
+    header = await reader.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        header += await reader.readexactly(FRAME_HEADER.size - len(header))
+    return decode_frame_header(header)
@@ -0,0 +1,98 @@
+import hashlib
+
+# SHA-256 digests; leaves and interior nodes get different prefixes so one
+# can't be passed off as the other
+HASH_SIZE = 32
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+class IntegrityError(ValueError):
+    """Raised when chunk hashes don't match their Merkle root"""
+
+
+def chunk_hash(data):
+    """Leaf hash of one file chunk"""
+    return hashlib.sha256(LEAF_PREFIX + bytes(data)).digest()
+
+def merkle_root(leaves):
+    """Root of the hash tree over a list of leaf hashes; an odd node is carried up a level"""
+    if not leaves:
+        return hashlib.sha256(b'').digest()
+    
+    level = list(leaves)
+    while len(level) > 1:
+        parents = [
+            hashlib.sha256(NODE_PREFIX + level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+def file_chunk_hashes(file_path, chunk_size):
+    """Leaf hashes of every chunk of a file, read in one pass"""
+    leaves = []
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb") as f:
+        while count := f.readinto(buffer):
+            leaves.append(chunk_hash(view[:count]))
+    return leaves
+
+def pack_hashes(leaves):
+    """Concatenate leaf hashes for a file_hashes packet"""
+    return b''.join(leaves)
+
+def check_hashes(data, total_chunks, root):
+    """Check a file's packed leaf hashes against its Merkle root, returning them as bytes"""
+    data = bytes(data)
+    if len(data) != total_chunks * HASH_SIZE:
+        raise IntegrityError(f"Expected {total_chunks} chunk hashes, got {len(data)} bytes")
+    
+    leaves = [data[i:i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)]
+    if merkle_root(leaves) != root:
+        raise IntegrityError("Chunk hashes don't match the Merkle root")
+    return data
+
+def verify_chunk(hashes, chunk_index, data):
+    """Check a chunk against the packed leaf hashes of its file"""
+    offset = chunk_index * HASH_SIZE
+    return chunk_hash(data) == hashes[offset:offset + HASH_SIZE]
+
+
+class PartialHashes:
+    """Leaf hashes of a file arriving in file_hashes packets, checked against the root once every chunk has one"""
+    def __init__(self, total_chunks, root):
+        self.total_chunks = total_chunks
+        self.root = root
+        self.data = bytearray(total_chunks * HASH_SIZE)
+        self.held = bytearray(total_chunks)  # 1 for each chunk whose hash has arrived
+        self.missing = total_chunks
+        self.verified = None  # Packed hashes once they match the root
+    
+    def add(self, start, data):
+        """Take the hashes of the chunks from `start` on, returning all of them once they are in and match the root"""
+        if self.verified is not None:
+            return self.verified
+        
+        data = bytes(data)
+        count, extra = divmod(len(data), HASH_SIZE)
+        if extra or not isinstance(start, int) or start < 0 or start + count > self.total_chunks:
+            raise IntegrityError(f"Hashes for chunks {start} to {start + count} don't fit {self.total_chunks} chunks")
+        
+        self.data[start * HASH_SIZE:(start + count) * HASH_SIZE] = data
+        self.missing -= count - self.held.count(1, start, start + count)
+        self.held[start:start + count] = b'\x01' * count
+        if self.missing:
+            return None
+        
+        try:
+            self.verified = check_hashes(self.data, self.total_chunks, self.root)
+        except IntegrityError:
+            # Some batch was bad; start over so the sender's next round refills it
+            self.held = bytearray(self.total_chunks)
+            self.missing = self.total_chunks
+            raise
+        return self.verified